@@ -184,12 +184,22 @@ run_cmd('mkdir /srv/{PROJECT}')
 run_cmd('mkdir -p /var/log/{PROJECT}')
 run_cmd('chown -R {PROJECT}:{PROJECT} /var/log/{PROJECT}')
 run_cmd('chmod 755 /var/log/{PROJECT}')
+run_cmd('mkdir -p /var/lib/{PROJECT}')
+run_cmd('chown -R {PROJECT}:{PROJECT} /var/lib/{PROJECT}')
+run_cmd('chmod 755 /var/lib/{PROJECT}')
 run_cmd('cp {DIR}/other/legcocar_template.conf /srv/{PROJECT}/')
 run_cmd('cp -R {DIR}/html_static /srv/{PROJECT}/')
 run_cmd('cp -R {DIR}/html_templates /srv/{PROJECT}/')
 run_cmd('cp {DIR}/src/flaskserver.py /srv/{PROJECT}/')
+run_cmd('cp {DIR}/src/macros.py /srv/{PROJECT}/')
+run_cmd('cp {DIR}/src/routing.py /srv/{PROJECT}/')
+run_cmd('cp {DIR}/src/settings.py /srv/{PROJECT}/')
 run_cmd('cp {DIR}/src/wsgi.py /srv/flask_wsgi/')
 run_cmd('cp {DIR}/other/000-default.conf /etc/apache2/sites-available/')
+
+# Ship precompiled bytecode, so that web server and car control workers don't
+# compile the modules when they start
+run_cmd('python3 -m compileall -q /srv/{PROJECT} /srv/flask_wsgi {DIR}/src')
 run_cmd('chown -R {PROJECT}:{PROJECT} /srv/flask_wsgi')
 run_cmd('chmod 755 /srv/flask_wsgi')
 run_cmd('chown -R {PROJECT}:{PROJECT} /srv/{PROJECT}')
@@ -211,6 +221,14 @@ if not quick:
         '''echo '[rabbitmq_management].' > /etc/rabbitmq/enabled_plugins''')
     run_cmd('chown rabbitmq.rabbitmq /etc/rabbitmq/enabled_plugins')
 
+# /etc/rabbitmq/rabbitmq.config and the command exchange and queue
+# definitions it loads
+if not quick:
+    run_cmd('cp {DIR}/other/rabbitmq.config /etc/rabbitmq/')
+    run_cmd('cp {DIR}/other/rabbitmq_definitions.json /etc/rabbitmq/')
+    run_cmd('chown rabbitmq.rabbitmq /etc/rabbitmq/rabbitmq.config '
+            '/etc/rabbitmq/rabbitmq_definitions.json')
+
 # Create RabbitMQ project user
 if not quick:
     run_cmd('rabbitmqctl add_user {PROJECT} {PROJECT}')
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Benchmark
+*********
+
+This module benchmarks the complete command path. HTTP requests are sent to
+the flask server through its WSGI interface, published to an in-memory broker
+and consumed by the real :class:`Car` running against a simulated hub.
+
+Instead of random HTTP requests, a recorded command stream can be replayed
+directly into the broker.
+
+"""
+
+# Built in modules
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Third party modules
+import curio
+from werkzeug.test import EnvironBuilder
+
+# Local modules
+import flaskserver
+import routing
+import simhub
+from membroker import InMemoryBroker
+from recorder import CommandReplayer, read_recording
+
+
+def percentiles(values: list):
+    """
+    Summarize a list of latencies.
+
+    :param values: Latencies in seconds.
+    :rtype:        dict
+    :return:       Mean, p50, p90, p99 and max in milliseconds.
+
+    """
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def pick(fraction):
+        index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+        return round(values[index] * 1000, 3)
+
+    return {'mean': round(sum(values) / len(values) * 1000, 3),
+            'p50': pick(0.5),
+            'p90': pick(0.9),
+            'p99': pick(0.99),
+            'max': pick(1.0)}
+
+
+def command_body(command: str, rand: random.Random):
+    """
+    Create a random API request body for a command.
+
+    :param command: API command name.
+    :param rand:    Random generator.
+    :rtype:         dict
+    :return:        Request body.
+
+    """
+    if command == 'speed':
+        return {'speed': rand.randint(-100, 100)}
+    elif command == 'steering':
+        return {'position': rand.randint(-90, 90)}
+    elif command == 'gearbox':
+        return rand.choice([{'change_up': True}, {'change_down': True}])
+    elif command == 'indicators':
+        return {'brightness': 100, 'duration': 1,
+                'left': rand.choice([True, False])}
+    return {'brightness': rand.randint(0, 100)}
+
+
+class Benchmark:
+    """End-to-end benchmark of the command path."""
+
+    def __init__(self,
+                 requests: int = 200,
+                 concurrency: int = 4,
+                 commands: list = None,
+                 time_scale: float = 1000.0,
+                 write_latency: float = None,
+                 write_jitter: float = None,
+                 seed: int = 1,
+                 timeout: float = 60.0,
+                 replay: str = None,
+                 replay_speed: float = 0.0,
+                 input_filter: bool = False):
+        """
+        Constructor function.
+
+        :param requests:      Number of HTTP requests to send.
+        :param concurrency:   Number of concurrent HTTP clients.
+        :param commands:      API commands to send, picked at random.
+        :param time_scale:    Simulated hub time scale.
+        :param write_latency: Simulated BLE write latency in seconds.
+        :param write_jitter:  Simulated BLE write jitter in seconds.
+        :param seed:          Random seed.
+        :param timeout:       Max seconds to wait for the car to finish.
+        :param replay:        Recording to replay instead of sending HTTP
+                              requests.
+        :param replay_speed:  Replay speed factor, 0 is max speed.
+        :param input_filter:  If the web tier input filter should be used.
+
+        """
+        self.requests = requests
+        self.concurrency = concurrency
+        self.commands = commands or ['speed', 'steering']
+        self.time_scale = time_scale
+        self.write_latency = write_latency
+        self.write_jitter = write_jitter
+        self.seed = seed
+        self.timeout = timeout
+        self.replay = replay
+        self.replay_speed = replay_speed
+        self.input_filter = input_filter
+        self._broker = InMemoryBroker()
+        self._lock = threading.Lock()
+        self._http = []
+        self._queue = []
+        self._handler = []
+        self._total = []
+        self._errors = 0
+        self._web_cpu = 0.0
+        self._car_cpu = 0.0
+        self._car_done = threading.Event()
+        self._car_ready = threading.Event()
+        self._car = None
+
+    @staticmethod
+    def _import_car_module():
+        """
+        Import the car control using the simulated hub.
+
+        :rtype:  module
+        :return: The carcontrol module.
+
+        """
+        os.environ['LEGCOCAR_SIMULATED_HUB'] = '1'
+        return importlib.import_module('carcontrol')
+
+    def _send_request(self, path: str, body: dict):
+        """
+        Send one HTTP request through the WSGI interface.
+
+        :param path: Request path.
+        :param body: Request JSON body.
+
+        """
+        environ = EnvironBuilder(path=path, method='POST',
+                                 json=body).get_environ()
+        status = []
+
+        def start_response(status_line, headers, exc_info=None):
+            status.append(int(status_line.split()[0]))
+
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        result = flaskserver.web_server(environ, start_response)
+        b''.join(result)
+        if hasattr(result, 'close'):
+            result.close()
+        cpu = time.thread_time() - cpu_start
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._http.append(elapsed)
+            self._web_cpu += cpu
+            if status[0] != 200:
+                self._errors += 1
+
+    def _car_thread(self, carcontrol):
+        """
+        Run the car against the simulated hub until all messages are handled.
+
+        :param carcontrol: The carcontrol module.
+
+        """
+        benchmark = self
+        broker = self._broker
+
+        class BenchCar(carcontrol.Car):
+
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                # Thread switches of the benchmark are long in simulated
+                # time, the link is given a second of real time
+                self._link_timeout = benchmark.time_scale
+
+            def _get_message(self):
+                # Every command carries its own delivery, since commands
+                # are coalesced before they are dispatched
+                body = super()._get_message()
+                if body is not None:
+                    body['_delivery'] = broker.last_delivery
+                return body
+
+            async def dispatch(self, body: dict):
+                delivery = body.pop('_delivery', None)
+                start = time.perf_counter()
+                handled = await super().dispatch(body=body)
+                end = time.perf_counter()
+                if delivery is None:
+                    return handled
+                with benchmark._lock:
+                    benchmark._queue.append(
+                        delivery['delivered'] - delivery['published'])
+                    benchmark._handler.append(end - start)
+                    benchmark._total.append(end - delivery['published'])
+                return handled
+
+        car_class = carcontrol.attach_hardware(BenchCar)
+
+        async def car_main():
+            simhub.SimHub.hubs = []
+            self._car = car_class(name='bench', ble_id='00:00:00:00:00:00')
+            tasks = await self._car.connect()
+            tasks.append(await curio.spawn(self._car.run, daemon=True))
+            self._car_ready.set()
+            while not self._car_done.is_set():
+                await curio.sleep(0.01)
+            for task in tasks:
+                await task.cancel()
+
+        cpu_start = time.thread_time()
+        curio.run(car_main)
+        self._car_cpu = time.thread_time() - cpu_start
+
+    def run(self):
+        """
+        Run the benchmark.
+
+        :rtype:  dict
+        :return: Benchmark results.
+
+        """
+        simhub.configure(time_scale=self.time_scale,
+                         write_latency=self.write_latency,
+                         write_jitter=self.write_jitter,
+                         seed=self.seed)
+        carcontrol = self._import_car_module()
+        carcontrol.channel = self._broker.connection().channel()
+        routing.declare_queues(carcontrol.channel, 'to_lego')
+        flaskserver.RequestHandler.broker_connection_factory = (
+            self._broker.connection)
+        input_filter = None
+        if self.input_filter:
+            input_filter = flaskserver.InputFilter()
+        flaskserver.RequestHandler.input_filter = input_filter
+        rand = random.Random(self.seed)
+        jobs = []
+        for _ in range(self.requests):
+            command = rand.choice(self.commands)
+            jobs.append(('/api/' + command, command_body(command, rand)))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            car = threading.Thread(target=self._car_thread,
+                                   args=(carcontrol,))
+            car.start()
+            self._car_ready.wait()
+
+            # Send all requests
+            start = time.perf_counter()
+            if self.replay is not None:
+                replayer = CommandReplayer(
+                    channel=self._broker.connection().channel(),
+                    speed=self.replay_speed)
+                self.requests = len(replayer.replay(
+                    read_recording(self.replay)))
+            else:
+                with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                    list(pool.map(lambda job: self._send_request(*job), jobs))
+            web_time = time.perf_counter() - start
+            # Let the input filter publish the updates it dropped by rate
+            if input_filter is not None:
+                time.sleep(max(1 / settings['max_rate'] for settings
+                               in input_filter.filters.values()))
+
+            # Wait for the car to handle all messages, coalesced, duplicate
+            # and expired messages are never dispatched
+            deadline = time.monotonic() + self.timeout
+            while (len(self._total) +
+                   self._car.metrics['coalesced_commands'] +
+                   self._car.metrics['duplicate_commands'] +
+                   self._broker.dropped <
+                   self._broker.published and
+                   time.monotonic() < deadline):
+                time.sleep(0.01)
+            car_time = time.perf_counter() - start
+            self._car_done.set()
+            car.join()
+
+        handled = len(self._total)
+        return {
+            'config': {'requests': self.requests,
+                       'concurrency': self.concurrency,
+                       'commands': self.commands,
+                       'time_scale': self.time_scale,
+                       'write_latency': simhub.SimHub.write_latency,
+                       'write_jitter': simhub.SimHub.write_jitter,
+                       'seed': self.seed,
+                       'replay': self.replay,
+                       'replay_speed': self.replay_speed,
+                       'input_filter': self.input_filter},
+            'errors': self._errors,
+            'handled': handled,
+            'requests_per_second': round(self.requests / web_time, 1),
+            'commands_per_second': round(handled / car_time, 1),
+            'latency_ms': {'http': percentiles(self._http),
+                           'queue': percentiles(self._queue),
+                           'handler': percentiles(self._handler),
+                           'total': percentiles(self._total)},
+            'cpu_ms_per_command': {
+                'web': round(self._web_cpu / max(self.requests, 1) * 1000, 3),
+                'car': round(self._car_cpu / max(handled, 1) * 1000, 3)},
+            'ble_writes_per_command': round(
+                self._car.ble_writes / max(handled, 1), 3),
+            'skipped_commands': self._car.metrics['skipped_commands'],
+            'skipped_writes': self._car.metrics['skipped_writes'],
+            'coalesced_commands': self._car.metrics['coalesced_commands'],
+            'duplicate_commands': self._car.metrics['duplicate_commands'],
+            'dropped_messages': self._broker.dropped,
+            'link': self._car.link.stats(),
+            'notifications': self._car.notification_rates(),
+            'input_filter': (input_filter.stats if input_filter is not None
+                             else None)}
+
+
+class Main:
+    """Contains the script"""
+
+    @staticmethod
+    def _parse_command_line_options():
+        """
+        Parse options from the command line.
+
+        :rtype: Namespace
+
+        """
+        description = 'Benchmark the legcocar command path.'
+        parser = argparse.ArgumentParser(description=description)
+        parser.add_argument('--requests', '-n', type=int, default=200,
+                            help='Number of HTTP requests.')
+        parser.add_argument('--concurrency', '-c', type=int, default=4,
+                            help='Number of concurrent HTTP clients.')
+        parser.add_argument('--commands', type=str, default='speed,steering',
+                            help='Comma separated API commands to send.')
+        parser.add_argument('--time-scale', type=float, default=1000.0,
+                            help='Simulated hub time scale.')
+        parser.add_argument('--write-latency', type=float, default=None,
+                            help='Simulated BLE write latency in seconds.')
+        parser.add_argument('--write-jitter', type=float, default=None,
+                            help='Simulated BLE write jitter in seconds.')
+        parser.add_argument('--seed', type=int, default=1,
+                            help='Random seed.')
+        parser.add_argument('--replay', type=str, default=None,
+                            help='Replay this recording instead of sending '
+                                 'HTTP requests.')
+        parser.add_argument('--replay-speed', type=float, default=0.0,
+                            help='Replay speed factor, 0 is max speed.')
+        parser.add_argument('--input-filter', action='store_true',
+                            help='Filter speed and steering input in the '
+                                 'web tier.')
+        parser.add_argument('--output', '-o', type=str, default=None,
+                            help='Save results as JSON to this file.')
+        args = parser.parse_args()
+        return args
+
+    def run(self):
+        """
+        Run the script.
+
+        """
+        args = self._parse_command_line_options()
+        benchmark = Benchmark(requests=args.requests,
+                              concurrency=args.concurrency,
+                              commands=args.commands.split(','),
+                              time_scale=args.time_scale,
+                              write_latency=args.write_latency,
+                              write_jitter=args.write_jitter,
+                              seed=args.seed,
+                              replay=args.replay,
+                              replay_speed=args.replay_speed,
+                              input_filter=args.input_filter)
+        results = benchmark.run()
+        print(json.dumps(results, indent=4))
+        if args.output is not None:
+            with open(args.output, 'w') as file_obj:
+                json.dump(results, file_obj, indent=4)
+
+
+if __name__ == '__main__':
+    main = Main()
+    main.run()
@@ -16,94 +16,192 @@ import argparse
 import logging
 import codecs
 import json
+import os
+import re
+import time
 import traceback
 
-# Third party modules
-import pika
+# Third party modules, pika is imported when connecting to the broker
 import curio
-import txdbus
-from curio import sleep
-from bricknil import attach, start
-from bricknil.hub import CPlusHub
-from bricknil.sensor.motor import CPlusXLMotor, CPlusLargeMotor
-from bricknil.sensor import Light
+
+# Use a simulated hub instead of bricknil and Bluetooth if requested
+if os.environ.get('LEGCOCAR_SIMULATED_HUB'):
+    from simhub import attach, start, sleep, monotonic
+    from simhub import CPlusHub, CPlusXLMotor, CPlusLargeMotor, Light
+else:
+    from time import monotonic
+    from curio import sleep
+    from bricknil import attach, start
+    from bricknil.hub import CPlusHub
+    from bricknil.sensor.motor import CPlusXLMotor, CPlusLargeMotor
+    from bricknil.sensor import Light
 
 # Local modules
 from settings import Settings
-from commonlib import create_logger
+from commonlib import create_logger, read_json_file, write_json_file
+from controllers import GearHold, SteeringController
+from lighteffects import LightEffects, Steady, effect_from_body
+from linkmonitor import LinkMonitor, Pacer
+from idempotency import IdempotencyCache
+from routing import class_queues, declare_queues, WeightedQueues
+from macros import compile_macros
+from recorder import CommandRecorder
+from journal import Journal, COMMAND, HANDLER_START, HANDLER_END, SENSOR
+from journal import SHIFT, PROFILE_STEP, SKIP
 
 # Status on connection to LEGO via Bluetooth
 connected_to_Lego = False
 
+# Records incoming messages if set
+recorder = None
+
+# Flight recorder journal, kept in memory until the journal file is opened
+flight_recorder = Journal()
+
+# Compiled macros
+macros = {}
+
+# Hubs used if no hubs are configured
+DEFAULT_HUBS = [{'name': 'hub2', 'ble_id': '90:84:2B:4E:35:B4'}]
+
+# Peripherals attached if no hardware is configured
+DEFAULT_HARDWARE = {
+    'drive_motor1': {'type': 'CPlusXLMotor', 'port': 0,
+                     'capabilities': [['sense_speed', 5]]},
+    'drive_motor2': {'type': 'CPlusXLMotor', 'port': 1,
+                     'capabilities': [['sense_speed', 5]]},
+    'steering_motor': {'type': 'CPlusLargeMotor', 'port': 2,
+                       'capabilities': ['sense_pos']},
+    'gear_change_motor': {'type': 'CPlusLargeMotor', 'port': 3,
+                          'capabilities': ['sense_pos']}}
+
+# Peripheral types that can be attached
+PERIPHERAL_TYPES = {'CPlusXLMotor': CPlusXLMotor,
+                    'CPlusLargeMotor': CPlusLargeMotor,
+                    'Light': Light}
+
+# Peripheral names the car control uses
+PERIPHERAL_NAMES = ('drive_motor1', 'drive_motor2', 'drive_motor3',
+                    'drive_motor4', 'steering_motor', 'gear_change_motor',
+                    'left_indicators', 'right_indicators', 'reverse_lights',
+                    'brake_lights', 'tail_lights', 'high_beams', 'headlights')
+
+# Commands that set an absolute target, an earlier command is replaced by a
+# later one with the same arguments when queued commands are coalesced
+COALESCED_COMMANDS = ('speed', 'steering', 'headlights', 'high_beams',
+                      'tail_lights', 'brake_lights', 'reverse_lights',
+                      'indicators')
+
+# Hub run by this worker process, all hubs are run if not set
+worker_hub = None
+
+# Pipe to the supervisor, health is not reported if not set
+health_pipe = None
+
+# Cars created by the running system
+cars = []
+
+# Hub name => commanded state to resume after a reconnect
+resume_state = {}
+
+# Monotonic time when the hub connection was lost, None before the first
+# connect
+disconnect_time = None
+
+# Queue => (monotonic time, body) of messages received while disconnected
+outage_buffer = {}
+
+# Messages received while disconnected are dropped when they are older than
+# this when the hub is connected again (seconds)
+command_expiry = 2.0
+
+# Hub name => idempotency keys of executed commands, kept over reconnects
+executed_keys = {}
+
+# Number of idempotency keys remembered per hub and for how many seconds
+idempotency_cache_size = 1024
+idempotency_ttl = 60.0
+
+
+class HubConnectionError(Exception):
+    """The connection to a hub was lost."""
+
+    def __init__(self, hub: str):
+        super().__init__(
+            "Connection to hub '{hub}' was lost".format(hub=hub))
+
 
-# Uncomment and change port to attach drive motor 1
-@attach(CPlusXLMotor,
-        name='drive_motor1',
-        port=0,
-        capabilities=[('sense_speed', 5)])
-# Uncomment and change port to attach drive motor 2
-@attach(CPlusXLMotor,
-        name='drive_motor2',
-        port=1,
-        capabilities=[('sense_speed', 5)])
-# Uncomment and change port to attach drive motor 3
-# @attach(CPlusXLMotor,
-#         name='drive_motor3',
-#         port=0,
-#         capabilities=[('sense_speed', 5), 'sense_pos'])
-# Uncomment and change port to attach drive motor 4
-# @attach(CPlusXLMotor,
-#         name='drive_motor4',
-#         port=0,
-#         capabilities=[('sense_speed', 5), 'sense_pos'])
-# Uncomment and change port to attach steering motor
-@attach(CPlusLargeMotor,
-        name='steering_motor',
-        port=2,
-        capabilities=['sense_pos'])
-# Uncomment and change port to attach gear change motor
-@attach(CPlusLargeMotor,
-        name='gear_change_motor',
-        port=3,
-        capabilities=['sense_pos'])
-# Uncomment and change port to attach left indicators
-# @attach(Light,
-#         name='left_indicators',
-#         port=3)
-# Uncomment and change port to attach right indicators
-# @attach(Light,
-#         name='right_indicators',
-#         port=0)
-# Uncomment and change port to reverse lights
-# @attach(Light,
-#         name='reverse_lights',
-#         port=0)
-# Uncomment and change port to brake lights
-# @attach(Light,
-#         name='brake_lights',
-#         port=0)
-# Uncomment and change port to tail lights
-# @attach(Light,
-#         name='tail_lights',
-#         port=0)
-# Uncomment and change port to high beams
-# @attach(Light,
-#         name='high_beams',
-#         port=0)
-# Uncomment and change port to attach headlights
-# @attach(Light,
-#         name='headlights',
-#         port=0)
 class Car(CPlusHub):
 
+    _PERSISTED_STATE = (
+        '_current_gear', '_gear_offset', '_gear_adjust', '_gear_number',
+        '_gear_change_speed', '_gear_change_max_power', '_steering_pos',
+        '_steering_speed', '_steering_max_power', '_headlight_status',
+        '_tail_light_status', '_high_beam_status', '_brake_light_status',
+        '_reverse_light_status', '_left_indicator_status',
+        '_right_indicator_status')
+    """(*tuple*) Attributes that are saved to the state file."""
+
+    _LIGHT_STATUS = {'headlights': '_headlight_status',
+                     'high_beams': '_high_beam_status',
+                     'tail_lights': '_tail_light_status',
+                     'brake_lights': '_brake_light_status',
+                     'reverse_lights': '_reverse_light_status',
+                     'left_indicators': '_left_indicator_status',
+                     'right_indicators': '_right_indicator_status'}
+    """(*dict*) Light name => attribute that is True when the light is on."""
+
     def __init__(self,
                  name: str,
                  query_port_info: bool = False,
-                 ble_id: str = None):
+                 ble_id: str = None,
+                 drive_directions: tuple = (1, -1, 1, -1),
+                 calibration_file: str = None,
+                 state_file: str = None,
+                 macros: dict = None,
+                 queues: tuple = ('to_lego',),
+                 port_map_file: str = None):
+        """
+        Constructor function.
+
+        :param name:             Hub name.
+        :param query_port_info:  If hub port info should be queried.
+        :param ble_id:           Hub Bluetooth address.
+        :param drive_directions: Rotation direction (1 or -1) of drive motor
+                                 1-4 when the car is going forward.
+        :param calibration_file: Full path and name of steering calibration
+                                 cache file. Steering is not calibrated if
+                                 not set.
+        :param state_file:       Full path and name of controller state file.
+                                 State is not persisted if not set.
+        :param macros:           Compiled macros, see
+                                 :func:`macros.compile_macros`.
+        :param queues:           RabbitMQ queues of the car, commands are
+                                 consumed from their class queues.
+        :param port_map_file:    Full path and name of port map cache file.
+                                 Port info is always queried if not set.
+
+        """
         super().__init__(name, query_port_info, ble_id)
 
+        # Drive motor directions, motors are looked up when first used since
+        # they are attached after the hub has been created
+        self._drive_directions = drive_directions
+        self._drive_motors = None
+
+        # Number of messages received
+        self._message_number = 0
+        self.queues = queues
+        """(*tuple*) RabbitMQ queues of the car."""
+        self._class_queues = WeightedQueues(class_queues(queues))
+        self.class_queues = [name for name, weight in
+                             self._class_queues.queues]
+        """(*list*) Command class queues consumed by the car."""
+
         # Speed
         self._speed = 0
+        self._drive_speed = 0
+        self._speed_tolerance = 3
 
         # Steering
         self._steering_pos = 0
@@ -112,6 +210,11 @@ class Car(CPlusHub):
         self._steering_max_power = 20
         self._steering_max_left = None
         self._steering_max_right = None
+        self._steering_margin = 3
+        self._calibration_file = calibration_file
+        self._steering_rate = 20
+        self._steering_tolerance = 2
+        self._steering_controller = SteeringController()
 
         # Gearbox
         self._gear_adjust = 0
@@ -121,6 +224,40 @@ class Car(CPlusHub):
         self._current_gear = 1
         self._gear_change_speed = 100
         self._gear_change_max_power = 100
+        self._gear_hold = GearHold()
+        self._gear_hold.set_gears(offset=self._gear_offset,
+                                  adjust=self._gear_adjust,
+                                  gear_number=self._gear_number)
+        self._shifting = False
+        self._shift_ramp_time = 200
+        self._shift_tolerance = 2
+        self._shift_timeout = 1.0
+
+        # Metrics
+        self.metrics = {'shifts': 0,
+                        'shift_time': 0.0,
+                        'shift_time_max': 0.0,
+                        'gear_corrections': 0,
+                        'steering_stalls': 0,
+                        'profile_step_errors': [],
+                        'skipped_commands': {},
+                        'skipped_writes': 0,
+                        'reconnects': 0,
+                        'reconnect_time': 0.0,
+                        'expired_commands': 0,
+                        'coalesced_commands': 0,
+                        'duplicate_commands': 0}
+
+        # Idempotency keys of executed commands
+        if name not in executed_keys:
+            executed_keys[name] = IdempotencyCache(size=idempotency_cache_size,
+                                                   ttl=idempotency_ttl)
+        self._executed_keys = executed_keys[name]
+        self.metrics['duplicate_commands'] = self._executed_keys.duplicates
+
+        # BLE link, commands are paced to the measured write latency
+        self.link = LinkMonitor()
+        self._pacer = Pacer(self.link)
 
         # Lights
         self._headlight_status = False
@@ -131,6 +268,193 @@ class Car(CPlusHub):
         self._left_indicator_status = False
         self._right_indicator_status = False
 
+        self._light_effects = LightEffects(hub=self, write=self._write,
+                                           on_finish=self._light_finished)
+        self._light_bodies = {}
+
+        # Motion profile
+        self._profile_task = None
+
+        # Macros
+        self._macros = macros or {}
+        self._macro_task = None
+
+        # Reconnect, drive speed is only resumed after short outages
+        self._port_map_file = port_map_file
+        self._saved_port_map = None
+        self._attached_io = {}
+        self._resume_speed_time = 1.0
+        self._tasks = []
+
+        # The hub connection is lost when the sensors are silent this many
+        # seconds, even after a value has been requested
+        self._link_timeout = 2.0
+
+        # Sensor notifications per peripheral
+        self._notifications = {}
+        self._run_time = monotonic()
+        self._running = False
+
+        # Persisted state
+        self._state_file = state_file
+        self._saved_state = None
+        self._state_verified = False
+        self._restore_state()
+
+    def _restore_state(self):
+        """
+        Restore controller state from the state file.
+
+        """
+        if self._state_file is None:
+            return
+        state = read_json_file(self._state_file, default={})
+        self._apply_state(state)
+        self._light_bodies = dict(state.get('lights', {}))
+        self._saved_state = state
+
+    def _restore_lights(self):
+        """
+        Turn on the lights that were on when the state was saved, with their
+        last command if it was saved.
+
+        """
+        for light, attribute in self._LIGHT_STATUS.items():
+            if not getattr(self, attribute):
+                continue
+            effect = 'blink' if light.endswith('_indicators') else 'steady'
+            body, effect = self._light_bodies.get(light, ({}, effect))
+            setattr(self, attribute,
+                    self._set_light_effect(light, body, effect))
+
+    def _apply_state(self, state: dict):
+        """
+        Set controller state.
+
+        :param state: Persisted attribute => value.
+
+        """
+        for attribute in self._PERSISTED_STATE:
+            if attribute in state:
+                setattr(self, attribute, state[attribute])
+        self._gear_hold.set_gears(offset=self._gear_offset,
+                                  adjust=self._gear_adjust,
+                                  gear_number=self._gear_number)
+
+    def _save_state(self):
+        """
+        Save controller state to the state file if it has changed.
+
+        """
+        if self._state_file is None:
+            return
+        state = {attribute: getattr(self, attribute)
+                 for attribute in self._PERSISTED_STATE}
+        state['lights'] = dict(self._light_bodies)
+        if state != self._saved_state:
+            write_json_file(self._state_file, state)
+            self._saved_state = state
+
+    def _port_map(self):
+        """
+        Get the port map the hub reported.
+
+        :rtype:  dict
+        :return: Hub address and port => device name the hub reported
+                 attached.
+
+        """
+        ports = {str(port): device_name
+                 for port, device_name in sorted(self._attached_io.items())}
+        return {'ble_id': self.ble_id, 'ports': ports}
+
+    def use_cached_port_map(self):
+        """
+        Skip the port info queries when connecting if the port map is cached
+        and the hub reported the configured peripherals on their ports.
+
+        """
+        if self._port_map_file is None:
+            return
+        self._saved_port_map = read_json_file(self._port_map_file)
+        if self._saved_port_map is None:
+            return
+        ports = self._saved_port_map.get('ports', {})
+        if (self._saved_port_map.get('ble_id') == self.ble_id and
+                all(ports.get(str(peripheral.port)) == peripheral.sensor_name
+                    for peripheral in self.peripherals.values())):
+            self.query_port_info = False
+
+    async def connect_peripheral_to_port(self, device_name: str, port: int):
+        """
+        Connect a peripheral the hub reported attached. The port map is
+        cached when all configured ports have been reported, or right away
+        when a port differs from the cache.
+
+        :param device_name: Device name the hub reported.
+        :param port:        Hub port number.
+        :return:            Peripheral, None if no peripheral is configured
+                            for the device.
+
+        """
+        self._attached_io[port] = device_name
+        if self._port_map_file is not None:
+            saved = (self._saved_port_map or {}).get('ports', {})
+            port_map = self._port_map()
+            if (port_map != self._saved_port_map and
+                    (saved.get(str(port)) != device_name or
+                     all(peripheral.port in self._attached_io
+                         for peripheral in self.peripherals.values()))):
+                write_json_file(self._port_map_file, port_map)
+                self._saved_port_map = port_map
+        return await super().connect_peripheral_to_port(device_name, port)
+
+    def get_resume_state(self):
+        """
+        Get the commanded state to resume after a reconnect.
+
+        :rtype:  dict
+        :return: Controller state, drive speed and light commands.
+
+        """
+        return {'state': {attribute: getattr(self, attribute)
+                          for attribute in self._PERSISTED_STATE},
+                'speed': self._drive_speed,
+                'lights': dict(self._light_bodies),
+                'reconnects': self.metrics['reconnects']}
+
+    async def _resume(self, state: dict, outage: float):
+        """
+        Resume the commanded state from before a reconnect.
+
+        :param state:  State from :meth:`get_resume_state`.
+        :param outage: Seconds the hub was disconnected.
+
+        """
+        self._apply_state(state['state'])
+        for light, (body, effect) in state['lights'].items():
+            self._set_light_effect(light, body, effect)
+        if state['speed'] != 0 and outage <= self._resume_speed_time:
+            await self._set_speed(speed=state['speed'])
+
+    def _verify_gear(self):
+        """
+        Check the restored gear against the first sensed gear change motor
+        position. If the motor is closer to another gear, that gear is used.
+
+        """
+        self._state_verified = True
+        nearest_gear = min(
+            range(1, self._gear_number + 1),
+            key=lambda gear: abs(self._gear_position(gear) -
+                                 self._gear_change_motor_pos))
+        if nearest_gear != self._current_gear:
+            self.message_info(
+                'Gear change motor is at gear {nearest}, not restored gear '
+                '{gear}'.format(nearest=nearest_gear, gear=self._current_gear))
+            self._current_gear = nearest_gear
+            self._save_state()
+
     async def set_speed(self, body: dict):
         """
         Set car speed.
@@ -141,7 +465,23 @@ class Car(CPlusHub):
         # Set requested speed in motor(s)
         speed = body['speed']
         await self._set_speed(speed=speed)
-        await sleep(2)
+
+    def _get_drive_motors(self):
+        """
+        Get attached drive motors.
+
+        :rtype:  list
+        :return: (motor, direction) tuples.
+
+        """
+        if self._drive_motors is None:
+            self._drive_motors = []
+            for number, direction in enumerate(self._drive_directions,
+                                               start=1):
+                motor = getattr(self, 'drive_motor{}'.format(number), None)
+                if motor is not None:
+                    self._drive_motors.append((motor, direction))
+        return self._drive_motors
 
     async def _set_speed(self, speed: int):
         """
@@ -150,10 +490,34 @@ class Car(CPlusHub):
         :param speed: Target speed from -100 to 100.
 
         """
-        # Set requested speed in motor(s)
-        await self.drive_motor1.set_speed(speed)
-        await self.drive_motor2.set_speed(-speed)
-        await sleep(2)
+        # Set requested speed in all drive motors concurrently. The writes
+        # still go to the hub one at a time through the Bluetooth write
+        # queue, so the motors start up to one write time apart
+        self._drive_speed = speed
+        async with curio.TaskGroup() as group:
+            for motor, direction in self._get_drive_motors():
+                # Motors already commanded to the speed are not written,
+                # unless a ramp is moving them away from it
+                ramp = motor.ramp_in_progress_task
+                if (motor.speed == speed * direction and
+                        (ramp is None or ramp.terminated)):
+                    self.metrics['skipped_writes'] += 1
+                    continue
+                await group.spawn(self._write, motor.set_speed,
+                                  speed * direction)
+
+    async def _write(self, method, *args, **kwargs):
+        """
+        Write to a peripheral. The write is only queued to the BLE layer and
+        returns right away.
+
+        :param method: Peripheral coroutine method that writes to the hub.
+        :param args:   Method arguments.
+        :param kwargs: Method keyword arguments.
+
+        """
+        self.link.write_started(monotonic())
+        await method(*args, **kwargs)
 
     async def set_steering_position(self, body: dict):
         """
@@ -163,7 +527,8 @@ class Car(CPlusHub):
 
         """
         # Steering position
-        self._steering_pos = body['position']
+        if 'position' in body:
+            self._set_steering_target(body['position'])
 
         # Steering speed
         if 'speed' in body:
@@ -173,11 +538,119 @@ class Car(CPlusHub):
         if 'max_power' in body:
             self._steering_max_power = body['max_power']
 
-        # Set requested position in steering motor
-        await self.steering_motor.set_pos(pos=self._steering_pos,
-                                          speed=self._steering_speed,
-                                          max_power=self._steering_max_power)
-        await sleep(2)
+        # The steering control task moves the steering motor to the new
+        # position
+
+    def _clamp_steering(self, position: int):
+        """
+        Keep a steering position away from the end stops.
+
+        :param position: Steering motor position.
+        :rtype:          int
+        :return:         Clamped steering motor position.
+
+        """
+        if self._steering_max_left is not None:
+            position = max(
+                self._steering_max_left + self._steering_margin,
+                min(self._steering_max_right - self._steering_margin,
+                    position))
+        return position
+
+    def _set_steering_target(self, position: int):
+        """
+        Set the steering position target, kept away from the end stops.
+
+        :param position: Steering motor position.
+
+        """
+        self._steering_pos = self._clamp_steering(position)
+
+    async def run_profile(self, body: dict):
+        """
+        Start a motion profile, replacing any running profile.
+
+        :param body: Target "profile" command body.
+
+        """
+        if self._profile_task is not None:
+            await self._profile_task.cancel()
+        self._profile_task = await curio.spawn(self._run_profile,
+                                               body['steps'], daemon=True)
+
+    async def _run_profile(self, steps: list):
+        """
+        Run the steps of a motion profile.
+
+        Each step is run at an absolute deadline from the profile start, so
+        that delays in one step don't move the following steps. The timing
+        error of each step is written to the journal and kept in the metrics.
+
+        :param steps: Profile steps with "time" in seconds from the start and
+                      any of "speed", "steering" and "gear".
+
+        """
+        errors = []
+        start_time = monotonic()
+        for step in steps:
+            deadline = start_time + step['time']
+            delay = deadline - monotonic()
+            if delay > 0:
+                await sleep(delay)
+            error = monotonic() - deadline
+            errors.append(error)
+            flight_recorder.write(PROFILE_STEP, 'profile', error * 1000000)
+            if 'steering' in step:
+                self._set_steering_target(step['steering'])
+            if 'speed' in step:
+                await self._set_speed(speed=step['speed'])
+            if 'gear' in step:
+                await self._shift(
+                    gear=max(1, min(step['gear'], self._gear_number)))
+            self._save_state()
+        self.metrics['profile_step_errors'] = [
+            round(error * 1000, 3) for error in errors]
+        self.message_info(
+            'Profile done, {steps} steps, max timing error {ms:.1f} ms'.format(
+                steps=len(errors), ms=max(errors, default=0) * 1000))
+        self._profile_task = None
+
+    async def run_macro(self, body: dict):
+        """
+        Start a macro, replacing any running macro.
+
+        :param body: Target "macro" command body.
+
+        """
+        steps = self._macros.get(body['name'])
+        if steps is None:
+            self.message_info('Unknown macro {name}'.format(name=body['name']))
+            return
+        if self._macro_task is not None:
+            await self._macro_task.cancel()
+        self._macro_task = await curio.spawn(self._run_macro, body['name'],
+                                             steps, daemon=True)
+
+    async def _run_macro(self, name: str, steps: tuple):
+        """
+        Run the steps of a macro.
+
+        Each step is run at an absolute deadline from the macro start, in the
+        same way as motion profile steps.
+
+        :param name:  Macro name.
+        :param steps: Compiled macro steps.
+
+        """
+        start_time = monotonic()
+        for step_time, body in steps:
+            delay = start_time + step_time - monotonic()
+            if delay > 0:
+                await sleep(delay)
+            await self.dispatch(body=body)
+        self.message_info('Macro {name} done, {steps} steps'.format(
+            name=name, steps=len(steps)))
+        self._macro_task = None
 
     async def change_gear(self, body: dict):
         """
@@ -206,133 +679,185 @@ class Car(CPlusHub):
         if 'max_power' in body:
             self._gear_change_max_power = body['max_power']
 
-        gear_position = int(self._gear_offset * (self._current_gear - 1))
-        gear_position += self._gear_adjust
+        # Update gear position table
+        self._gear_hold.set_gears(offset=self._gear_offset,
+                                  adjust=self._gear_adjust,
+                                  gear_number=self._gear_number)
+
+        await self._shift(gear=self._requested_gear(body))
+
+    def _requested_gear(self, body: dict):
+        """
+        Get the gear requested by a gearbox command.
+
+        :param body: Target "gearbox" command body.
+        :rtype:      int
+        :return:     Gear number, starting at 1.
+
+        """
         # Handle change up one gear
+        gear = self._current_gear
         if ('change_up' in body and body['change_up'] and
-                self._current_gear < self._gear_number):
-            self._current_gear += 1
-            gear_position = int(self._gear_offset * (self._current_gear - 1))
-            gear_position += self._gear_adjust
+                gear < self._gear_number):
+            gear += 1
 
         # Handle change down one gear
-        elif ('change_down' in body and body['change_down'] and
-                self._current_gear > 1):
-            self._current_gear -= 1
-            gear_position = int(self._gear_offset * (self._current_gear - 1))
-            gear_position += self._gear_adjust
-
-        # Handle set gear down
-        elif 'gear' in body and body['gear'] < self._current_gear:
-            self._current_gear = body['gear']
-            gear_position = int(self._gear_offset * body['gear'])
-            gear_position += self._gear_adjust
-
-        # Handle set gear up
-        elif 'gear' in body and body['gear'] > self._current_gear:
-            self._current_gear = body['gear']
-            gear_position = int(self._gear_offset * body['gear'])
-            gear_position += self._gear_adjust
-
-        # Set speed to 0
-        drive_speed = self._speed
-        await self._set_speed(speed=0)
-        await sleep(2)
-
-        # Set requested position in gear change motor
-        await self.gear_change_motor.set_pos(
-            pos=gear_position,
-            speed=self._gear_change_speed,
-            max_power=self._gear_change_max_power)
-        await sleep(4)
-
-        # Restore speed
-        await self._set_speed(speed=drive_speed)
-        await sleep(10)
+        elif ('change_down' in body and body['change_down'] and gear > 1):
+            gear -= 1
 
-    async def set_headlight_brightness(self, body: dict):
+        # Handle set gear
+        elif 'gear' in body:
+            gear = max(1, min(body['gear'], self._gear_number))
+
+        return gear
+
+    def _gear_position(self, gear: int):
         """
-        Set headlamp brightness.
+        Get gear change motor position of a gear.
 
-        :param body: Target "headlights" command body.
+        :param gear: Gear number, starting at 1.
+        :rtype:      int
+        :return:     Gear change motor position in degrees.
 
         """
-        # Light brightness 0-100
-        brightness = body['brightness']
+        return self._gear_hold.position(gear)
 
-        # Light will be on for this long in seconds
-        duration = 0
-        if 'duration' in body:
-            duration = body['duration']
+    async def _ramp_drive_speed(self, speed: int, ramp_time_ms: int,
+                                wait: bool = True):
+        """
+        Ramp speed of all drive motors.
 
-        # Set status
-        if brightness == 0:
-            self._headlight_status = False
-        else:
-            self._headlight_status = True
+        :param speed:        Target speed from -100 to 100.
+        :param ramp_time_ms: Ramp time in milliseconds, must be above 100.
+        :param wait:         If the ramp should be waited for.
 
-        # Set requested brightness in light(s)
-        await self.headlights.set_brightness(brightness)
-        if duration > 0:
-            await sleep(duration)
-            await self.headlights.set_brightness(0)
-        await sleep(1)
+        """
+        async with curio.TaskGroup() as group:
+            for motor, direction in self._get_drive_motors():
+                await group.spawn(motor.ramp_speed, speed * direction,
+                                  ramp_time_ms)
+        if wait:
+            await sleep(ramp_time_ms / 1000)
+
+    async def _shift(self, gear: int):
+        """
+        Shift gear with a short torque cut.
+
+        Drive speed is ramped down, the gear change motor is moved until its
+        sensed position is within tolerance of the gear position and then
+        drive speed is ramped back up.
+
+        :param gear: Target gear number, starting at 1.
 
-    async def set_high_beam_brightness(self, body: dict):
         """
-        Set high beam brightness.
+        start_time = monotonic()
+        self._shifting = True
+        self._state_verified = True
+        self._current_gear = gear
+        gear_position = self._gear_position(gear)
+        try:
+            # Cut torque
+            if self._drive_speed != 0:
+                await self._ramp_drive_speed(
+                    speed=0, ramp_time_ms=self._shift_ramp_time)
+
+            # Set requested position in gear change motor and wait for it
+            await self._write(
+                self.gear_change_motor.set_pos,
+                pos=gear_position,
+                speed=self._gear_change_speed,
+                max_power=self._gear_change_max_power)
+            waited = 0.0
+            while (abs(self._gear_change_motor_pos - gear_position) >
+                   self._shift_tolerance and waited < self._shift_timeout):
+                await sleep(0.01)
+                waited += 0.01
+
+            # Restore speed, or ramp to the speed of a command handled
+            # during the shift
+            drive_speed = self._drive_speed
+            if drive_speed != 0:
+                await self._ramp_drive_speed(
+                    speed=drive_speed, ramp_time_ms=self._shift_ramp_time,
+                    wait=False)
+        finally:
+            self._shifting = False
+
+        # Report shift duration
+        shift_time = monotonic() - start_time
+        self.metrics['shifts'] += 1
+        self.metrics['shift_time'] = shift_time
+        self.metrics['shift_time_max'] = max(self.metrics['shift_time_max'],
+                                             shift_time)
+        flight_recorder.write(SHIFT, 'gearbox', shift_time * 1000)
+        self.message_info('Shifted to gear {gear} in {ms:.0f} ms'.format(
+            gear=gear, ms=shift_time * 1000))
+
+    def _set_light_effect(self, light: str, body: dict,
+                          effect: str = 'steady'):
+        """
+        Start the effect of a light command.
 
-        :param body: Target "high_beams" command body.
+        :param light:  Light name.
+        :param body:   Light command body.
+        :param effect: Effect used if the body has no "effect".
+        :rtype:        bool
+        :return:       True if the light is on.
 
         """
-        # Light brightness 0-100
-        brightness = body['brightness']
+        try:
+            light_effect = effect_from_body(body, effect)
+        except ValueError as e:
+            self.message_info('Invalid {light} command, {reason}'.format(
+                light=light, reason=e))
+            return getattr(self, self._LIGHT_STATUS[light])
+        self._light_bodies[light] = [body, effect]
+        # Fades and pulses run down to 0 by themselves
+        if body.get('brightness', 100) == 0 and isinstance(light_effect,
+                                                           Steady):
+            self._light_effects.cancel(light)
+            return False
+        self._light_effects.set_effect(light, light_effect)
+        return True
+
+    def _light_finished(self, light: str, brightness: int):
+        """
+        Clear the status of a light that went off when its effect ended.
 
-        # Light will be on for this long in seconds
-        duration = 0
-        if 'duration' in body:
-            duration = body['duration']
+        :param light:      Light name.
+        :param brightness: Last brightness of the light.
 
-        # Set status
-        if brightness == 0:
-            self._high_beam_status = False
-        else:
-            self._high_beam_status = True
+        """
+        if brightness == 0 and getattr(self, self._LIGHT_STATUS[light]):
+            setattr(self, self._LIGHT_STATUS[light], False)
+            self._save_state()
+
+    async def set_headlight_brightness(self, body: dict):
+        """
+        Set headlamp brightness.
 
-        # Set requested brightness in light(s)
-        await self.high_beams.set_brightness(brightness)
-        if duration > 0:
-            await sleep(duration)
-            await self.high_beams.set_brightness(0)
-        await sleep(1)
+        :param body: Target "headlights" command body.
 
-    async def set_tail_light_brightness(self, body: dict):
         """
-        Set tail light brightness.
+        self._headlight_status = self._set_light_effect('headlights', body)
 
-        :param body: Target "tail_lights" command body.
+    async def set_high_beam_brightness(self, body: dict):
+        """
+        Set high beam brightness.
+
+        :param body: Target "high_beams" command body.
 
         """
-        # Light brightness 0-100
-        brightness = body['brightness']
+        self._high_beam_status = self._set_light_effect('high_beams', body)
 
-        # Light will be on for this long in seconds
-        duration = 0
-        if 'duration' in body:
-            duration = body['duration']
+    async def set_tail_light_brightness(self, body: dict):
+        """
+        Set tail light brightness.
 
-        # Set status
-        if brightness == 0:
-            self._tail_light_status = False
-        else:
-            self._tail_light_status = True
+        :param body: Target "tail_lights" command body.
 
-        # Set requested brightness in light(s)
-        await self.tail_lights.set_brightness(brightness)
-        if duration > 0:
-            await sleep(duration)
-            await self.tail_lights.set_brightness(0)
-        await sleep(1)
+        """
+        self._tail_light_status = self._set_light_effect('tail_lights', body)
 
     async def set_brake_light_brightness(self, body: dict):
         """
@@ -341,26 +866,7 @@ class Car(CPlusHub):
         :param body: Target "brake_lights" command body.
 
         """
-        # Light brightness 0-100
-        brightness = body['brightness']
-
-        # Light will be on for this long in seconds
-        duration = 0
-        if 'duration' in body:
-            duration = body['duration']
-
-        # Set status
-        if brightness == 0:
-            self._brake_light_status = False
-        else:
-            self._brake_light_status = True
-
-        # Set requested brightness in light(s)
-        await self.brake_lights.set_brightness(brightness)
-        if duration > 0:
-            await sleep(duration)
-            await self.brake_lights.set_brightness(0)
-        await sleep(1)
+        self._brake_light_status = self._set_light_effect('brake_lights', body)
 
     async def set_reverse_light_brightness(self, body: dict):
         """
@@ -369,26 +875,8 @@ class Car(CPlusHub):
         :param body: Target "reverse_lights" command body.
 
         """
-        # Light brightness 0-100
-        brightness = body['brightness']
-
-        # Light will be on for this long in seconds
-        duration = 0
-        if 'duration' in body:
-            duration = body['duration']
-
-        # Set status
-        if brightness == 0:
-            self._reverse_light_status = False
-        else:
-            self._reverse_light_status = True
-
-        # Set requested brightness in light(s)
-        await self.reverse_lights.set_brightness(brightness)
-        if duration > 0:
-            await sleep(duration)
-            await self.reverse_lights.set_brightness(0)
-        await sleep(1)
+        self._reverse_light_status = self._set_light_effect('reverse_lights',
+                                                            body)
 
     async def set_indicator_lights(self, body: dict):
         """
@@ -397,109 +885,460 @@ class Car(CPlusHub):
         :param body: Target "indicator_lights" command body.
 
         """
-        # Light brightness 0-100
-        brightness = body['brightness']
-
-        # Indicators will be operating this long (seconds)
-        duration = 0
-        if 'duration' in body:
-            duration = body['duration']
-
-        # How long indicators will on each time (seconds)
-        length = 0.5
-        if 'length' in body:
-            length = body['length']
-
-        # Time between indicators lights on (seconds)
-        interval = 0.75
-        if 'interval' in body:
-            interval = body['interval']
-
-        # If left indicator should be operating
-        left = False
-        if 'left' in body:
-            left = body['left']
-
-        # If right indicator should be operating
-        right = False
-        if 'right' in body:
-            right = body['right']
-
-        # Set indicator status on
-        if left:
-            self._left_indicator_status = True
-        if right:
-            self._right_indicator_status = True
-
-        # Set requested indicator operation
-        current_duration = 0.0
-        while duration == 0 or current_duration <= duration:
-            # Turn on requested indicator lights
-            if left:
-                await self.left_indicators.set_brightness(brightness)
-            if right:
-                await self.right_indicators.led1.set_brightness(brightness)
-            # Wait while indicator lights are on
-            await sleep(length)
-            # Turn off requested indicator lights
-            if left:
-                await self.left_indicators.set_brightness(0)
-            if right:
-                await self.right_indicators.set_brightness(0)
-            # Wait while indicator lights are off
-            await sleep(interval - length)
-            # Go to next interval
-            current_duration += interval
-        await sleep(1)
-
-        # Set indicator status off
-        if left:
-            self._left_indicator_status = False
-        if right:
-            self._right_indicator_status = False
+        # Indicators blink unless another effect is requested
+        on = body.get('brightness', 100) != 0
+        for side in ('left', 'right'):
+            if side not in body:
+                continue
+            light = side + '_indicators'
+            if body[side] and on:
+                status = self._set_light_effect(light, body, effect='blink')
+            else:
+                status = self._set_light_effect(light, {'brightness': 0})
+            setattr(self, '_{side}_indicator_status'.format(side=side),
+                    status)
+
+    def _update_speed(self, motor):
+        """
+        Log sensed drive motor speed and set car speed to the average sensed
+        speed of all drive motors.
+
+        :param motor: Drive motor that sensed a new speed.
+
+        """
+        sense_speed = CPlusXLMotor.capability.sense_speed
+        self._count_notification(motor.name)
+        # Drive motors may sense only their position
+        speed = sensed_value(motor, sense_speed, 8)
+        if speed is not None:
+            flight_recorder.write(SENSOR, motor.name + '.speed', speed)
+        # Drive motors without a sensed speed are left out
+        speeds = []
+        for drive_motor, direction in self._get_drive_motors():
+            speed = sensed_value(drive_motor, sense_speed, 8)
+            if speed is not None:
+                speeds.append(speed * direction)
+        if speeds:
+            self._speed = int(sum(speeds) / len(speeds))
+
+    def _count_notification(self, name: str):
+        """
+        Count a sensor notification.
+
+        :param name: Peripheral name.
+
+        """
+        self._notifications[name] = self._notifications.get(name, 0) + 1
+        self.link.notification(monotonic(), name)
+
+    def notification_rates(self):
+        """
+        Get the sensor notification rate of every port.
+
+        :rtype:  dict
+        :return: Peripheral name => port, notification count and
+                 notifications per second since the car started running.
+
+        """
+        elapsed = max(monotonic() - self._run_time, 1e-6)
+        return {name: {'port': peripheral.port,
+                       'count': self._notifications.get(name, 0),
+                       'rate': round(self._notifications.get(name, 0) /
+                                     elapsed, 2)}
+                for name, peripheral in self.peripherals.items()}
 
     async def drive_motor1_change(self):
-        self._speed = self.drive_motor1.speed
-        self._speed = (self._speed + self.drive_motor2.speed) // 2
+        self._update_speed(self.drive_motor1)
 
     async def drive_motor2_change(self):
-        self._speed = self.drive_motor2.speed
-        self._speed = (self._speed + self.drive_motor1.speed) // 2
+        self._update_speed(self.drive_motor2)
+
+    async def drive_motor3_change(self):
+        self._update_speed(self.drive_motor3)
+
+    async def drive_motor4_change(self):
+        self._update_speed(self.drive_motor4)
 
     async def steering_motor_change(self):
         # Get steering motor position
-        self._steering_motor_pos = (
-            self.steering_motor.value[CPlusLargeMotor.capability.sense_pos])
-
-        # Correct steering motor position
-        # TODO delete this, may brake lego?
-        # precision = 2
-        # if not (-precision <= self._steering_motor_pos - self._steering_pos <=
-        #         precision):
-        #     # Set steering motor position
-        #     await self.steering_motor.set_pos(
-        #         pos=self._steering_pos,
-        #         speed=self._steering_speed,
-        #         max_power=self._steering_max_power)
-        #     await sleep(2)
+        self._count_notification('steering_motor')
+        position = sensed_value(self.steering_motor,
+                                CPlusLargeMotor.capability.sense_pos, 32)
+        if position is None:
+            return
+        self._steering_motor_pos = position
+        flight_recorder.write(SENSOR, 'steering_motor.pos',
+                              self._steering_motor_pos)
+
+    async def _find_steering_end_stop(self, speed: int):
+        """
+        Run the steering motor until it stalls against an end stop.
+
+        :param speed: Steering motor speed, the sign gives the direction.
+        :rtype:       int
+        :return:      End stop position.
+
+        """
+        stall_time = 0.5
+        timeout = 5.0
+        await self._write(self.steering_motor.set_speed, speed)
+        position = self._steering_motor_pos
+        still = 0.0
+        waited = 0.0
+        while still < stall_time and waited < timeout:
+            await sleep(0.05)
+            waited += 0.05
+            if abs(self._steering_motor_pos - position) >= 1:
+                position = self._steering_motor_pos
+                still = 0.0
+            else:
+                still += 0.05
+        await self._write(self.steering_motor.set_speed, 0)
+        return self._steering_motor_pos
+
+    async def _calibrate_steering(self):
+        """
+        Find the steering end stops.
+
+        The steering position is zeroed when the hub is powered on, so the
+        limits cached for this hub can not be trusted after a connect. If
+        limits are cached, only the left end stop is probed and the cached
+        range is moved to it. Otherwise the steering is swept to both end
+        stops at low power. The result is cached.
+
+        """
+        if self._calibration_file is None:
+            return
+        cache = read_json_file(self._calibration_file, default={})
+        limits = cache.get(self.ble_id)
+        if limits is not None:
+            self.message_info('Using cached steering range')
+            left = await self._find_steering_end_stop(-15)
+            limits = {'left': left,
+                      'right': left + limits['right'] - limits['left']}
+        else:
+            self.message_info('Calibrating steering')
+            limits = {'left': await self._find_steering_end_stop(-15),
+                      'right': await self._find_steering_end_stop(15)}
+        if cache.get(self.ble_id) != limits:
+            cache[self.ble_id] = limits
+            write_json_file(self._calibration_file, cache)
+        self._steering_max_left = limits['left']
+        self._steering_max_right = limits['right']
+        self._steering_pos = max(
+            limits['left'] + self._steering_margin,
+            min(limits['right'] - self._steering_margin, self._steering_pos))
+
+    async def _steering_control(self):
+        """
+        Steering control task.
+
+        Runs the steering controller at a fixed rate on the latest sensed
+        steering position. The steering motor is only written to when the
+        controller output changes.
+
+        """
+        period = 1 / self._steering_rate
+        output = 0
+        while True:
+            await sleep(period)
+            new_output = self._steering_controller.update(
+                target=self._steering_pos,
+                position=self._steering_motor_pos,
+                max_output=min(self._steering_speed,
+                               self._steering_max_power),
+                dt=period)
+            if new_output != output:
+                output = new_output
+                await self._write(self.steering_motor.set_speed, output)
+            self.metrics['steering_stalls'] = (
+                self._steering_controller.stalls)
 
     async def gear_change_motor_change(self):
         # Get gear change motor position
-        self._gear_change_motor_pos = (
-            self.gear_change_motor.value[CPlusLargeMotor.capability.sense_pos])
-
-        # Correct gear change motor position
-        precision = 2
-        gear_position = int(self._gear_offset * (self._current_gear - 1))
-        gear_position += self._gear_adjust
-        if not (-precision <= self._gear_change_motor_pos - gear_position
-                <= precision):
-            # Set gear change motor position
-            await self.gear_change_motor.set_pos(
+        self._count_notification('gear_change_motor')
+        position = sensed_value(self.gear_change_motor,
+                                CPlusLargeMotor.capability.sense_pos, 32)
+        if position is None:
+            return
+        self._gear_change_motor_pos = position
+        flight_recorder.write(SENSOR, 'gear_change_motor.pos',
+                              self._gear_change_motor_pos)
+
+        # Check restored gear against the first reading
+        if not self._state_verified and not self._shifting:
+            self._verify_gear()
+
+        # Don't correct the position while a shift is moving the motor
+        if self._shifting:
+            self._gear_hold.reset()
+            return
+
+        # Correct gear change motor position if it has drifted out of the
+        # hold band
+        gear_position = self._gear_hold.update(
+            gear=self._current_gear,
+            position=self._gear_change_motor_pos,
+            now=monotonic())
+        if gear_position is not None:
+            self.metrics['gear_corrections'] = self._gear_hold.corrections
+            await self._write(
+                self.gear_change_motor.set_pos,
                 pos=gear_position,
                 speed=self._gear_change_speed,
                 max_power=self._gear_change_max_power)
-            await sleep(2)
+
+    def _unchanged(self, body: dict, attributes: dict):
+        """
+        Check that command settings equal the current settings.
+
+        :param body:       Command body.
+        :param attributes: Command argument => attribute name.
+        :rtype:            bool
+        :return:           True if no setting would change.
+
+        """
+        return all(body[arg] == getattr(self, attribute)
+                   for arg, attribute in attributes.items() if arg in body)
+
+    def _is_noop(self, body: dict):
+        """
+        Check if a command would not change the car.
+
+        A setpoint is a no-op when it equals the last commanded value and the
+        sensed value is within tolerance of it.
+
+        :param body: Command body.
+        :rtype:      bool
+        :return:     True if the command can be skipped.
+
+        """
+        command = body['command']
+        if command == 'speed':
+            return (not self._shifting and
+                    body['speed'] == self._drive_speed and
+                    abs(self._speed - body['speed']) <= self._speed_tolerance)
+        elif command == 'steering':
+            if not self._unchanged(body, {'speed': '_steering_speed',
+                                          'max_power': '_steering_max_power'}):
+                return False
+            if 'position' not in body:
+                return True
+            position = self._clamp_steering(body['position'])
+            return (position == self._steering_pos and
+                    abs(self._steering_motor_pos - position) <=
+                    self._steering_tolerance)
+        elif command == 'gearbox':
+            if self._shifting or not self._unchanged(
+                    body, {'offset': '_gear_offset',
+                           'gear_number': '_gear_number',
+                           'adjust': '_gear_adjust',
+                           'speed': '_gear_change_speed',
+                           'max_power': '_gear_change_max_power'}):
+                return False
+            gear = self._requested_gear(body)
+            return (gear == self._current_gear and
+                    abs(self._gear_change_motor_pos -
+                        self._gear_position(gear)) <= self._shift_tolerance)
+        return False
+
+    async def dispatch(self, body: dict):
+        """
+        Run the handler of a command, unless the command would not change the
+        car.
+
+        :param body: Command body.
+        :rtype:      bool
+        :return:     False if the command was skipped.
+
+        """
+        if self._is_noop(body):
+            skipped = self.metrics['skipped_commands']
+            skipped[body['command']] = skipped.get(body['command'], 0) + 1
+            flight_recorder.write(SKIP, body['command'], self._message_number)
+            return False
+        flight_recorder.write(HANDLER_START, body['command'],
+                              self._message_number)
+        if body['command'] == 'speed':
+            await self.set_speed(body=body)
+        elif body['command'] == 'steering':
+            await self.set_steering_position(body=body)
+        elif body['command'] == 'gearbox':
+            await self.change_gear(body=body)
+        elif body['command'] == 'profile':
+            await self.run_profile(body=body)
+        elif body['command'] == 'macro':
+            await self.run_macro(body=body)
+        elif body['command'] == 'headlights':
+            await self.set_headlight_brightness(body=body)
+        elif body['command'] == 'high_beams':
+            await self.set_high_beam_brightness(body=body)
+        elif body['command'] == 'tail_lights':
+            await self.set_tail_light_brightness(body=body)
+        elif body['command'] == 'brake_lights':
+            await self.set_brake_light_brightness(body=body)
+        elif body['command'] == 'reverse_lights':
+            await self.set_reverse_light_brightness(body=body)
+        elif body['command'] == 'indicators':
+            await self.set_indicator_lights(body=body)
+        self._save_state()
+        flight_recorder.write(HANDLER_END, body['command'],
+                              self._message_number)
+        return True
+
+    @staticmethod
+    def _decode_message(body: bytes):
+        """
+        Record and decode a message from the broker.
+
+        :param body: Message body.
+        :rtype:      dict
+        :return:     Command body.
+
+        """
+        if recorder is not None:
+            recorder.record(body)
+        return json.loads(codecs.decode(body, 'utf-8'))
+
+    def _get_message(self):
+        """
+        Get the next message from the class queues of the car, drive input
+        is weighted over slower commands.
+
+        :rtype:  dict
+        :return: Command body, None if the queues are empty.
+
+        """
+        method_frame, header_frame, body = self._class_queues.get(channel)
+        if method_frame is None:
+            return None
+        channel.basic_ack(method_frame.delivery_tag)
+        return self._decode_message(body)
+
+    def _is_duplicate(self, body: dict):
+        """
+        Check if a command has already been executed, by the idempotency key
+        the client sent with it. The key is removed from the body.
+
+        :param body: Command body.
+        :rtype:      bool
+        :return:     True if the command should be skipped.
+
+        """
+        key = body.pop('idempotency_key', None)
+        if key is None or not self._executed_keys.seen(key, monotonic()):
+            return False
+        self.metrics['duplicate_commands'] = self._executed_keys.duplicates
+        flight_recorder.write(SKIP, body['command'], self._message_number)
+        return True
+
+    def _coalesce(self, bodies: list):
+        """
+        Drop commands that are replaced by a later command in the same batch.
+
+        :param bodies: Command bodies in the order received.
+        :rtype:        list
+        :return:       Command bodies to handle.
+
+        """
+        kept = []
+        seen = set()
+        for body in reversed(bodies):
+            key = None
+            if body['command'] in COALESCED_COMMANDS:
+                key = (body['command'], tuple(sorted(body)))
+            if key in seen:
+                self.metrics['coalesced_commands'] += 1
+                continue
+            if key is not None:
+                seen.add(key)
+            kept.append(body)
+        kept.reverse()
+        return kept
+
+    async def _handle_message(self, body: dict):
+        """
+        Handle a command and pace the next one to the link.
+
+        :param body: Command body.
+
+        """
+        self.message_debug('Handling {body}'.format(body=body))
+        self._message_number += 1
+        flight_recorder.write(COMMAND, body['command'], self._message_number)
+        writes = self.link.writes
+        await self.dispatch(body=body)
+        # Leave the link time to carry the writes of the command, skipped
+        # commands don't write at all
+        delay = self._pacer.command_done(self.link.writes - writes)
+        if delay > 0:
+            await sleep(delay)
+
+    def report_health(self, state: str):
+        """
+        Send health and metrics to the supervisor.
+
+        :param state: "connecting", "running" or "reconnecting".
+
+        """
+        health_pipe.send({'hub': self.name,
+                          'pid': os.getpid(),
+                          'time': monotonic(),
+                          'state': state,
+                          'messages': self._message_number,
+                          'speed': self._speed,
+                          'gear': self._current_gear,
+                          'metrics': self.metrics,
+                          'notifications': self.notification_rates(),
+                          'link': self.link.stats()})
+
+    async def _report_health(self):
+        """
+        Send health and metrics to the supervisor every second, from when
+        the car is created, so that also a slow hub connect is reported.
+
+        """
+        while True:
+            self.report_health('running' if self._running else 'connecting')
+            await sleep(1)
+
+    async def _link_watchdog(self):
+        """
+        Link watchdog task.
+
+        bricknil does not report a lost hub connection and writes to a lost
+        hub never fail. A sensor value is requested every half link timeout,
+        which a connected hub always answers, and the answers also measure
+        the link round trip. The task ends with :class:`HubConnectionError`
+        when a request is not answered within half the link timeout.
+
+        """
+        request_time = None
+        while True:
+            await sleep(self._link_timeout / 4)
+            now = monotonic()
+            last = self.link.last_notification or 0.0
+            if request_time is not None and last < request_time:
+                if now - request_time >= self._link_timeout / 2:
+                    raise HubConnectionError(self.name)
+            elif (request_time is None or
+                    now - request_time >= self._link_timeout / 2):
+                request_time = now
+                await self._request_value()
+
+    async def _request_value(self):
+        """
+        Request the sensor value of the first attached sensing peripheral,
+        and measure the round trip of the request.
+
+        """
+        for port, peripheral in sorted(self.port_to_peripheral.items()):
+            if peripheral.capabilities:
+                self.link.write_started(monotonic(), peripheral.name)
+                # Port information request for the port value
+                await peripheral.send_message('req value on {}'.format(port),
+                                              [0x00, 0x21, port, 0x00])
+                return
 
     async def run(self):
         """
@@ -507,36 +1346,75 @@ class Car(CPlusHub):
 
         """
         self.message_info("Running")
+        self._run_time = monotonic()
+        self._running = True
+
+        # Turn on the restored lights on the first start, and resume the
+        # commanded state after a reconnect
+        if disconnect_time is None:
+            self._restore_lights()
+        else:
+            outage = monotonic() - disconnect_time
+            state = resume_state.get(self.name)
+            if state is not None:
+                self.metrics['reconnects'] = state['reconnects'] + 1
+                await self._resume(state, outage)
+            self.metrics['reconnect_time'] = outage
+            self.message_info('Reconnected after {s:.1f} s'.format(s=outage))
+
+        # Start light effects
+        self._tasks.append(await curio.spawn(self._light_effects.run, sleep,
+                                             daemon=True))
+
+        # Watch the link, the hub connection can only be seen lost through
+        # silent sensors
+        if any(peripheral.capabilities
+               for peripheral in self.peripherals.values()):
+            self._tasks.append(await curio.spawn(self._link_watchdog,
+                                                 daemon=True))
+
+        # Calibrate and start steering control
+        if getattr(self, 'steering_motor', None) is not None:
+            await self._calibrate_steering()
+            self._tasks.append(await curio.spawn(self._steering_control,
+                                                 daemon=True))
+
+        # All cars share the broker channel
+        for queue in self.queues:
+            declare_queues(channel, queue)
+
+        # Handle the commands received during an outage, unless they are too
+        # old
+        for queue in self.class_queues:
+            for received, body in outage_buffer.pop(queue, ()):
+                if monotonic() - received > command_expiry:
+                    self.metrics['expired_commands'] += 1
+                    continue
+                body = self._decode_message(body)
+                if not self._is_duplicate(body):
+                    await self._handle_message(body)
 
         while True:
             # self.message_info("looping")  # TODO delete
             # print("looping")  # TODO delete
-            method_frame, header_frame, body = (
-                channel.basic_get(queue='to_lego'))
-            if method_frame is not None:
-                channel.basic_ack(method_frame.delivery_tag)
-                body = json.loads(codecs.decode(body, 'utf-8'))
-                print(body)  # TODO delete when logging implemented
-                if body['command'] == 'speed':
-                    await self.set_speed(body=body)
-                elif body['command'] == 'steering':
-                    await self.set_steering_position(body=body)
-                elif body['command'] == 'gearbox':
-                    await self.change_gear(body=body)
-                elif body['command'] == 'headlights':
-                    await self.set_headlight_brightness(body=body)
-                elif body['command'] == 'high_beams':
-                    await self.set_high_beam_brightness(body=body)
-                elif body['command'] == 'tail_lights':
-                    await self.set_tail_light_brightness(body=body)
-                elif body['command'] == 'brake_lights':
-                    await self.set_brake_light_brightness(body=body)
-                elif body['command'] == 'reverse_lights':
-                    await self.set_reverse_light_brightness(body=body)
-                elif body['command'] == 'indicators':
-                    await self.set_indicator_lights(body=body)
-                await sleep(2)
-            await sleep(0.1)
+            # The background tasks only end if the hub connection is lost
+            for task in self._tasks:
+                if task.terminated:
+                    raise HubConnectionError(self.name)
+            # Commands queued faster than the link can carry them are
+            # coalesced, retried commands are skipped
+            bodies = []
+            for _ in range(self._pacer.batch_size()):
+                body = self._get_message()
+                if body is None:
+                    break
+                if not self._is_duplicate(body):
+                    bodies.append(body)
+            if not bodies:
+                await sleep(self._pacer.idle())
+                continue
+            for body in self._coalesce(bodies):
+                await self._handle_message(body)
 
         # await self.motor.ramp_speed(80, 5000)
 
@@ -566,13 +1444,302 @@ class Car(CPlusHub):
         # await sleep(20)
 
 
+def hub_file(path: str, name: str):
+    """
+    Get the per hub name of a file.
+
+    :param path: Full path and name of file.
+    :param name: Hub name.
+    :rtype:      str
+    :return:     Full path and name of file with the hub name inserted before
+                 the extension, for example "state.hub2.json".
+
+    """
+    root, extension = os.path.splitext(path)
+    return '{root}.{name}{extension}'.format(root=root, name=name,
+                                             extension=extension)
+
+
+def sensed_value(peripheral, capability, bits: int):
+    """
+    Get a sensed value of a peripheral as a signed integer.
+
+    bricknil decodes sensor values as unsigned integers, and the value of a
+    capability is a list of None until the first notification.
+
+    :param peripheral: Peripheral.
+    :param capability: Sensing capability.
+    :param bits:       Size of the value, 8 for speed and 32 for position.
+    :rtype:            int
+    :return:           Sensed value, None if nothing has been sensed yet.
+
+    """
+    value = (peripheral.value or {}).get(capability)
+    if isinstance(value, list):
+        value = value[0] if len(value) == 1 else None
+    if not isinstance(value, int):
+        return None
+    if value >= 1 << (bits - 1):
+        value -= 1 << bits
+    return value
+
+
+def get_hardware():
+    """
+    Get the configured hardware of all hubs.
+
+    :rtype:  dict
+    :return: Hardware configuration, see :func:`check_hardware`.
+
+    """
+    return getattr(Settings, 'HARDWARE', DEFAULT_HARDWARE)
+
+
+def get_hubs():
+    """
+    Get the configured hubs.
+
+    :rtype:  list
+    :return: Hub configurations with "name" and "ble_id".
+    :raises: ValueError
+
+    """
+    hubs = getattr(Settings, 'HUBS', DEFAULT_HUBS)
+    names = [hub.get('name') for hub in hubs]
+    for name in names:
+        if type(name) != str or not re.fullmatch('[A-Za-z0-9_-]+', name):
+            raise ValueError("Invalid hub name '{}'".format(name))
+    if len(set(names)) != len(names) or not names:
+        raise ValueError('Hub names must be unique')
+    for hub in hubs:
+        check_hardware(hub.get('hardware', get_hardware()))
+    return hubs
+
+
+def check_hardware(hardware: dict):
+    """
+    Check a hardware configuration.
+
+    :param hardware: Peripheral name => "type", "port" and optional
+                     "capabilities", where each capability is a name or a
+                     [name, delta] list.
+    :raises:         ValueError
+
+    """
+    ports = set()
+    for name, peripheral in hardware.items():
+        if name not in PERIPHERAL_NAMES:
+            raise ValueError("Unknown peripheral '{}'".format(name))
+        cls = PERIPHERAL_TYPES.get(peripheral.get('type'))
+        if cls is None:
+            raise ValueError(
+                "Peripheral '{name}' type must be one of {types}".format(
+                    name=name, types=', '.join(PERIPHERAL_TYPES)))
+        port = peripheral.get('port')
+        if type(port) != int or port in ports:
+            raise ValueError("Peripheral '{}' port must be a unique "
+                             "int".format(name))
+        ports.add(port)
+        for capability in peripheral.get('capabilities', []):
+            delta = 0
+            if isinstance(capability, list):
+                capability, delta = capability
+            if (capability not in cls.capability.__members__ or
+                    type(delta) != int or delta < 0):
+                raise ValueError(
+                    "Peripheral '{name}' has invalid capability "
+                    "{capability}".format(name=name, capability=capability))
+
+
+def attach_hardware(car_class, hardware: dict = None):
+    """
+    Attach peripherals to a car class, just like stacked @attach decorators.
+
+    :param car_class: Car class.
+    :param hardware:  Hardware configuration, see :func:`check_hardware`.
+                      :data:`DEFAULT_HARDWARE` is used if not set.
+    :return:          Car class, or function that creates cars, with the
+                      peripherals attached.
+
+    """
+    if hardware is None:
+        hardware = DEFAULT_HARDWARE
+    # Attach to a subclass, so that the car class is left as it is. bricknil
+    # returns a function from @attach and checks the handlers of the next
+    # peripheral on it, and the function only gets the attributes in the
+    # namespace of the subclass, so the handlers are copied there
+    handlers = {name: getattr(car_class, name) for name in dir(car_class)
+                if name.endswith('_change')}
+    car_class = type(car_class.__name__, (car_class,), handlers)
+    for name, peripheral in reversed(list(hardware.items())):
+        kwargs = {'name': name, 'port': peripheral['port']}
+        capabilities = [tuple(capability) if isinstance(capability, list)
+                        else capability
+                        for capability in peripheral.get('capabilities', [])]
+        if capabilities:
+            kwargs['capabilities'] = capabilities
+        car_class = attach(PERIPHERAL_TYPES[peripheral['type']],
+                           **kwargs)(car_class)
+    return car_class
+
+
+def apply_settings(changed: set):
+    """
+    Apply changed settings to the running car control. Called when the
+    config file is reloaded.
+
+    :param changed: Names of the changed settings.
+
+    """
+    global command_expiry, idempotency_cache_size, idempotency_ttl, macros
+    if 'COMMAND_EXPIRY' in changed:
+        command_expiry = getattr(Settings, 'COMMAND_EXPIRY', command_expiry)
+    if changed & {'IDEMPOTENCY_CACHE_SIZE', 'IDEMPOTENCY_TTL'}:
+        idempotency_cache_size = getattr(Settings, 'IDEMPOTENCY_CACHE_SIZE',
+                                         idempotency_cache_size)
+        idempotency_ttl = getattr(Settings, 'IDEMPOTENCY_TTL',
+                                  idempotency_ttl)
+        for cache in executed_keys.values():
+            cache.size = idempotency_cache_size
+            cache.ttl = idempotency_ttl
+    if 'MACROS' in changed:
+        macros = compile_macros(getattr(Settings, 'MACROS', {}))
+        for car in cars:
+            car._macros = macros
+
+
+async def watch_settings():
+    """
+    Reload the config file when it changes. An invalid file is reported and
+    the settings are left unchanged.
+
+    """
+    while True:
+        await sleep(Settings.SETTINGS_RELOAD_INTERVAL)
+        try:
+            Settings.reload_if_changed()
+        except Exception:
+            traceback.print_exc()
+
+
 async def system():
-    # hub = Car(name='hub1',
-    #             query_port_info=True,
-    #             ble_id="90:84:2B:4D:03:F7")
-    hub = Car(name='hub2',
-              query_port_info=True,
-              ble_id='90:84:2B:4E:35:B4')
+    # Forget the hubs of an earlier connection
+    CPlusHub.hubs.clear()
+    cars.clear()
+
+    # Pick up changed settings without a restart
+    await curio.spawn(watch_settings, daemon=True)
+
+    # Every hub consumes its own queue, the first hub also consumes the
+    # "to_lego" queue used by API requests without a car selector
+    for number, hub in enumerate(get_hubs()):
+        if worker_hub is not None and hub['name'] != worker_hub:
+            continue
+        queues = ('to_lego.' + hub['name'],)
+        if number == 0:
+            queues += ('to_lego',)
+        car = attach_hardware(Car, hub.get('hardware', get_hardware()))(
+            name=hub['name'],
+            query_port_info=True,
+            ble_id=hub['ble_id'],
+            calibration_file=hub_file(Settings.CALIBRATION_FILE, hub['name']),
+            state_file=hub_file(Settings.STATE_FILE, hub['name']),
+            macros=macros,
+            queues=queues,
+            port_map_file=hub_file(Settings.PORT_MAP_FILE, hub['name']))
+        car.use_cached_port_map()
+        cars.append(car)
+
+        # Report health to the supervisor
+        if health_pipe is not None:
+            await curio.spawn(car._report_health, daemon=True)
+
+
+def buffer_commands(duration: float, max_messages: int = 1000):
+    """
+    Receive the messages of all cars while the hubs are disconnected. Health
+    is reported to the supervisor every second meanwhile.
+
+    :param duration:     Seconds to receive messages.
+    :param max_messages: Max messages kept per queue, the oldest are dropped.
+
+    """
+    end_time = monotonic() + duration
+    report_time = monotonic()
+    while monotonic() < end_time:
+        if health_pipe is not None and monotonic() >= report_time:
+            for car in cars:
+                car.report_health('reconnecting')
+            report_time += 1
+        for car in cars:
+            for queue in car.class_queues:
+                method_frame, header_frame, body = (
+                    channel.basic_get(queue=queue))
+                if method_frame is not None:
+                    channel.basic_ack(method_frame.delivery_tag)
+                    buffer = outage_buffer.setdefault(queue, [])
+                    buffer.append((monotonic(), body))
+                    del buffer[:-max_messages]
+        time.sleep(0.1)
+
+
+def run_with_reconnect(min_backoff: float = 1.0, max_backoff: float = 30.0,
+                       connects: int = None):
+    """
+    Run the system, and connect again with an exponential backoff when the
+    hub connection is lost. The commanded state of the cars is resumed after
+    a reconnect.
+
+    :param min_backoff: Seconds before the first reconnect.
+    :param max_backoff: Max seconds between reconnects. The backoff is reset
+                        when the system has run this long.
+    :param connects:    Max number of connects, forever if not set.
+
+    """
+    global disconnect_time
+    backoff = min_backoff
+    number = 0
+    while connects is None or number < connects:
+        number += 1
+        connect_time = monotonic()
+        try:
+            start(system)
+        except Exception:
+            traceback.print_exc()
+        disconnect_time = monotonic()
+        if disconnect_time - connect_time >= max_backoff:
+            backoff = min_backoff
+        for car in cars:
+            resume_state[car.name] = car.get_resume_state()
+        if connects is not None and number >= connects:
+            break
+        print('Hub connection lost, reconnecting in {s:.1f} s'.format(
+            s=backoff))
+        buffer_commands(duration=backoff)
+        backoff = min(backoff * 2, max_backoff)
+
+
+def run_worker(hub: str, pipe, core: int = None, log_verbosity: int = None,
+               record: str = None):
+    """
+    Run the car control of one hub in a worker process started by the
+    supervisor.
+
+    :param hub:           Hub name.
+    :param pipe:          Pipe to send health reports to the supervisor.
+    :param core:          CPU core to pin the worker to, not pinned if None.
+    :param log_verbosity: Logging verbosity.
+    :param record:        Record incoming messages to this file, the hub
+                          name is added before the extension.
+
+    """
+    if core is not None:
+        os.sched_setaffinity(0, {core})
+    global worker_hub, health_pipe
+    worker_hub = hub
+    health_pipe = pipe
+    Main.init(log_verbosity=log_verbosity)
+    Main.run_hubs(hub=hub, record=record)
 
 
 class Main:
@@ -588,16 +1755,28 @@ class Main:
 
         """
         log_verbosity_help = 'Logging verbosity 0-60.'
+        record_help = 'Record incoming messages to this file.'
+        supervise_help = 'Run every hub in its own worker process.'
+        pin_cores_help = 'Pin every worker process to its own CPU core.'
         description = 'Connects a LEGO Control+ Bluetooth hub to RabbitMQ.'
         parser = argparse.ArgumentParser(description=description)
         parser.add_argument('--log-verbosity', '-v', type=int,
                             help=log_verbosity_help, required=False)
+        parser.add_argument('--record', type=str,
+                            help=record_help, required=False)
+        parser.add_argument('--supervise', action='store_true',
+                            help=supervise_help)
+        parser.add_argument('--pin-cores', action='store_true',
+                            help=pin_cores_help)
         args = parser.parse_args()
         return args
 
-    def run(self):
+    @staticmethod
+    def init(log_verbosity: int = None):
         """
-        Run the script.
+        Read settings and connect to log files.
+
+        :param log_verbosity: Logging verbosity, overrides the setting.
 
         """
         # Read settings from YAML file
@@ -610,31 +1789,81 @@ class Main:
         error_log = create_logger(log_file=Settings.ERROR_LOG,
                                   level=60, screen=False)
 
-        # Parse command line options
-        args = self._parse_command_line_options()
-        if args.log_verbosity is not None:
-            Settings.LOG_VERBOSITY = args.log_verbosity
+        if log_verbosity is not None:
+            Settings.LOG_VERBOSITY = log_verbosity
 
-        # Connect to LEGO Control+ hub
-        # try:
-        while True:
-            start(system)
-            break
-        # except BaseException:
-        #     message = traceback_message = traceback.format_exc()
+    @staticmethod
+    def run_hubs(hub: str = None, record: str = None):
+        """
+        Run the car control of all hubs, or of one hub.
 
+        :param hub:    Hub name, all hubs are run if not set.
+        :param record: Record incoming messages to this file.
 
-if __name__ == '__main__':
+        """
+        # Compile macros and apply settings, also when they are reloaded
+        apply_settings({'COMMAND_EXPIRY', 'IDEMPOTENCY_CACHE_SIZE',
+                        'IDEMPOTENCY_TTL', 'MACROS'})
+        Settings.add_listener(apply_settings)
+
+        # Check hub configuration before connecting
+        get_hubs()
+
+        # Open flight recorder journal, workers have one journal each
+        global flight_recorder
+        journal_file = Settings.JOURNAL_FILE
+        if hub is not None:
+            journal_file = hub_file(journal_file, hub)
+            if record is not None:
+                record = hub_file(record, hub)
+        flight_recorder = Journal(path=journal_file,
+                                  records=Settings.JOURNAL_RECORDS)
+
+        # Record incoming messages
+        global recorder
+        if record is not None:
+            recorder = CommandRecorder(path=record)
+
+        # Connect to RabbitMQ
+        import pika
+        global channel
+        connection = pika.BlockingConnection(
+            pika.ConnectionParameters(host='localhost'))
+        channel = connection.channel()
+
+        # Connect to LEGO Control+ hubs
+        run_with_reconnect(
+            min_backoff=getattr(Settings, 'RECONNECT_MIN_BACKOFF', 1.0),
+            max_backoff=getattr(Settings, 'RECONNECT_MAX_BACKOFF', 30.0))
+
+        # Close connection to RabbitMQ
+        channel.close()
+        connection.close()
 
-    # Connect to RabbitMQ
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(host='localhost'))
-    channel = connection.channel()
-    channel.queue_declare(queue='to_lego')
+    def run(self):
+        """
+        Run the script.
 
+        """
+        # Parse command line options
+        args = self._parse_command_line_options()
+        self.init(log_verbosity=args.log_verbosity)
+
+        # Run one worker process per hub
+        if args.supervise:
+            from supervisor import Supervisor
+            hubs = [hub['name'] for hub in get_hubs()]
+            supervisor = Supervisor(
+                hubs=hubs,
+                target=run_worker,
+                args=(args.log_verbosity, args.record),
+                pin_cores=args.pin_cores,
+                status_file=getattr(Settings, 'WORKER_STATUS_FILE', None))
+            supervisor.run()
+        else:
+            self.run_hubs(record=args.record)
+
+
+if __name__ == '__main__':
     main = Main()
     main.run()
-
-    # Close connection to RabbitMQ
-    channel.close()
-    connection.close()
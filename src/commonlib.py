@@ -11,7 +11,9 @@ This module contains functions and classes used by multiple legcocar modules.
 """
 
 # Built in modules
+import json
 import logging
+import os
 from logging import Logger
 from logging import CRITICAL, ERROR, WARNING, DEBUG, INFO
 
@@ -83,3 +85,35 @@ def create_logger(log_file: str = None,
 
     # Return the logger
     return logger
+
+
+def read_json_file(path: str, default=None):
+    """
+    Read a JSON file.
+
+    :param path:    Full path and name of JSON file.
+    :param default: Returned if the file doesn't exist or can't be parsed.
+    :return:        File contents.
+
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as file_obj:
+            return json.load(file_obj)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json_file(path: str, data):
+    """
+    Write a JSON file atomically.
+
+    The data is written to a temporary file that is then renamed, so readers
+    never see a partially written file.
+
+    :param path: Full path and name of JSON file.
+    :param data: Data to write.
+
+    """
+    with open(path + '~', 'w', encoding='utf-8') as file_obj:
+        json.dump(data, file_obj)
+    os.rename(path + '~', path)
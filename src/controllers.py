@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Controllers
+***********
+
+This module contains the motor position controllers used by the car control.
+The controllers only contain the control logic. The caller feeds them sensed
+positions and a monotonic time, and sends the resulting commands to the hub.
+
+"""
+
+
+class GearHold:
+    """Holds the gear change motor at the position of the current gear."""
+
+    def __init__(self,
+                 band: float = 4,
+                 settle_band: float = 1,
+                 debounce: float = 0.2,
+                 min_interval: float = 0.5):
+        """
+        Constructor function.
+
+        :param band:         A correction is made when the position is further
+                             than this from the gear position (degrees).
+        :param settle_band:  After a correction the position is held again
+                             when it is within this from the gear position
+                             (degrees).
+        :param debounce:     The position must be outside the band this long
+                             before a correction is made (seconds).
+        :param min_interval: Min time between corrections (seconds).
+
+        """
+        self.band = band
+        self.settle_band = settle_band
+        self.debounce = debounce
+        self.min_interval = min_interval
+        self.positions = [0]
+        """(*list*) Gear change motor position of each gear."""
+        self.corrections = 0
+        """(*int*) Number of corrections made."""
+        self._holding = True
+        self._outside_since = None
+        self._last_correction = None
+
+    def set_gears(self, offset: float, adjust: int, gear_number: int):
+        """
+        Compute the gear position table.
+
+        :param offset:      Degrees between gears.
+        :param adjust:      Position adjustment of all gears (degrees).
+        :param gear_number: Number of gears.
+
+        """
+        self.positions = [int(offset * gear) + adjust
+                          for gear in range(gear_number)]
+
+    def position(self, gear: int):
+        """
+        Get the gear change motor position of a gear.
+
+        :param gear: Gear number, starting at 1.
+        :rtype:      int
+        :return:     Position in degrees.
+
+        """
+        return self.positions[max(1, min(gear, len(self.positions))) - 1]
+
+    def reset(self):
+        """
+        Forget the correction state, for example when a shift has moved the
+        motor.
+
+        """
+        self._holding = True
+        self._outside_since = None
+
+    def update(self, gear: int, position: int, now: float):
+        """
+        Handle a sensed gear change motor position.
+
+        :param gear:     Current gear number.
+        :param position: Sensed gear change motor position (degrees).
+        :param now:      Monotonic time (seconds).
+        :rtype:          int
+        :return:         Position to correct to, None if no correction should
+                         be made.
+
+        """
+        target = self.position(gear)
+        error = abs(position - target)
+
+        # Hold until the position leaves the band
+        if self._holding:
+            if error <= self.band:
+                self._outside_since = None
+                return None
+        # Hold again once a correction has settled
+        elif error <= self.settle_band:
+            self.reset()
+            return None
+
+        # Debounce
+        if self._outside_since is None:
+            self._outside_since = now
+        if now - self._outside_since < self.debounce:
+            return None
+
+        # Limit correction rate
+        if (self._last_correction is not None and
+                now - self._last_correction < self.min_interval):
+            return None
+
+        self._holding = False
+        self._last_correction = now
+        self.corrections += 1
+        return target
+
+
+class SteeringController:
+    """PID position controller for the steering motor."""
+
+    def __init__(self,
+                 kp: float = 1.5,
+                 ki: float = 0.0,
+                 kd: float = 0.05,
+                 deadband: float = 2,
+                 slew_rate: float = 400,
+                 output_step: int = 5,
+                 stall_time: float = 0.3):
+        """
+        Constructor function.
+
+        :param kp:          Proportional gain (% speed per degree).
+        :param ki:          Integral gain (% speed per degree second).
+        :param kd:          Derivative gain (% speed per degree per second).
+        :param deadband:    No output when the position is within this from
+                            the target (degrees).
+        :param slew_rate:   Max output change (% speed per second).
+        :param output_step: Output is rounded to steps of this size (%), so
+                            that small changes don't cause hub writes.
+        :param stall_time:  The motor is stalled, for example against an end
+                            stop, when it has not moved for this long
+                            (seconds).
+
+        """
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.deadband = deadband
+        self.slew_rate = slew_rate
+        self.output_step = output_step
+        self.stall_time = stall_time
+        self.stalls = 0
+        """(*int*) Number of detected stalls."""
+        self._output = 0.0
+        self._integral = 0.0
+        self._last_error = None
+        self._target = None
+        self._stalled = False
+        self._still_time = 0.0
+        self._still_position = None
+
+    def update(self, target: float, position: float, max_output: float,
+               dt: float):
+        """
+        Compute motor speed.
+
+        :param target:     Target position (degrees).
+        :param position:   Sensed position (degrees).
+        :param max_output: Max absolute output (% speed).
+        :param dt:         Seconds since last update.
+        :rtype:            int
+        :return:           Motor speed from -100 to 100.
+
+        """
+        # A new target clears a stall
+        if target != self._target:
+            self._target = target
+            self._stalled = False
+            self._still_time = 0.0
+
+        error = target - position
+        if self._stalled or abs(error) <= self.deadband:
+            self._output = 0.0
+            self._integral = 0.0
+            self._last_error = None
+            return 0
+
+        # PID
+        self._integral += error * dt
+        derivative = 0.0
+        if self._last_error is not None and dt > 0:
+            derivative = (error - self._last_error) / dt
+        self._last_error = error
+        wanted = (self.kp * error + self.ki * self._integral +
+                  self.kd * derivative)
+        wanted = max(-max_output, min(max_output, wanted))
+
+        # Limit slew rate
+        max_change = self.slew_rate * dt
+        self._output += max(-max_change, min(max_change,
+                                             wanted - self._output))
+
+        # Detect stall
+        if self._still_position is None or abs(
+                position - self._still_position) >= 1:
+            self._still_position = position
+            self._still_time = 0.0
+        else:
+            self._still_time += dt
+            if self._still_time >= self.stall_time:
+                self._stalled = True
+                self.stalls += 1
+                self._output = 0.0
+                return 0
+
+        return int(round(self._output / self.output_step) * self.output_step)
@@ -12,24 +12,309 @@ This modules is a flask web server.
 
 # Built in modules
 import argparse
+import functools
 import json
+import threading
+import time
 import traceback
 import re
 
 # Third party modules
 from flask import Flask, render_template, request, Response
 from json import JSONDecodeError
-import pika
+
+# Local modules
+from macros import check_light_args
+from routing import EXCHANGE, routing_key
+
+# Commands that can be sent to a car with "/api/cars/<car>/<command>"
+COMMANDS = ('speed', 'steering', 'gearbox', 'headlights', 'high_beams',
+            'tail_lights', 'brake_lights', 'reverse_lights', 'indicators',
+            'profile', 'macro')
+
+# Max number of steps in a motion profile
+MAX_PROFILE_STEPS = 1000
+
+# Max time of a motion profile step in seconds
+MAX_PROFILE_TIME = 600
+
+# Input filter settings of analog commands. "arg" is the filtered argument,
+# values within "deadband" from zero are sent as zero, values that differ less
+# than "min_change" from the last published value are dropped, "smoothing" is
+# the exponential smoothing factor (1 is no smoothing) and "max_rate" is the
+# max number of published messages per second and client session. The last
+# update dropped by the rate limit is published when the rate allows it.
+INPUT_FILTERS = {
+    'speed': {'arg': 'speed', 'deadband': 5, 'min_change': 3,
+              'smoothing': 1.0, 'max_rate': 20},
+    'steering': {'arg': 'position', 'deadband': 0, 'min_change': 2,
+                 'smoothing': 1.0, 'max_rate': 20}}
+
+# Seconds until the input filter state of an idle client session is forgotten
+INPUT_FILTER_SESSION_TIMEOUT = 60
+
+# Settings class, set by load_settings(). The defaults above are used and the
+# config file is not read if not set.
+config = None
+
+
+class InputFilter:
+    """
+    Drops analog input updates that would not change the car before they are
+    published.
+
+    The filter state is kept per worker process.
+
+    """
+
+    def __init__(self, filters: dict = None,
+                 session_timeout: float = INPUT_FILTER_SESSION_TIMEOUT,
+                 clock=time.monotonic, timer=threading.Timer):
+        """
+        Constructor function.
+
+        :param filters:         Filter settings per command, see
+                                :data:`INPUT_FILTERS`.
+        :param session_timeout: Seconds until the state of an idle client
+                                session is forgotten.
+        :param clock:           Monotonic clock function.
+        :param timer:           Creates the timers that publish updates
+                                dropped by the rate limit, called like
+                                threading.Timer.
+        :raises:                ValueError
+
+        """
+        self.filters = INPUT_FILTERS if filters is None else filters
+        self._check_filters(self.filters)
+        self.session_timeout = session_timeout
+        self._clock = clock
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._last_sweep = clock()
+        self.stats = {command: {'received': 0, 'published': 0, 'dropped': 0}
+                      for command in self.filters}
+        """(*dict*) Command => received, published and dropped counts."""
+
+    def configure(self, filters: dict = None, session_timeout: float = None):
+        """
+        Change the filter settings while running. The client sessions and
+        counts are kept.
+
+        :param filters:         Filter settings per command, merged with
+                                :data:`INPUT_FILTERS`.
+        :param session_timeout: Seconds until the state of an idle client
+                                session is forgotten.
+        :raises:                ValueError
+
+        """
+        filters = {command: {**INPUT_FILTERS.get(command, {}), **settings}
+                   for command, settings in (filters or {}).items()}
+        self._check_filters(filters)
+        with self._lock:
+            self.filters = {**INPUT_FILTERS, **filters}
+            if session_timeout is not None:
+                self.session_timeout = session_timeout
+            for command in self.filters:
+                self.stats.setdefault(
+                    command, {'received': 0, 'published': 0, 'dropped': 0})
+
+    @staticmethod
+    def _check_filters(filters: dict):
+        """
+        Check the filter settings.
+
+        :param filters: Filter settings per command.
+        :raises:        ValueError
+
+        """
+        for command, settings in filters.items():
+            max_rate = settings.get('max_rate')
+            if type(max_rate) not in (int, float) or not max_rate > 0:
+                raise ValueError("Input filter '{command}' max_rate must be "
+                                 "more than 0, not {max_rate}".format(
+                                     command=command, max_rate=max_rate))
+
+    def _expire_sessions(self, now: float):
+        """
+        Forget idle client sessions.
+
+        :param now: Monotonic time.
+
+        """
+        if now - self._last_sweep < self.session_timeout:
+            return
+        self._last_sweep = now
+        for key, state in list(self._sessions.items()):
+            if (now - state['seen'] > self.session_timeout and
+                    state['timer'] is None):
+                del self._sessions[key]
+
+    def _publish_pending(self, session: str, command: str):
+        """
+        Publish the last update of a client session that was dropped by the
+        rate limit, unless a later update was published or dropped as
+        unchanged. Called by the timer of the session.
+
+        :param session: Client session.
+        :param command: Command name.
+
+        """
+        with self._lock:
+            state = self._sessions[(session, command)]
+            state['timer'] = None
+            value, publish = state['pending'], state['publish']
+            state['pending'] = None
+            settings = self.filters.get(command)
+            if value is None or settings is None:
+                return
+            self.stats[command]['published'] += 1
+            state['published'] = value
+            state['publish_time'] = self._clock()
+            arg = settings['arg']
+        try:
+            publish({arg: value})
+        except Exception:
+            traceback.print_exc()
+
+    def filter(self, session: str, command: str, args: dict, publish=None):
+        """
+        Filter the arguments of a command.
+
+        Only commands that have filter settings and no other arguments than
+        the filtered one are filtered. A change to zero is never dropped, so
+        that the car always stops.
+
+        :param session: Client session.
+        :param command: Command name.
+        :param args:    Command arguments.
+        :param publish: Function called from a timer thread with the
+                        arguments of the last update dropped by the rate
+                        limit, when the rate allows it. Updates dropped by
+                        the rate limit are not published later if not set.
+        :rtype:         tuple
+        :return:        Arguments to publish, None if the update is dropped,
+                        and the reason it was dropped, "unchanged" or "rate".
+
+        """
+        settings = self.filters.get(command)
+        if settings is None or list(args) != [settings['arg']]:
+            return args, None
+        arg = settings['arg']
+        now = self._clock()
+        with self._lock:
+            self._expire_sessions(now)
+            stats = self.stats[command]
+            stats['received'] += 1
+            state = self._sessions.get((session, command))
+            if state is None:
+                state = {'smoothed': float(args[arg]), 'published': None,
+                         'publish_time': None, 'pending': None,
+                         'publish': None, 'timer': None}
+                self._sessions[(session, command)] = state
+            else:
+                state['smoothed'] += settings['smoothing'] * (
+                    args[arg] - state['smoothed'])
+            state['seen'] = now
+            value = int(round(state['smoothed']))
+            if abs(value) <= settings['deadband']:
+                value = 0
+            published = state['published']
+            stop = value == 0 and published != 0
+            reason = None
+            if published is not None and not stop and abs(
+                    value - published) < max(settings['min_change'], 1):
+                reason = 'unchanged'
+            elif (state['publish_time'] is not None and not stop and
+                  now - state['publish_time'] < 1 / settings['max_rate']):
+                reason = 'rate'
+            # Only the last dropped update is published later, and not if it
+            # is dropped as unchanged
+            state['pending'] = None
+            if reason == 'rate' and publish is not None:
+                state['pending'] = value
+                state['publish'] = publish
+                if state['timer'] is None:
+                    delay = (state['publish_time'] + 1 / settings['max_rate']
+                             - now)
+                    state['timer'] = self._timer(
+                        delay, self._publish_pending, (session, command))
+                    state['timer'].daemon = True
+                    state['timer'].start()
+            if reason is not None:
+                stats['dropped'] += 1
+                return None, reason
+            stats['published'] += 1
+            state['published'] = value
+            state['publish_time'] = now
+        return {arg: value}, None
 
 
 # noinspection PyTypeChecker,PyBroadException
 class RequestHandler:
     """Flask web server."""
 
+    broker_connection_factory = None
+    """(*function*) Creates broker connections, pika is used if not set."""
+
+    input_filter = InputFilter()
+    """(*InputFilter*) Filters analog input, nothing is filtered if None."""
+
     def __init__(self):
         # Init variables for connecting to RabbitMQ
         self._connection = None
         self._channel = None
+        self._queue = 'to_lego'
+
+    @staticmethod
+    def _connect_to_broker():
+        """
+        Connect to the message broker.
+
+        :rtype:   pika.BlockingConnection
+        :returns: Broker connection.
+
+        """
+        if RequestHandler.broker_connection_factory is not None:
+            return RequestHandler.broker_connection_factory()
+        # pika is imported on the first publish, so that the web server
+        # workers start without it
+        import pika
+        return pika.BlockingConnection(pika.ConnectionParameters('localhost'))
+
+    def _connect_channel(self):
+        """
+        Connect to RabbitMQ and declare the command exchange.
+
+        """
+        self._connection = self._connect_to_broker()
+        self._channel = self._connection.channel()
+        self._channel.exchange_declare(exchange=EXCHANGE,
+                                       exchange_type='topic',
+                                       durable=True)
+
+    @staticmethod
+    def _publish(args: dict, queue: str, command: str):
+        """
+        Publish a command on a new broker connection.
+
+        :param args:    Command arguments.
+        :param queue:   Car queue.
+        :param command: Command name.
+
+        """
+        connection = RequestHandler._connect_to_broker()
+        try:
+            channel = connection.channel()
+            channel.exchange_declare(exchange=EXCHANGE,
+                                     exchange_type='topic',
+                                     durable=True)
+            channel.basic_publish(exchange=EXCHANGE,
+                                  routing_key=routing_key(queue, command),
+                                  body=json.dumps({**args,
+                                                   'command': command}))
+        finally:
+            connection.close()
 
     @staticmethod
     def _get_request_arguments():
@@ -135,13 +420,128 @@ class RequestHandler:
                     path=path, arg=arg, arg_type=all_args[arg],
                     value=value)
 
+    @staticmethod
+    def _validate_profile(path: str, args: dict):
+        """
+        Check that all steps of a motion profile are valid.
+
+        :param path: HTTP request path.
+        :param args: HTTP request arguments.
+        :raises: HttpRequestInvalidProfileError
+
+        """
+        steps = args['steps']
+        if len(steps) == 0 or len(steps) > MAX_PROFILE_STEPS:
+            raise HttpRequestInvalidProfileError(
+                path=path, step=0,
+                reason='a profile must have 1-{} steps'.format(
+                    MAX_PROFILE_STEPS))
+        last_time = 0
+        for number, step in enumerate(steps):
+            if type(step) != dict:
+                raise HttpRequestInvalidProfileError(
+                    path=path, step=number, reason='step is not an object')
+            invalid = [i for i in step.keys()
+                       if i not in ('time', 'speed', 'steering', 'gear')]
+            if invalid:
+                raise HttpRequestInvalidProfileError(
+                    path=path, step=number,
+                    reason='invalid keys {}'.format(', '.join(invalid)))
+            step_time = step.get('time')
+            if (type(step_time) not in (int, float) or
+                    not last_time <= step_time <= MAX_PROFILE_TIME):
+                raise HttpRequestInvalidProfileError(
+                    path=path, step=number,
+                    reason="'time' must be a number from the previous step "
+                           "time to {}".format(MAX_PROFILE_TIME))
+            last_time = step_time
+            if len(step) == 1:
+                raise HttpRequestInvalidProfileError(
+                    path=path, step=number,
+                    reason="step needs 'speed', 'steering' or 'gear'")
+            for key in ('speed', 'steering', 'gear'):
+                if key in step and type(step[key]) != int:
+                    raise HttpRequestInvalidProfileError(
+                        path=path, step=number,
+                        reason="'{}' must be an int".format(key))
+            if 'speed' in step and not -100 <= step['speed'] <= 100:
+                raise HttpRequestInvalidProfileError(
+                    path=path, step=number,
+                    reason="'speed' must be from -100 to 100")
+            if 'gear' in step and step['gear'] < 1:
+                raise HttpRequestInvalidProfileError(
+                    path=path, step=number, reason="'gear' must be 1 or more")
+
+    @staticmethod
+    def _validate_light(path: str, args: dict):
+        """
+        Check the effect and the times of a light request.
+
+        :param path: HTTP request path.
+        :param args: HTTP request arguments.
+        :raises: HttpRequestInvalidLightError
+
+        """
+        reason = check_light_args(args)
+        if reason is not None:
+            raise HttpRequestInvalidLightError(path=path, reason=reason)
+
+    @staticmethod
+    def _check_car(path: str, car: str):
+        """
+        Check that a car is configured under "HUBS" in the config file. Any
+        car is accepted if the config file has no hubs.
+
+        :param path: HTTP request path.
+        :param car:  Car name.
+        :raises: HttpRequestUnknownCarError
+
+        """
+        hubs = getattr(config, 'HUBS', None)
+        if hubs is None:
+            return
+        if car not in [hub.get('name') for hub in hubs if type(hub) == dict]:
+            raise HttpRequestUnknownCarError(path=path, car=car)
+
+    @staticmethod
+    def _get_idempotency_key(path: str, client: str):
+        """
+        Get the idempotency key of a request, from the "Idempotency-Key" header
+        or from the "X-Sequence-Number" header and the client session. Retried
+        requests must send the same key.
+
+        :param path:   HTTP request path.
+        :param client: Client session.
+        :rtype:        str
+        :return:       Idempotency key, None if the request has none.
+        :raises:       HttpRequestInvalidIdempotencyKeyError
+
+        """
+        key = request.headers.get('Idempotency-Key')
+        if key is not None:
+            if not re.fullmatch('[\x21-\x7e]{1,255}', key):
+                raise HttpRequestInvalidIdempotencyKeyError(
+                    path=path, header='Idempotency-Key', key=key)
+            return key
+        sequence = request.headers.get('X-Sequence-Number')
+        if sequence is not None:
+            if not re.fullmatch('[0-9]{1,20}', sequence):
+                raise HttpRequestInvalidIdempotencyKeyError(
+                    path=path, header='X-Sequence-Number', key=sequence)
+            return '{client}#{sequence}'.format(client=client,
+                                                sequence=sequence)
+        return None
+
     # noinspection PyUnresolvedReferences
-    def _handle_api_request(self, mandatory_args: dict, optional_args: dict):
+    def _handle_api_request(self, mandatory_args: dict, optional_args: dict,
+                            validate=None):
         """
         Handle a HTTP API request.
 
         :param mandatory_args: Dictionary describing mandatory arguments.
         :param optional_args:  Dictionary describing optional arguments.
+        :param validate:       Function called with path and arguments for
+                               additional validation.
         :rtype:   dict
         :returns: API response message.
 
@@ -154,13 +554,43 @@ class RequestHandler:
                                  args=args,
                                  mandatory_args=mandatory_args,
                                  optional_args=optional_args)
+        if validate is not None:
+            validate(path, args)
+        client = request.headers.get('X-Session-Id', request.remote_addr)
+        idempotency_key = self._get_idempotency_key(path=path, client=client)
         # Get command from path
-        args['command'] = re.match('.*/(.+)', string=path).group(1)
+        command = re.match('.*/(.+)', string=path).group(1)
+        # Drop analog input updates that would not change the car
+        if self.input_filter is not None:
+            session = '{queue}/{client}'.format(queue=self._queue,
+                                                client=client)
+            publish = functools.partial(self._publish, queue=self._queue,
+                                        command=command)
+            args, reason = self.input_filter.filter(session=session,
+                                                    command=command,
+                                                    args=args,
+                                                    publish=publish)
+            if args is None:
+                result = {'filtered': reason,
+                          **self.input_filter.stats[command]}
+                if reason == 'rate':
+                    result['retry_after'] = (
+                        1 / self.input_filter.filters[command]['max_rate'])
+                return self._json_response(message='Input filtered',
+                                           status_code=200,
+                                           result=result)
+        args['command'] = command
+        # The car skips commands with a key it has already executed
+        if idempotency_key is not None:
+            args['idempotency_key'] = idempotency_key
+        # Connect to RabbitMQ
+        self._connect_channel()
         # Set body
         body = json.dumps(args)
         # Send message to to RabbitMQ
-        self._channel.basic_publish(exchange='',
-                                    routing_key='to_lego',
+        self._channel.basic_publish(exchange=EXCHANGE,
+                                    routing_key=routing_key(self._queue,
+                                                            command),
                                     body=body)
         # message = 'Speed set to {}'.format(args['speed'])
         return self._json_response(message=str(args),
@@ -174,12 +604,19 @@ class RequestHandler:
         path = request.path
         content_type = request.content_type
         try:
-            if path.startswith('/api/'):
-                # Connect to RabbitMQ if request is an API request
-                self._connection = pika.BlockingConnection(
-                    pika.ConnectionParameters('localhost'))
-                self._channel = self._connection.channel()
-                self._channel.queue_declare(queue='to_lego')
+            # Select car by "/api/cars/<car>/" path prefix or "X-Car" header,
+            # the default car consumes the "to_lego" queue
+            car = request.headers.get('X-Car')
+            match = re.match('/api/cars/([^/]+)(/.*)', path)
+            if match is not None:
+                car = match.group(1)
+                path = '/api' + match.group(2)
+            if car is not None:
+                if not re.fullmatch('[A-Za-z0-9_-]+', car):
+                    raise HttpRequestInvalidCarError(path=request.path,
+                                                     car=car)
+                self._check_car(path=request.path, car=car)
+                self._queue = 'to_lego.' + car
             if (path.startswith('/api/') and
                     not content_type.startswith('application/json')):
                 raise HttpRequestContentTypeError(
@@ -211,10 +648,16 @@ class RequestHandler:
                   and request.method == 'POST'):
                 mandatory_args = {}
                 optional_args = {'brightness': 'int',
-                                 'duration': 'int'}
+                                 'duration': 'int',
+                                 'effect': 'str',
+                                 'length': 'float',
+                                 'interval': 'float',
+                                 'period': 'float',
+                                 'fade_time': 'float'}
                 response = self._handle_api_request(
                     mandatory_args=mandatory_args,
-                    optional_args=optional_args)
+                    optional_args=optional_args,
+                    validate=self._validate_light)
 
             # Handle steering position
             elif (path == '/api/steering' and
@@ -250,20 +693,46 @@ class RequestHandler:
                                  'duration': 'int',
                                  'length': 'float',
                                  'interval': 'float',
+                                 'effect': 'str',
+                                 'period': 'float',
+                                 'fade_time': 'float',
                                  'left': 'bool',
                                  'right': 'bool'}
+                response = self._handle_api_request(
+                    mandatory_args=mandatory_args,
+                    optional_args=optional_args,
+                    validate=self._validate_light)
+
+            # Handle motion profile
+            elif path == '/api/profile' and request.method == 'POST':
+                mandatory_args = {'steps': 'list'}
+                optional_args = {}
+                response = self._handle_api_request(
+                    mandatory_args=mandatory_args,
+                    optional_args=optional_args,
+                    validate=self._validate_profile)
+
+            # Handle macro, the steps are defined in the car config
+            elif path == '/api/macro' and request.method == 'POST':
+                mandatory_args = {'name': 'str'}
+                optional_args = {}
                 response = self._handle_api_request(
                     mandatory_args=mandatory_args,
                     optional_args=optional_args)
 
-            # Close connection to RabbitMQ if request was an API request
-            if path.startswith('/api/'):
+            # Unknown command to a selected car
+            elif match is not None:
+                raise HttpRequestUnknownCommandError(
+                    path=request.path, command=match.group(2)[1:])
+
+            # Close connection to RabbitMQ if a message was published
+            if self._connection is not None:
                 self._channel.close()
                 self._connection.close()
             return response
         except HttpRequestError as e:
             return self._json_response(message=str(e),
-                                       status_code=400)
+                                       status_code=e.status_code)
         except BaseException:
             traceback_message = traceback.format_exc()
             return self._json_response(message=traceback_message,
@@ -273,6 +742,9 @@ class RequestHandler:
 class HttpRequestError(Exception):
     """Error for malformed HTTP requests."""
 
+    status_code = 400
+    """(*int*) HTTP status code of the error response."""
+
     # noinspection PyUnresolvedReferences
     def __str__(self):
         """
@@ -369,6 +841,145 @@ class HttpRequestArgumentTypeError(HttpRequestError):
                                        value=value)
 
 
+class HttpRequestInvalidProfileError(HttpRequestError):
+    """Error for malformed HTTP requests."""
+
+    def __init__(self, path: str, step: int, reason: str):
+        """
+        Constructor function.
+
+        :param path:   Target path that caused the error.
+        :param step:   Index of the invalid profile step.
+        :param reason: Why the step is invalid.
+
+        """
+        message = ("Invalid profile in HTTP request '{path}'. Step {step}: "
+                   "{reason}")
+        self._message = message.format(path=path, step=step, reason=reason)
+
+
+class HttpRequestInvalidLightError(HttpRequestError):
+    """Error for malformed HTTP requests."""
+
+    def __init__(self, path: str, reason: str):
+        """
+        Constructor function.
+
+        :param path:   Target path that caused the error.
+        :param reason: Why the light arguments are invalid.
+
+        """
+        message = "Invalid light in HTTP request '{path}': {reason}"
+        self._message = message.format(path=path, reason=reason)
+
+
+class HttpRequestInvalidCarError(HttpRequestError):
+    """Error for malformed HTTP requests."""
+
+    def __init__(self, path: str, car: str):
+        """
+        Constructor function.
+
+        :param path: Target path that caused the error.
+        :param car:  Invalid car name.
+
+        """
+        message = ("Invalid car '{car}' in HTTP request '{path}'. Car names "
+                   "may only contain letters, digits, '_' and '-'")
+        self._message = message.format(path=path, car=car)
+
+
+class HttpRequestUnknownCarError(HttpRequestError):
+    """Error for HTTP requests to cars that are not configured."""
+
+    status_code = 404
+
+    def __init__(self, path: str, car: str):
+        """
+        Constructor function.
+
+        :param path: Target path that caused the error.
+        :param car:  Unknown car name.
+
+        """
+        message = "Unknown car '{car}' in HTTP request '{path}'"
+        self._message = message.format(path=path, car=car)
+
+
+class HttpRequestUnknownCommandError(HttpRequestError):
+    """Error for HTTP requests with commands that do not exist."""
+
+    status_code = 404
+
+    def __init__(self, path: str, command: str):
+        """
+        Constructor function.
+
+        :param path:    Target path that caused the error.
+        :param command: Unknown command.
+
+        """
+        message = ("Unknown command '{command}' in HTTP request '{path}'. "
+                   "Valid commands are: {commands}")
+        self._message = message.format(path=path, command=command,
+                                       commands=', '.join(COMMANDS))
+
+
+class HttpRequestInvalidIdempotencyKeyError(HttpRequestError):
+    """Error for malformed HTTP requests."""
+
+    def __init__(self, path: str, header: str, key: str):
+        """
+        Constructor function.
+
+        :param path:   Target path that caused the error.
+        :param header: Header with the invalid key.
+        :param key:    Invalid key.
+
+        """
+        message = ("Invalid '{header}' header '{key}' in HTTP request "
+                   "'{path}'. An 'Idempotency-Key' must be 1-255 printable "
+                   "ASCII characters and a 'X-Sequence-Number' must be a "
+                   "number")
+        self._message = message.format(path=path, header=header, key=key)
+
+
+def apply_settings(changed: set):
+    """
+    Apply changed settings to the web server. Called when the config file is
+    reloaded.
+
+    :param changed: Names of the changed settings.
+
+    """
+    if RequestHandler.input_filter is None:
+        return
+    if changed & {'INPUT_FILTERS', 'INPUT_FILTER_SESSION_TIMEOUT'}:
+        RequestHandler.input_filter.configure(
+            filters=getattr(config, 'INPUT_FILTERS', None),
+            session_timeout=getattr(config, 'INPUT_FILTER_SESSION_TIMEOUT',
+                                    None))
+
+
+def load_settings():
+    """
+    Read the config file shared with the car control. Changes are picked up
+    while running. The defaults are used if the file can't be read.
+
+    """
+    global config
+    try:
+        from settings import Settings
+        Settings.static_init()
+        Settings.load_settings_from_yaml()
+    except Exception:
+        traceback.print_exc()
+        return
+    config = Settings
+    Settings.add_listener(apply_settings)
+    apply_settings({'INPUT_FILTERS', 'INPUT_FILTER_SESSION_TIMEOUT'})
+
+
 class Main:
     """Contains the script"""
 
@@ -394,6 +1005,7 @@ class Main:
 
         """
         args = self._parse_command_line_options()
+        load_settings()
         flask_debug = False
         if args.debug > 0:
             flask_debug = True
@@ -423,11 +1035,19 @@ web_server.strict_slashes = False
 @web_server.route('/api/brake_lights', methods=['POST'])
 @web_server.route('/api/reverse_lights', methods=['POST'])
 @web_server.route('/api/indicators', methods=['POST'])
-def index():
+@web_server.route('/api/profile', methods=['POST'])
+@web_server.route('/api/macro', methods=['POST'])
+@web_server.route('/api/cars/<car>/<command>', methods=['POST'])
+def index(**kwargs):
     """
     Handle incoming HTTP requests.
 
     """
+    if config is not None:
+        try:
+            config.reload_if_changed()
+        except Exception:
+            traceback.print_exc()
     request_handler = RequestHandler()
     return request_handler.handle_request()
 
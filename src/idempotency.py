@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Idempotency
+***********
+
+This module contains the cache of recently executed idempotency keys. Clients
+that retry a request after a timeout send the same "Idempotency-Key", and the
+car skips the commands whose key it has already executed, so that for example
+a retried "change_up" does not shift twice.
+
+"""
+
+# Built in modules
+from collections import OrderedDict
+
+
+class IdempotencyCache:
+    """Bounded LRU cache of executed keys that expire after a time."""
+
+    def __init__(self, size: int = 1024, ttl: float = 60.0):
+        """
+        Constructor function.
+
+        :param size: Max number of keys, the least recently seen key is
+                     forgotten first.
+        :param ttl:  Seconds a key is remembered.
+
+        """
+        self.size = size
+        self.ttl = ttl
+        self.duplicates = 0
+        """(*int*) Number of duplicate keys seen."""
+        self._keys = OrderedDict()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def seen(self, key: str, now: float):
+        """
+        Check if a key has been executed and remember it.
+
+        :param key: Idempotency key.
+        :param now: Monotonic time.
+        :rtype:     bool
+        :return:    True if the key is a duplicate.
+
+        """
+        # Keys are ordered by last seen time, so expired keys are first
+        while self._keys:
+            oldest, seen_time = next(iter(self._keys.items()))
+            if now - seen_time <= self.ttl:
+                break
+            del self._keys[oldest]
+        duplicate = key in self._keys
+        if duplicate:
+            self.duplicates += 1
+            self._keys.move_to_end(key)
+        else:
+            # The size can be lowered while running, so drop until it fits
+            while len(self._keys) >= max(self.size, 1):
+                self._keys.popitem(last=False)
+        self._keys[key] = now
+        return duplicate
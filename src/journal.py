@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Journal
+*******
+
+This module contains the car flight recorder. It is a memory mapped ring of
+fixed size binary records that is always on, so that the last events before a
+problem can be decoded afterwards.
+
+The journal file starts with a header page holding the file geometry, the
+number of records written so far and a table of source names. After the header
+page follow the records. Each record holds a monotonic timestamp, a sequence
+number, an event type, a source id and a value.
+
+"""
+
+# Built in modules
+import argparse
+import csv
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+MAGIC = b'LCJRNL01'
+"""(*bytes*) Identifies a journal file."""
+
+HEADER = struct.Struct('<8sIIQ')
+"""(*Struct*) Magic, record size, record capacity and records written."""
+
+COUNTER_OFFSET = 16
+"""(*int*) Offset of the records written counter in the header."""
+
+SOURCE_NAME = struct.Struct('<32s')
+"""(*Struct*) One entry in the source name table."""
+
+SOURCE_TABLE_OFFSET = HEADER.size
+"""(*int*) Offset of the source name table."""
+
+MAX_SOURCES = 120
+"""(*int*) Max number of source names."""
+
+RECORDS_OFFSET = 4096
+"""(*int*) Offset of the first record."""
+
+RECORD = struct.Struct('<dIBBxxi')
+"""(*Struct*) Time, sequence number, event, source id and value."""
+
+COMMAND = 1
+"""(*int*) Command message received, value is the message number."""
+
+HANDLER_START = 2
+"""(*int*) Command handler started, value is the message number."""
+
+HANDLER_END = 3
+"""(*int*) Command handler finished, value is the message number."""
+
+SENSOR = 4
+"""(*int*) Sensor callback, value is the sensor value."""
+
+SHIFT = 5
+"""(*int*) Gear shift finished, value is the shift duration in ms."""
+
+PROFILE_STEP = 6
+"""(*int*) Motion profile step run, value is the timing error in us."""
+
+SKIP = 7
+"""(*int*) Command skipped since it would not change the car, value is the
+message number."""
+
+EVENT_NAMES = {COMMAND: 'command',
+               HANDLER_START: 'handler_start',
+               HANDLER_END: 'handler_end',
+               SENSOR: 'sensor',
+               SHIFT: 'shift',
+               PROFILE_STEP: 'profile_step',
+               SKIP: 'skip'}
+"""(*dict*) Event names used by the decoder."""
+
+
+class Journal:
+    """Memory mapped flight recorder journal."""
+
+    def __init__(self, path: str = None, records: int = 4096):
+        """
+        Constructor function.
+
+        An existing journal file with the same capacity is continued,
+        otherwise the file is created.
+
+        :param path:    Full path and name of journal file. The journal is
+                        kept in anonymous memory if not set.
+        :param records: Number of records before the journal wraps.
+
+        """
+        self._capacity = records
+        size = RECORDS_OFFSET + RECORD.size * records
+        self._file = None
+        if path is None:
+            self._mm = mmap.mmap(-1, size)
+            new = True
+        else:
+            new = not self._has_geometry(path, records)
+            self._file = open(path, 'r+b' if not new else 'w+b')
+            self._file.truncate(size)
+            self._mm = mmap.mmap(self._file.fileno(), size)
+        self._sources = {}
+        if new:
+            HEADER.pack_into(self._mm, 0, MAGIC, RECORD.size, records, 0)
+            self._written = 0
+        else:
+            self._written = HEADER.unpack_from(self._mm, 0)[3]
+            for source_id, name in enumerate(read_sources(self._mm)):
+                self._sources[name] = source_id
+
+    @staticmethod
+    def _has_geometry(path: str, records: int):
+        """
+        Check if a journal file exists with the wanted geometry.
+
+        :param path:    Full path and name of journal file.
+        :param records: Number of records.
+        :rtype:         bool
+        :return:        True if the file can be continued.
+
+        """
+        if not os.path.isfile(path):
+            return False
+        with open(path, 'rb') as file_obj:
+            header = file_obj.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return False
+        magic, record_size, capacity, _ = HEADER.unpack(header)
+        return (magic == MAGIC and record_size == RECORD.size and
+                capacity == records)
+
+    def _source_id(self, source: str):
+        """
+        Register a source name.
+
+        :param source: Source name.
+        :rtype:        int
+        :return:       Source id.
+
+        """
+        source_id = len(self._sources)
+        if source_id >= MAX_SOURCES:
+            source_id = MAX_SOURCES - 1
+        else:
+            SOURCE_NAME.pack_into(
+                self._mm, SOURCE_TABLE_OFFSET + source_id * SOURCE_NAME.size,
+                source.encode('utf-8')[:SOURCE_NAME.size])
+        self._sources[source] = source_id
+        return source_id
+
+    def write(self, event: int, source: str, value: int = 0):
+        """
+        Write one record.
+
+        :param event:  Event type, for example :data:`SENSOR`.
+        :param source: Source name, for example the command or sensor name.
+        :param value:  Event value.
+
+        """
+        source_id = self._sources.get(source)
+        if source_id is None:
+            source_id = self._source_id(source)
+        written = self._written
+        RECORD.pack_into(
+            self._mm,
+            RECORDS_OFFSET + (written % self._capacity) * RECORD.size,
+            time.monotonic(), written & 0xffffffff, event, source_id,
+            max(-0x80000000, min(0x7fffffff, int(value))))
+        self._written = written + 1
+        struct.pack_into('<Q', self._mm, COUNTER_OFFSET, self._written)
+
+    def close(self):
+        """
+        Close the journal.
+
+        """
+        self._mm.close()
+        if self._file is not None:
+            self._file.close()
+
+
+def read_sources(buffer):
+    """
+    Read the source name table.
+
+    :param buffer: Journal file contents.
+    :rtype:        list
+    :return:       Source names in id order.
+
+    """
+    sources = []
+    for source_id in range(MAX_SOURCES):
+        name = SOURCE_NAME.unpack_from(
+            buffer, SOURCE_TABLE_OFFSET + source_id * SOURCE_NAME.size)[0]
+        name = name.rstrip(b'\x00')
+        if not name:
+            break
+        sources.append(name.decode('utf-8', 'replace'))
+    return sources
+
+
+def decode_journal(path: str):
+    """
+    Decode a journal file, oldest record first.
+
+    :param path: Full path and name of journal file.
+    :rtype:      list
+    :return:     Records as dictionaries.
+
+    """
+    with open(path, 'rb') as file_obj:
+        buffer = file_obj.read()
+    magic, record_size, capacity, written = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC or record_size != RECORD.size:
+        raise ValueError("'{path}' is not a journal file".format(path=path))
+    sources = read_sources(buffer)
+    first = max(0, written - capacity)
+    records = []
+    for number in range(first, written):
+        offset = RECORDS_OFFSET + (number % capacity) * RECORD.size
+        timestamp, seq, event, source_id, value = RECORD.unpack_from(
+            buffer, offset)
+        source = (sources[source_id] if source_id < len(sources)
+                  else str(source_id))
+        records.append({'seq': number,
+                        'time': timestamp,
+                        'event': EVENT_NAMES.get(event, str(event)),
+                        'source': source,
+                        'value': value})
+    return records
+
+
+class Main:
+    """Contains the script"""
+
+    @staticmethod
+    def _parse_command_line_options():
+        """
+        Parse options from the command line.
+
+        :rtype: Namespace
+
+        """
+        description = 'Decode a legcocar flight recorder journal.'
+        parser = argparse.ArgumentParser(description=description)
+        parser.add_argument('journal', type=str,
+                            help='Full path and name of journal file.')
+        parser.add_argument('--format', '-f', choices=['csv', 'json'],
+                            default='csv', help='Output format.')
+        args = parser.parse_args()
+        return args
+
+    def run(self):
+        """
+        Run the script.
+
+        """
+        args = self._parse_command_line_options()
+        records = decode_journal(args.journal)
+        if args.format == 'json':
+            json.dump(records, sys.stdout, indent=4)
+            sys.stdout.write('\n')
+        else:
+            writer = csv.DictWriter(
+                sys.stdout, fieldnames=['seq', 'time', 'event', 'source',
+                                        'value'])
+            writer.writeheader()
+            writer.writerows(records)
+
+
+if __name__ == '__main__':
+    main = Main()
+    main.run()
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Light effects
+*************
+
+This module contains the light effects engine. One task drives the effects
+of all lights from a timer wheel, so that light commands return immediately
+and effects can be changed or cancelled while they are running. Brightness
+writes that fall in the same tick are sent together.
+
+"""
+
+# Third party modules
+import curio
+
+# Local modules
+from macros import check_light_args
+
+
+class Effect:
+    """Light effect base."""
+
+    def __init__(self):
+        self.light = None
+        """(*str*) Name of the light running the effect."""
+        self.due = None
+        """(*int*) Tick when the effect should step next."""
+
+    def step(self, tick_time: float, current: int):
+        """
+        Advance the effect.
+
+        :param tick_time: Seconds per engine tick.
+        :param current:   Current light brightness.
+        :rtype:           tuple
+        :return:          New brightness and seconds until the next step.
+                          The effect is finished if the time is None.
+
+        """
+        raise NotImplementedError
+
+
+class Steady(Effect):
+    """Light on, optionally for a limited time."""
+
+    def __init__(self, brightness: int, duration: float = 0):
+        """
+        Constructor function.
+
+        :param brightness: Brightness 0-100.
+        :param duration:   Seconds until the light goes off, 0 is forever.
+
+        """
+        super().__init__()
+        self.brightness = brightness
+        self.duration = duration
+        self._on = False
+
+    def step(self, tick_time: float, current: int):
+        if self._on:
+            return 0, None
+        self._on = True
+        if self.duration > 0 and self.brightness > 0:
+            return self.brightness, self.duration
+        return self.brightness, None
+
+
+class Blink(Effect):
+    """Light blinking on and off."""
+
+    def __init__(self, brightness: int, length: float = 0.5,
+                 interval: float = 0.75, duration: float = 0):
+        """
+        Constructor function.
+
+        :param brightness: Brightness 0-100 when on.
+        :param length:     Seconds the light is on each time.
+        :param interval:   Seconds between the light going on.
+        :param duration:   Seconds to blink, 0 is forever.
+
+        """
+        super().__init__()
+        self.brightness = brightness
+        self.length = length
+        self.interval = interval
+        self.duration = duration
+        self._elapsed = 0.0
+        self._on = False
+
+    def step(self, tick_time: float, current: int):
+        if self.duration > 0 and self._elapsed >= self.duration:
+            return 0, None
+        self._on = not self._on
+        if self._on:
+            return self.brightness, self.length
+        self._elapsed += self.interval
+        return 0, max(self.interval - self.length, tick_time)
+
+
+class Fade(Effect):
+    """Light fading from its current brightness to a target brightness."""
+
+    def __init__(self, brightness: int, fade_time: float = 1.0):
+        """
+        Constructor function.
+
+        :param brightness: Target brightness 0-100.
+        :param fade_time:  Seconds to fade.
+
+        """
+        super().__init__()
+        self.brightness = brightness
+        self.fade_time = fade_time
+        self._start = None
+        self._elapsed = 0.0
+
+    def step(self, tick_time: float, current: int):
+        if self._start is None:
+            self._start = current
+        self._elapsed += tick_time
+        if self._elapsed >= self.fade_time:
+            return self.brightness, None
+        fraction = self._elapsed / self.fade_time
+        brightness = self._start + (self.brightness - self._start) * fraction
+        return int(round(brightness)), tick_time
+
+
+class Pulse(Effect):
+    """Light brightness going up and down."""
+
+    def __init__(self, brightness: int, period: float = 1.0,
+                 duration: float = 0):
+        """
+        Constructor function.
+
+        :param brightness: Peak brightness 0-100.
+        :param period:     Seconds per pulse.
+        :param duration:   Seconds to pulse, 0 is forever.
+
+        """
+        super().__init__()
+        self.brightness = brightness
+        self.period = period
+        self.duration = duration
+        self._elapsed = 0.0
+
+    def step(self, tick_time: float, current: int):
+        if self.duration > 0 and self._elapsed >= self.duration:
+            return 0, None
+        phase = (self._elapsed % self.period) / self.period
+        self._elapsed += tick_time
+        brightness = self.brightness * (1 - abs(2 * phase - 1))
+        return int(round(brightness)), tick_time
+
+
+def effect_from_body(body: dict, effect: str = 'steady'):
+    """
+    Create an effect from a light command body.
+
+    :param body:   Light command body.
+    :param effect: Effect used if the body has no "effect".
+    :rtype:        Effect
+    :return:       The effect.
+    :raises:       ValueError
+
+    """
+    reason = check_light_args(body)
+    if reason is not None:
+        raise ValueError(reason)
+    effect = body.get('effect', effect)
+    brightness = body.get('brightness', 100)
+    duration = body.get('duration', 0)
+    if effect == 'blink':
+        return Blink(brightness=brightness,
+                     length=body.get('length', 0.5),
+                     interval=body.get('interval', 0.75),
+                     duration=duration)
+    elif effect == 'fade':
+        return Fade(brightness=brightness,
+                    fade_time=body.get('fade_time', 1.0))
+    elif effect == 'pulse':
+        return Pulse(brightness=brightness,
+                     period=body.get('period', 1.0),
+                     duration=duration)
+    return Steady(brightness=brightness, duration=duration)
+
+
+class LightEffects:
+    """Runs the effects of all lights on a hub."""
+
+    def __init__(self, hub, tick_time: float = 0.05, wheel_size: int = 64,
+                 write=None, on_finish=None):
+        """
+        Constructor function.
+
+        :param hub:        Hub with the lights attached.
+        :param tick_time:  Seconds per tick.
+        :param wheel_size: Number of timer wheel slots.
+        :param write:      Coroutine function called with a peripheral method
+                           and its arguments to write to the hub. The method
+                           is called directly if not set.
+        :param on_finish:  Function called with the light name and its last
+                           brightness when an effect ends by itself.
+
+        """
+        self._hub = hub
+        self._write = write
+        self._on_finish = on_finish
+        self._tick_time = tick_time
+        self._wheel = [[] for _ in range(wheel_size)]
+        self._tick = 0
+        self._effects = {}
+        self.brightness = {}
+        """(*dict*) Light name => last written brightness."""
+        self.writes = 0
+        """(*int*) Number of brightness writes."""
+
+    def set_effect(self, light: str, effect: Effect):
+        """
+        Start an effect on a light, replacing any running effect.
+
+        :param light:  Light name.
+        :param effect: Effect to start.
+
+        """
+        effect.light = light
+        self._effects[light] = effect
+        self._schedule(effect, self._tick + 1)
+
+    def cancel(self, light: str):
+        """
+        Stop the effect of a light and turn it off.
+
+        :param light: Light name.
+
+        """
+        self.set_effect(light, Steady(brightness=0))
+
+    def is_running(self, light: str):
+        """
+        Check if a light has an effect running.
+
+        :param light: Light name.
+        :rtype:       bool
+        :return:      True if an effect is running.
+
+        """
+        return light in self._effects
+
+    def _schedule(self, effect: Effect, tick: int):
+        effect.due = tick
+        self._wheel[tick % len(self._wheel)].append(effect)
+
+    def _advance(self):
+        """
+        Step all effects due in the next tick.
+
+        :rtype:  dict
+        :return: Light name => brightness to write.
+
+        """
+        self._tick += 1
+        slot = self._wheel[self._tick % len(self._wheel)]
+        due = [effect for effect in slot if effect.due == self._tick]
+        slot[:] = [effect for effect in slot if effect.due != self._tick]
+        writes = {}
+        for effect in due:
+            # Skip effects that have been replaced
+            if self._effects.get(effect.light) is not effect:
+                continue
+            brightness, delay = effect.step(
+                self._tick_time, self.brightness.get(effect.light, 0))
+            writes[effect.light] = brightness
+            if delay is None:
+                del self._effects[effect.light]
+                if self._on_finish is not None:
+                    self._on_finish(effect.light, brightness)
+            else:
+                ticks = max(1, int(round(delay / self._tick_time)))
+                self._schedule(effect, self._tick + ticks)
+        return {light: brightness for light, brightness in writes.items()
+                if self.brightness.get(light) != brightness}
+
+    async def run(self, sleep=curio.sleep):
+        """
+        Run the engine.
+
+        :param sleep: Sleep coroutine function.
+
+        """
+        while True:
+            await sleep(self._tick_time)
+            writes = self._advance()
+            if not writes:
+                continue
+            # Send all writes of this tick together, lights that are not
+            # attached are skipped
+            async with curio.TaskGroup() as group:
+                for light, brightness in writes.items():
+                    peripheral = getattr(self._hub, light, None)
+                    if peripheral is None:
+                        continue
+                    if self._write is not None:
+                        await group.spawn(self._write,
+                                          peripheral.set_brightness,
+                                          brightness)
+                    else:
+                        await group.spawn(peripheral.set_brightness,
+                                          brightness)
+            self.brightness.update(writes)
+            self.writes += len(writes)
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Link monitor
+************
+
+This module contains the BLE link monitor and the command pacer. The monitor
+measures the write latency and notification rate of a hub and keeps a moving
+estimate of the write bandwidth of the link. The pacer uses the estimate to
+decide how long the dispatcher waits after a command and how many queued
+commands are coalesced, instead of fixed sleeps.
+
+Writes only queue a message to the BLE layer and return right away, so the
+latency is measured as the round trip from a sensor value request to the
+notification that answers it.
+
+"""
+
+# Built in modules
+import math
+
+
+class LinkMonitor:
+    """Measures the BLE link of one hub."""
+
+    def __init__(self, alpha: float = 0.2, default_latency: float = 0.02,
+                 window: float = 1.0, max_latency: float = 1.0):
+        """
+        Constructor function.
+
+        :param alpha:           Smoothing factor of the moving averages.
+        :param default_latency: Write latency assumed before the first
+                                measured round trip (seconds).
+        :param window:          Notifications are counted over windows of
+                                this many seconds, since they arrive in
+                                bursts.
+        :param max_latency:     Requests not answered within this many
+                                seconds are not measured.
+
+        """
+        self.alpha = alpha
+        self.window = window
+        self.max_latency = max_latency
+        self.latency = default_latency
+        """(*float*) Moving average write round trip in seconds."""
+        self.latency_max = 0.0
+        """(*float*) Max write round trip in seconds."""
+        self.writes = 0
+        """(*int*) Number of writes."""
+        self.notifications = 0
+        """(*int*) Number of sensor notifications."""
+        self.notification_rate = 0.0
+        """(*float*) Moving average notifications per second."""
+        self.last_notification = None
+        """(*float*) Monotonic time of the last notification."""
+        self._window_start = None
+        self._window_count = 0
+        self._pending = {}
+
+    def write_started(self, now: float, name: str = None):
+        """
+        Register a write.
+
+        :param now:  Monotonic time.
+        :param name: Name of the peripheral that answers the write with a
+                     notification, the round trip is measured if set.
+
+        """
+        self.writes += 1
+        # The round trip is measured from the first unanswered write
+        sent = self._pending.get(name)
+        if name is not None and (sent is None or
+                                 now - sent > self.max_latency):
+            self._pending[name] = now
+
+    def notification(self, now: float, name: str = None):
+        """
+        Register a sensor notification.
+
+        :param now:  Monotonic time.
+        :param name: Name of the notifying peripheral, it answers a pending
+                     write to the peripheral.
+
+        """
+        self.notifications += 1
+        self.last_notification = now
+        sent = self._pending.pop(name, None)
+        if sent is not None and now - sent <= self.max_latency:
+            latency = now - sent
+            self.latency += self.alpha * (latency - self.latency)
+            self.latency_max = max(self.latency_max, latency)
+        if self._window_start is None:
+            self._window_start = now
+        self._window_count += 1
+        elapsed = now - self._window_start
+        if elapsed >= self.window:
+            self.notification_rate += self.alpha * (
+                self._window_count / elapsed - self.notification_rate)
+            self._window_start = now
+            self._window_count = 0
+
+    def bandwidth(self):
+        """
+        Estimate the write bandwidth of the link.
+
+        :rtype:  float
+        :return: Writes per second.
+
+        """
+        return 1 / max(self.latency, 1e-6)
+
+    def stats(self):
+        """
+        Get the link statistics.
+
+        :rtype:  dict
+        :return: Latency in ms, writes, notifications and bandwidth.
+
+        """
+        return {'latency_ms': round(self.latency * 1000, 3),
+                'latency_max_ms': round(self.latency_max * 1000, 3),
+                'writes': self.writes,
+                'notifications': self.notifications,
+                'notification_rate': round(self.notification_rate, 2),
+                'bandwidth': round(self.bandwidth(), 1)}
+
+
+class Pacer:
+    """Paces and coalesces commands to match the link bandwidth."""
+
+    def __init__(self,
+                 monitor: LinkMonitor,
+                 min_write_time: float = 0.01,
+                 headroom: float = 0.2,
+                 max_delay: float = 0.5,
+                 command_interval: float = 0.05,
+                 max_batch: int = 20,
+                 min_poll: float = 0.01,
+                 max_poll: float = 0.1):
+        """
+        Constructor function.
+
+        :param monitor:          Link monitor of the hub.
+        :param min_write_time:   Min link time of a write (seconds), used
+                                 when the measured round trip is shorter.
+        :param headroom:         Link time left free after the writes of a
+                                 command for sensor notifications and
+                                 background writes, as a fraction of their
+                                 write time.
+        :param max_delay:        Max wait after a command (seconds), so that
+                                 a degraded link does not stall the
+                                 dispatcher.
+        :param command_interval: Expected interval between incoming commands
+                                 (seconds). Commands are coalesced when they
+                                 need more link time than this.
+        :param max_batch:        Max number of commands coalesced at once.
+        :param min_poll:         Queue poll interval right after a command
+                                 (seconds).
+        :param max_poll:         Queue poll interval when idle (seconds).
+
+        """
+        self.monitor = monitor
+        self.min_write_time = min_write_time
+        self.headroom = headroom
+        self.max_delay = max_delay
+        self.command_interval = command_interval
+        self.max_batch = max_batch
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.writes_per_command = 1.0
+        """(*float*) Moving average hub writes per command."""
+        self._poll = min_poll
+
+    def write_time(self):
+        """
+        Get the link time of a write, including the headroom.
+
+        :rtype:  float
+        :return: Seconds.
+
+        """
+        return (max(self.monitor.latency, self.min_write_time) *
+                (1 + self.headroom))
+
+    def command_done(self, writes: int):
+        """
+        Register the hub writes of a handled command.
+
+        :param writes: Number of writes the command made.
+        :rtype:        float
+        :return:       Seconds to wait before the next command. The writes
+                       are only queued, so this is the link time they need.
+
+        """
+        self.writes_per_command += self.monitor.alpha * (
+            writes - self.writes_per_command)
+        self._poll = self.min_poll
+        return min(self.max_delay, writes * self.write_time())
+
+    def batch_size(self):
+        """
+        Get the number of queued commands to coalesce.
+
+        :rtype:  int
+        :return: 1 when the link keeps up with the commands, more when it
+                 does not.
+
+        """
+        cost = self.writes_per_command * self.write_time()
+        return max(1, min(self.max_batch,
+                          math.ceil(cost / self.command_interval)))
+
+    def idle(self):
+        """
+        Get the queue poll interval when no command was received. The
+        interval grows while idle.
+
+        :rtype:  float
+        :return: Seconds to wait.
+
+        """
+        poll = self._poll
+        self._poll = min(self.max_poll, self._poll * 2)
+        return poll
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Macros
+******
+
+This module contains the macro compiler. Macros are named command sequences,
+for example a launch or a parking light sequence, defined in the config file
+under "MACROS". They are validated and compiled once when the car control
+starts, and a single "macro" command then runs the whole sequence in the car.
+
+A macro is a list of steps. Each step is a command body with the command name
+in "command" and the time to run it in "time", in seconds from the macro
+start::
+
+    MACROS:
+        launch:
+        -   {time: 0, command: headlights, brightness: 100}
+        -   {time: 0, command: gearbox, gear: 1}
+        -   {time: 0.5, command: speed, speed: 100}
+        -   {time: 3, command: gearbox, gear: 2}
+
+"""
+
+LIGHT_ARGS = {'brightness': 'int',
+              'duration': 'int',
+              'effect': 'str',
+              'length': 'float',
+              'interval': 'float',
+              'period': 'float',
+              'fade_time': 'float'}
+"""(*dict*) Arguments of the light commands."""
+
+LIGHT_EFFECTS = ('steady', 'blink', 'fade', 'pulse')
+"""(*tuple*) Effects of the light commands."""
+
+LIGHT_TIMES = ('length', 'interval', 'period', 'fade_time')
+"""(*tuple*) Light command arguments that are times in seconds, they must be
+more than 0."""
+
+MACRO_COMMANDS = {
+    'speed': {'speed': 'int'},
+    'steering': {'position': 'int',
+                 'speed': 'int',
+                 'max_power': 'int'},
+    'gearbox': {'change_up': 'bool',
+                'change_down': 'bool',
+                'gear_number': 'int',
+                'gear': 'int',
+                'speed': 'int',
+                'max_power': 'int',
+                'adjust': 'int',
+                'offset': 'float'},
+    'headlights': LIGHT_ARGS,
+    'high_beams': LIGHT_ARGS,
+    'tail_lights': LIGHT_ARGS,
+    'brake_lights': LIGHT_ARGS,
+    'reverse_lights': LIGHT_ARGS,
+    'indicators': {**LIGHT_ARGS, 'left': 'bool', 'right': 'bool'}}
+"""(*dict*) Commands that can be used in macros and the type of their
+arguments."""
+
+MANDATORY_ARGS = {'speed': ('speed',)}
+"""(*dict*) Mandatory arguments of macro commands."""
+
+MAX_MACRO_STEPS = 1000
+"""(*int*) Max number of steps in a macro."""
+
+MAX_MACRO_TIME = 600
+"""(*int*) Max time of a macro step in seconds."""
+
+_TYPES = {'int': (int,),
+          'float': (int, float),
+          'bool': (bool,),
+          'str': (str,)}
+
+
+class MacroError(ValueError):
+    """Invalid macro definition."""
+
+    def __init__(self, name: str, step: int, reason: str):
+        message = "Macro '{name}' step {step} is invalid, {reason}".format(
+            name=name, step=step, reason=reason)
+        super().__init__(message)
+
+
+def check_light_args(args: dict):
+    """
+    Check the values of light command arguments. The argument types must be
+    checked first.
+
+    :param args: Light command arguments.
+    :rtype:      str
+    :return:     Why the arguments are invalid, None if they are valid.
+
+    """
+    if 'effect' in args and args['effect'] not in LIGHT_EFFECTS:
+        return "'effect' must be one of {}".format(', '.join(LIGHT_EFFECTS))
+    for arg in LIGHT_TIMES:
+        # Also rejects NaN
+        if arg in args and not args[arg] > 0:
+            return "'{}' must be more than 0".format(arg)
+    return None
+
+
+def _compile_step(name: str, number: int, step, last_time: float):
+    """
+    Validate and compile one macro step.
+
+    :param name:      Macro name.
+    :param number:    Step number.
+    :param step:      Step definition.
+    :param last_time: Time of the previous step.
+    :rtype:           tuple
+    :return:          Step time and command body.
+    :raises:          MacroError
+
+    """
+    if type(step) != dict:
+        raise MacroError(name, number, 'step is not a mapping')
+    body = dict(step)
+    step_time = body.pop('time', None)
+    if (type(step_time) not in (int, float) or
+            not last_time <= step_time <= MAX_MACRO_TIME):
+        raise MacroError(
+            name, number, "'time' must be a number from the previous step "
+                          "time to {}".format(MAX_MACRO_TIME))
+    command = body.get('command')
+    if command not in MACRO_COMMANDS:
+        raise MacroError(
+            name, number, "'command' must be one of {}".format(
+                ', '.join(sorted(MACRO_COMMANDS))))
+    args = MACRO_COMMANDS[command]
+    for arg in MANDATORY_ARGS.get(command, ()):
+        if arg not in body:
+            raise MacroError(name, number, "'{}' is missing".format(arg))
+    for arg, value in body.items():
+        if arg == 'command':
+            continue
+        if arg not in args:
+            raise MacroError(name, number, "'{}' is invalid".format(arg))
+        # bool is an int subclass, so the type is compared exactly
+        if type(value) not in _TYPES[args[arg]]:
+            raise MacroError(name, number, "'{arg}' must be a {type}".format(
+                arg=arg, type=args[arg]))
+    if 'effect' in args:
+        reason = check_light_args(body)
+        if reason is not None:
+            raise MacroError(name, number, reason)
+    return float(step_time), body
+
+
+def compile_macros(definitions: dict):
+    """
+    Validate and compile macro definitions.
+
+    :param definitions: Macro name => list of steps, as read from the config
+                        file.
+    :rtype:             dict
+    :return:            Macro name => tuple of (time, command body) steps.
+    :raises:            MacroError
+
+    """
+    macros = {}
+    for name, steps in (definitions or {}).items():
+        if type(steps) != list or not 0 < len(steps) <= MAX_MACRO_STEPS:
+            raise MacroError(name, 0, 'a macro must be a list of 1-{} '
+                                      'steps'.format(MAX_MACRO_STEPS))
+        compiled = []
+        last_time = 0
+        for number, step in enumerate(steps):
+            step_time, body = _compile_step(name, number, step, last_time)
+            compiled.append((step_time, body))
+            last_time = step_time
+        macros[str(name)] = tuple(compiled)
+    return macros
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+In-memory broker
+****************
+
+This module contains an in-memory stand-in for the subset of the pika
+blocking channel API that legcocar uses. It is used for benchmarks and
+offline runs where no RabbitMQ server is available.
+
+"""
+
+# Built in modules
+import threading
+import time
+from collections import deque
+
+
+def _words_match(words: list, keys: list):
+    if not words:
+        return not keys
+    if words[0] == '#':
+        return any(_words_match(words[1:], keys[start:])
+                   for start in range(len(keys) + 1))
+    return (bool(keys) and words[0] in ('*', keys[0]) and
+            _words_match(words[1:], keys[1:]))
+
+
+def topic_matches(pattern: str, routing_key: str):
+    """
+    Check if a routing key matches a topic binding pattern, where "*" matches
+    one word and "#" matches zero or more words.
+
+    :param pattern:     Binding pattern.
+    :param routing_key: Routing key.
+    :rtype:             bool
+    :return:            True if the key matches.
+
+    """
+    return _words_match(pattern.split('.'), routing_key.split('.'))
+
+
+class MethodFrame:
+    """Delivery information returned by basic_get."""
+
+    def __init__(self, delivery_tag: int, routing_key: str):
+        """
+        Constructor function.
+
+        :param delivery_tag: Delivery tag used to ack the message.
+        :param routing_key:  Routing key the message was published with.
+
+        """
+        self.delivery_tag = delivery_tag
+        self.routing_key = routing_key
+
+
+class InMemoryBroker:
+    """Thread safe in-memory message broker."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._arguments = {}
+        self._bindings = {}
+        self._unacked = {}
+        self._delivery_tag = 0
+        self.published = 0
+        self.acked = 0
+        self.dropped = 0
+        """(*int*) Messages dropped by queue TTL or max length."""
+        self.last_delivery = None
+        """(*dict*) Message info of the last message delivered by
+        basic_get."""
+
+    def connection(self):
+        """
+        Create a connection to the broker.
+
+        :rtype:  InMemoryConnection
+        :return: New connection.
+
+        """
+        return InMemoryConnection(self)
+
+    def queue_size(self, queue: str):
+        """
+        Get number of messages waiting in a queue.
+
+        :param queue: Queue name.
+        :rtype:       int
+        :return:      Number of messages.
+
+        """
+        with self._lock:
+            return len(self._queues.get(queue, ()))
+
+    def declare(self, queue: str, arguments: dict = None):
+        with self._lock:
+            self._queues.setdefault(queue, deque())
+            self._arguments[queue] = arguments or {}
+
+    def declare_exchange(self, exchange: str):
+        with self._lock:
+            self._bindings.setdefault(exchange, [])
+
+    def bind(self, queue: str, exchange: str, routing_key: str):
+        with self._lock:
+            bindings = self._bindings.setdefault(exchange, [])
+            if (routing_key, queue) not in bindings:
+                bindings.append((routing_key, queue))
+
+    def _expire(self, queue: str, now: float):
+        """
+        Drop messages older than the message TTL of a queue.
+
+        :param queue: Queue name.
+        :param now:   Current time.
+
+        """
+        ttl = self._arguments[queue].get('x-message-ttl')
+        messages = self._queues[queue]
+        while ttl is not None and messages and (
+                now - messages[0]['published']) * 1000 > ttl:
+            messages.popleft()
+            self.dropped += 1
+
+    def publish(self, routing_key: str, body, exchange: str = ''):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        with self._lock:
+            # The default exchange routes to the queue named by the key
+            if exchange == '':
+                queues = [routing_key] if routing_key in self._queues else []
+            else:
+                queues = [queue for pattern, queue
+                          in self._bindings.get(exchange, ())
+                          if topic_matches(pattern, routing_key)]
+            # Just like RabbitMQ, unroutable messages are dropped
+            now = time.perf_counter()
+            for queue in queues:
+                messages = self._queues[queue]
+                max_length = self._arguments[queue].get('x-max-length')
+                if max_length is not None and len(messages) >= max_length:
+                    messages.popleft()
+                    self.dropped += 1
+                messages.append({'body': body,
+                                 'routing_key': routing_key,
+                                 'published': now})
+                self.published += 1
+
+    def get(self, queue: str):
+        with self._lock:
+            messages = self._queues.get(queue)
+            if messages:
+                self._expire(queue, time.perf_counter())
+            if not messages:
+                return None, None, None
+            message = messages.popleft()
+            message['delivered'] = time.perf_counter()
+            self._delivery_tag += 1
+            self._unacked[self._delivery_tag] = message
+            self.last_delivery = message
+            method_frame = MethodFrame(self._delivery_tag,
+                                       message['routing_key'])
+            return method_frame, None, message['body']
+
+    def ack(self, delivery_tag: int):
+        with self._lock:
+            del self._unacked[delivery_tag]
+            self.acked += 1
+
+
+class InMemoryConnection:
+    """Connection to an in-memory broker."""
+
+    def __init__(self, broker: InMemoryBroker):
+        self._broker = broker
+
+    def channel(self):
+        """
+        Open a channel.
+
+        :rtype:  InMemoryChannel
+        :return: New channel.
+
+        """
+        return InMemoryChannel(self._broker)
+
+    def close(self):
+        """
+        Close connection.
+
+        """
+
+
+class InMemoryChannel:
+    """Channel to an in-memory broker, mimics pika BlockingChannel."""
+
+    def __init__(self, broker: InMemoryBroker):
+        self._broker = broker
+
+    def queue_declare(self, queue: str, arguments: dict = None, **kwargs):
+        """
+        Declare a queue.
+
+        :param queue:     Queue name.
+        :param arguments: Queue arguments, "x-message-ttl" and "x-max-length"
+                          are supported. The oldest message is dropped when
+                          the queue is full.
+
+        """
+        self._broker.declare(queue, arguments)
+
+    def exchange_declare(self, exchange: str, exchange_type: str = 'direct',
+                         **kwargs):
+        """
+        Declare an exchange. All exchanges route like topic exchanges, which
+        also covers exact keys.
+
+        :param exchange:      Exchange name.
+        :param exchange_type: Ignored exchange type.
+
+        """
+        self._broker.declare_exchange(exchange)
+
+    def queue_bind(self, queue: str, exchange: str, routing_key: str = None):
+        """
+        Bind a queue to an exchange.
+
+        :param queue:       Queue name.
+        :param exchange:    Exchange name.
+        :param routing_key: Binding pattern, the queue name if not set.
+
+        """
+        self._broker.bind(queue, exchange, routing_key or queue)
+
+    def basic_publish(self, exchange: str, routing_key: str, body,
+                      properties=None):
+        """
+        Publish a message.
+
+        :param exchange:    Exchange name, '' is the default exchange.
+        :param routing_key: Routing key.
+        :param body:        Message body.
+        :param properties:  Ignored message properties.
+
+        """
+        self._broker.publish(routing_key=routing_key, body=body,
+                             exchange=exchange)
+
+    def basic_get(self, queue: str):
+        """
+        Get one message from a queue.
+
+        :param queue: Queue name.
+        :rtype:       tuple
+        :return:      Method frame, header frame and body. All are None if the
+                      queue is empty.
+
+        """
+        return self._broker.get(queue)
+
+    def basic_ack(self, delivery_tag: int):
+        """
+        Acknowledge a message.
+
+        :param delivery_tag: Delivery tag of the message.
+
+        """
+        self._broker.ack(delivery_tag)
+
+    def close(self):
+        """
+        Close channel.
+
+        """
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Recorder
+********
+
+This module records and replays "to_lego" command streams.
+
+A recording is an append-only binary file. Each record is the arrival time as
+a little endian double, the body length as a little endian unsigned int and
+then the raw message body.
+
+Every recording session starts with a session header record, with the wall
+clock start time (seconds since epoch) and the length :data:`SESSION_HEADER`
+and no body. The arrival times of the records after it are monotonic seconds
+since the start, so that clock adjustments during a recording don't skew the
+replay. Recordings from before session headers have arrival times in seconds
+since epoch, and are read the same way.
+
+"""
+
+# Built in modules
+import argparse
+import json
+import struct
+import sys
+import time
+
+# Local modules
+from routing import EXCHANGE, declare_queues, routing_key
+
+RECORD_HEADER = struct.Struct('<dI')
+"""(*Struct*) Header of each record, arrival time and body length."""
+
+SESSION_HEADER = 0xFFFFFFFF
+"""(*int*) Body length of session header records."""
+
+
+def read_recording(path: str):
+    """
+    Read records from a recording.
+
+    A truncated last record, for example after a crash, is ignored.
+
+    :param path: Full path and name of recording file.
+    :rtype:      generator
+    :return:     (timestamp, body) tuples, the timestamp is the arrival time
+                 in seconds since epoch.
+
+    """
+    start = 0.0
+    with open(path, 'rb') as file_obj:
+        while True:
+            header = file_obj.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, length = RECORD_HEADER.unpack(header)
+            if length == SESSION_HEADER:
+                start = timestamp
+                continue
+            body = file_obj.read(length)
+            if len(body) < length:
+                return
+            yield start + timestamp, body
+
+
+class CommandRecorder:
+    """Appends command messages to a recording file."""
+
+    def __init__(self, path: str):
+        """
+        Constructor function.
+
+        :param path: Full path and name of recording file.
+
+        """
+        self._file = open(path, 'ab')
+        self._start = time.monotonic()
+        self._file.write(RECORD_HEADER.pack(time.time(), SESSION_HEADER))
+        self._file.flush()
+
+    def record(self, body, timestamp: float = None):
+        """
+        Append one message to the recording.
+
+        :param body:      Raw message body.
+        :param timestamp: Monotonic arrival time, now if not set.
+
+        """
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if timestamp is None:
+            timestamp = time.monotonic()
+        self._file.write(RECORD_HEADER.pack(timestamp - self._start,
+                                            len(body)) + body)
+        self._file.flush()
+
+    def close(self):
+        """
+        Close the recording file.
+
+        """
+        self._file.close()
+
+
+class CommandReplayer:
+    """Publishes recorded messages with their original timing."""
+
+    def __init__(self, channel, queue: str = 'to_lego', speed: float = 1.0):
+        """
+        Constructor function.
+
+        :param channel: Broker channel to publish to.
+        :param queue:   Queue of the car to replay to, messages are routed to
+                        its class queues.
+        :param speed:   Replay speed factor, 1 is the original speed. 0
+                        replays as fast as possible.
+
+        """
+        self._channel = channel
+        self._queue = queue
+        self._speed = speed
+
+    def replay(self, records):
+        """
+        Replay records.
+
+        :param records: (timestamp, body) tuples, see :func:`read_recording`.
+        :rtype:         list
+        :return:        How late each message was published in seconds.
+
+        """
+        lateness = []
+        first = None
+        start = time.perf_counter()
+        for timestamp, body in records:
+            if first is None:
+                first = timestamp
+            if self._speed > 0:
+                due = start + (timestamp - first) / self._speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                lateness.append(max(0.0, time.perf_counter() - due))
+            else:
+                lateness.append(0.0)
+            command = json.loads(body.decode('utf-8'))['command']
+            self._channel.basic_publish(
+                exchange=EXCHANGE,
+                routing_key=routing_key(self._queue, command),
+                body=body)
+        return lateness
+
+
+class Main:
+    """Contains the script"""
+
+    @staticmethod
+    def _parse_command_line_options():
+        """
+        Parse options from the command line.
+
+        :rtype: Namespace
+
+        """
+        description = 'Replay or print a recorded legcocar command stream.'
+        parser = argparse.ArgumentParser(description=description)
+        parser.add_argument('action', choices=['replay', 'print'],
+                            help='Replay to RabbitMQ or print as JSON lines.')
+        parser.add_argument('recording', type=str,
+                            help='Full path and name of recording file.')
+        parser.add_argument('--speed', type=float, default=1.0,
+                            help='Replay speed factor, 0 is max speed.')
+        parser.add_argument('--queue', type=str, default='to_lego',
+                            help='Queue of the car to replay to.')
+        args = parser.parse_args()
+        return args
+
+    def run(self):
+        """
+        Run the script.
+
+        """
+        args = self._parse_command_line_options()
+        records = read_recording(args.recording)
+        if args.action == 'print':
+            for timestamp, body in records:
+                sys.stdout.write('{{"time": {timestamp}, "body": {body}}}\n'
+                                 .format(timestamp=timestamp,
+                                         body=body.decode('utf-8')))
+            return
+        import pika
+        connection = pika.BlockingConnection(
+            pika.ConnectionParameters(host='localhost'))
+        channel = connection.channel()
+        declare_queues(channel, args.queue)
+        replayer = CommandReplayer(channel=channel, queue=args.queue,
+                                   speed=args.speed)
+        lateness = replayer.replay(records)
+        channel.close()
+        connection.close()
+        if lateness:
+            print('Replayed {count} messages, max lateness {late:.1f} ms'
+                  .format(count=len(lateness), late=max(lateness) * 1000))
+
+
+if __name__ == '__main__':
+    main = Main()
+    main.run()
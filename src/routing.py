@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Routing
+*******
+
+This module contains the command routing. Commands are published to a topic
+exchange with the routing key "<car queue>.<class>", for example
+"to_lego.drive" or "to_lego.hub2.gear", and each command class has its own
+queue. Latency critical drive and steering input is then not queued behind
+slow gearbox and light commands, and each class has its own TTL and max length
+so that stale input is dropped by the broker.
+
+The exchange and the queues of the default car are declared by
+*other/rabbitmq_definitions.json*, the queues of other cars are declared by
+the car control. The queue settings below must match the definitions file.
+
+"""
+
+EXCHANGE = 'legcocar'
+"""(*str*) Topic exchange commands are published to."""
+
+COMMAND_CLASSES = {'speed': 'drive',
+                   'profile': 'drive',
+                   'macro': 'drive',
+                   'steering': 'steer',
+                   'gearbox': 'gear',
+                   'headlights': 'lights',
+                   'high_beams': 'lights',
+                   'tail_lights': 'lights',
+                   'brake_lights': 'lights',
+                   'reverse_lights': 'lights',
+                   'indicators': 'lights'}
+"""(*dict*) Command => command class."""
+
+QUEUE_CLASSES = {'drive': {'prefetch': 4, 'ttl': 1000, 'max_length': 10},
+                 'steer': {'prefetch': 4, 'ttl': 1000, 'max_length': 10},
+                 'gear': {'prefetch': 1, 'ttl': 10000, 'max_length': 10},
+                 'lights': {'prefetch': 1, 'ttl': 10000, 'max_length': 50}}
+"""(*dict*) Command class => queue settings. "prefetch" is the number of
+messages the car takes from the queue before it turns to the next class,
+"ttl" is the message TTL in milliseconds and "max_length" is the max number of
+messages, the oldest are dropped first."""
+
+
+def routing_key(queue: str, command: str):
+    """
+    Get the routing key of a command.
+
+    :param queue:   Queue of the car, for example "to_lego".
+    :param command: Command name.
+    :rtype:         str
+    :return:        Routing key, also the name of the class queue.
+
+    """
+    return '{queue}.{cls}'.format(queue=queue, cls=COMMAND_CLASSES[command])
+
+
+def class_queues(queues: tuple):
+    """
+    Get the class queues of cars.
+
+    :param queues: Queues of the cars.
+    :rtype:        list
+    :return:       (class queue name, prefetch) tuples.
+
+    """
+    return [('{queue}.{cls}'.format(queue=queue, cls=cls),
+             settings['prefetch'])
+            for queue in queues for cls, settings in QUEUE_CLASSES.items()]
+
+
+def declare_queues(channel, queue: str):
+    """
+    Declare the exchange and the class queues of a car, and bind them.
+
+    :param channel: Broker channel.
+    :param queue:   Queue of the car.
+
+    """
+    channel.exchange_declare(exchange=EXCHANGE, exchange_type='topic',
+                             durable=True)
+    for cls, settings in QUEUE_CLASSES.items():
+        name = '{queue}.{cls}'.format(queue=queue, cls=cls)
+        channel.queue_declare(
+            queue=name,
+            arguments={'x-message-ttl': settings['ttl'],
+                       'x-max-length': settings['max_length'],
+                       'x-overflow': 'drop-head'})
+        channel.queue_bind(queue=name, exchange=EXCHANGE, routing_key=name)
+
+
+class WeightedQueues:
+    """Gets messages from several queues with weighted fairness."""
+
+    def __init__(self, queues: list):
+        """
+        Constructor function.
+
+        :param queues: (queue name, weight) tuples. Up to weight messages are
+                       taken from a queue before turning to the next one.
+
+        """
+        self.queues = queues
+        self._index = 0
+        self._credit = queues[0][1] if queues else 0
+
+    def get(self, channel):
+        """
+        Get the next message, in deficit round robin order over the queues
+        that have messages. Every queue is polled at most once, the round
+        stops at the first queue that was already found empty.
+
+        :param channel: Broker channel.
+        :rtype:         tuple
+        :return:        Method frame, header frame and body. All are None if
+                        all queues are empty.
+
+        """
+        empty = set()
+        for _ in range(len(self.queues) + 1):
+            if self._index in empty:
+                break
+            name, weight = self.queues[self._index]
+            if self._credit > 0:
+                method_frame, header_frame, body = channel.basic_get(
+                    queue=name)
+                if method_frame is not None:
+                    self._credit -= 1
+                    return method_frame, header_frame, body
+                empty.add(self._index)
+            self._index = (self._index + 1) % len(self.queues)
+            self._credit = self.queues[self._index][1]
+        return None, None, None
@@ -7,13 +7,306 @@ Settings
 
 This module contains settings.
 
+The settings are read from the YAML config file and converted to the type
+given by :data:`SCHEMA`. The parsed file is cached by its modification time
+and size, so loading it again is free until the file changes, and
+:meth:`Settings.reload_if_changed` lets running processes pick up changes
+without a restart. :func:`write_yaml` writes settings back in one pass and
+keeps the text, comments and styles of the file.
+
 """
 
-import yaml
+import gc
 import os
-import re
+import time
 from shutil import copyfile
 
+SCHEMA = {'VERSION': 'str',
+          'LOG_VERBOSITY': 'int',
+          'SYSTEM_LOG': 'str',
+          'MESSAGE_LOG': 'str',
+          'ERROR_LOG': 'str',
+          'JOURNAL_FILE': 'str',
+          'JOURNAL_RECORDS': 'int',
+          'CALIBRATION_FILE': 'str',
+          'STATE_FILE': 'str',
+          'HUBS': 'list',
+          'HARDWARE': 'dict',
+          'MACROS': 'dict',
+          'WORKER_STATUS_FILE': 'str',
+          'PORT_MAP_FILE': 'str',
+          'RECONNECT_MIN_BACKOFF': 'float',
+          'RECONNECT_MAX_BACKOFF': 'float',
+          'COMMAND_EXPIRY': 'float',
+          'IDEMPOTENCY_CACHE_SIZE': 'int',
+          'IDEMPOTENCY_TTL': 'float',
+          'INPUT_FILTERS': 'dict',
+          'INPUT_FILTER_SESSION_TIMEOUT': 'float',
+          'SETTINGS_RELOAD_INTERVAL': 'float'}
+"""(*dict*) Setting => type. Settings that are not in the schema get their
+type from their value. Any setting can be null."""
+
+
+class SettingsError(ValueError):
+    """Invalid setting value."""
+
+    def __init__(self, param: str, type_: str, value):
+        message = "Setting '{param}' must be of type {type}, not {value!r}"
+        message = message.format(param=param, type=type_, value=value)
+        super().__init__(message)
+
+
+def _to_int(value):
+    if type(value) == bool:
+        raise TypeError
+    return int(value)
+
+
+def _to_float(value):
+    if type(value) == bool:
+        raise TypeError
+    return float(value)
+
+
+def _to_bool(value):
+    if type(value) == bool:
+        return value
+    if str(value).lower() in ('yes', 'true'):
+        return True
+    if str(value).lower() in ('no', 'false'):
+        return False
+    raise ValueError
+
+
+def _to_str(value):
+    if type(value) in (list, dict):
+        raise TypeError
+    return str(value)
+
+
+def _check_type(type_):
+    def check(value):
+        if type(value) != type_:
+            raise TypeError
+        return value
+    return check
+
+
+_CONVERTERS = {'int': _to_int,
+               'float': _to_float,
+               'bool': _to_bool,
+               'str': _to_str,
+               'list': _check_type(list),
+               'dict': _check_type(dict)}
+
+
+# Max width of values written in flow style, so that they stay on one line
+_FLOW_WIDTH = 4096
+
+
+def _same(value, old):
+    """
+    Check if a value is the same as an old value, also in type, so that
+    True is not the same as 1.
+
+    :param value: Value.
+    :param old:   Old value.
+    :rtype:       bool
+    :return:      True if they are the same.
+
+    """
+    if type(value) != type(old):
+        return False
+    if type(value) == dict:
+        return (list(value) == list(old) and
+                all(_same(value[key], old[key]) for key in value))
+    if type(value) == list:
+        return (len(value) == len(old) and
+                all(_same(item, old_item)
+                    for item, old_item in zip(value, old)))
+    return value == old
+
+
+def write_yaml(path: str, settings: dict):
+    """
+    Write settings to a YAML file. The text of the values that did not
+    change is kept as it is, with its comments, also inside lists, its flow
+    style and its quotes. Changed values keep the flow style and quotes of
+    the old value, and the comments of the keys and list items that are
+    still in the settings are kept. The file is read and written in one pass
+    each, and replaced atomically.
+
+    :param path:     Full path and name of the file.
+    :param settings: Settings to write.
+
+    """
+    import yaml
+    loader_class = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+    try:
+        with open(path, 'r', encoding='utf-8') as file_obj:
+            lines = file_obj.read().splitlines()
+    except FileNotFoundError:
+        lines = []
+    loader = loader_class('\n'.join(lines))
+    # The node graph of a large file holds many objects, and collecting
+    # while it is built makes the write time grow faster than the file
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        root = loader.get_single_node()
+        if type(root) != yaml.MappingNode or root.flow_style:
+            root = None
+        out = []
+
+        def is_comment(number: int):
+            # Blank lines are skipped like comments
+            stripped = lines[number].strip()
+            return not stripped or stripped[0] == '#'
+
+        def comments_above(number: int):
+            # Comment lines right above a line
+            first = number
+            while first > 0 and is_comment(first - 1):
+                first -= 1
+            return [line for line in lines[first:number] if line.strip()]
+
+        def is_block(node, node_type):
+            return type(node) == node_type and not node.flow_style
+
+        def last_line(node):
+            # Last line of a node. Block collections end where the next token
+            # starts, so their last line is that of their last value, and the
+            # comments after them belong to the next key or list item.
+            if is_block(node, yaml.MappingNode) and node.value:
+                return last_line(node.value[-1][1])
+            if is_block(node, yaml.SequenceNode) and node.value:
+                return last_line(node.value[-1])
+            number = node.end_mark.line
+            if node.end_mark.column == 0:
+                number -= 1
+            while number > node.start_mark.line and not lines[number].strip():
+                number -= 1
+            return number
+
+        def is_flow_item(node):
+            # List item written on the line of its "-"
+            return not (is_block(node, yaml.MappingNode) or
+                        is_block(node, yaml.SequenceNode))
+
+        def flow_text(value, node):
+            # Value on one line, with the quotes of the old value
+            style = None
+            if (type(value) == str and type(node) == yaml.ScalarNode and
+                    node.style in ('\'', '"')):
+                style = node.style
+            text = yaml.dump([value], Dumper=dumper, default_flow_style=True,
+                             default_style=style, width=_FLOW_WIDTH,
+                             sort_keys=False)
+            return text.strip()[1:-1]
+
+        def dump(value, indentation: str):
+            text = yaml.dump(value, Dumper=dumper, indent=4,
+                             default_flow_style=False, sort_keys=False)
+            out.extend(indentation + line for line in text.splitlines())
+
+        def write_mapping(mapping: dict, node, indentation: str):
+            old = {}
+            if node is not None:
+                old = {key.value: (key, value) for key, value in node.value}
+            for key, value in mapping.items():
+                if node is root:
+                    out.append('')  # Blank line between top level keys
+                if str(key) not in old:
+                    if type(value) == dict and value:
+                        # "key: null" without the value
+                        text = yaml.dump({key: None}, Dumper=dumper)
+                        out.append(indentation + text[:-len(' null\n')])
+                        write_mapping(value, None, indentation + '    ')
+                    else:
+                        dump({key: value}, indentation)
+                    continue
+                key_node, value_node = old[str(key)]
+                number = key_node.start_mark.line
+                out.extend(comments_above(number))
+                old_value = loader.construct_object(value_node, deep=True)
+                if _same(value, old_value):
+                    out.extend(lines[number:last_line(value_node) + 1])
+                    continue
+                line = lines[number]
+                if type(value) == dict and value and is_block(
+                        value_node, yaml.MappingNode):
+                    out.append(line)
+                    child = value_node.value[0][0].start_mark.column
+                    write_mapping(value, value_node, ' ' * child)
+                elif type(value) == list and value and is_block(
+                        value_node, yaml.SequenceNode):
+                    out.append(line)
+                    write_sequence(value, value_node)
+                elif (type(value) in (dict, list) and
+                      type(value_node) == yaml.ScalarNode):
+                    dump({key: value}, indentation)
+                else:
+                    text = line[:key_node.end_mark.column] + ': ' + flow_text(
+                        value, value_node)
+                    # Keep the comment after a value on the key line
+                    if value_node.end_mark.line == number:
+                        rest = line[value_node.end_mark.column:]
+                        if rest.strip().startswith('#'):
+                            text += rest.rstrip()
+                    out.append(text)
+
+        def write_sequence(items: list, node):
+            indentation = ' ' * node.start_mark.column
+            old = node.value
+            for index, item in enumerate(items):
+                item_node = old[index] if index < len(old) else None
+                if item_node is None:
+                    # New items are written like the last old item
+                    last = old[-1] if old else None
+                    if last is not None and is_flow_item(last):
+                        prefix = lines[last.start_mark.line][
+                            :last.start_mark.column]
+                        out.append(prefix + flow_text(item, None))
+                    else:
+                        dump([item], indentation)
+                    continue
+                number = item_node.start_mark.line
+                old_item = loader.construct_object(item_node, deep=True)
+                if _same(item, old_item):
+                    out.extend(comments_above(number))
+                    out.extend(lines[number:last_line(item_node) + 1])
+                elif (type(item) == dict and item and
+                      is_block(item_node, yaml.MappingNode)):
+                    # The first key is on the line of the "-"
+                    start = len(out) + len(comments_above(number))
+                    child = item_node.value[0][0].start_mark.column
+                    write_mapping(item, item_node, ' ' * child)
+                    out[start] = (indentation + '-' +
+                                  out[start][len(indentation) + 1:])
+                elif is_flow_item(item_node):
+                    out.extend(comments_above(number))
+                    out.append(lines[number][:item_node.start_mark.column] +
+                               flow_text(item, item_node))
+                else:
+                    out.extend(comments_above(number))
+                    dump([item], indentation)
+
+        write_mapping(settings, root, '')
+        # Comments at the end of the file
+        if root is not None and root.value:
+            trailer = lines[last_line(root.value[-1][1]) + 1:]
+            while trailer and not trailer[-1].strip():
+                trailer.pop()
+            out.extend(trailer)
+    finally:
+        loader.dispose()
+        if gc_enabled:
+            gc.enable()
+    with open(path + '~', 'w', encoding='utf-8') as file_obj:
+        file_obj.write('\n'.join(out[1:]) + '\n')
+    os.rename(path + '~', path)
+
 
 class Settings:
     """Settings container."""
@@ -39,6 +332,29 @@ class Settings:
     __PROGRAM_PATH = None
     """(*str*) Path of the program."""
 
+    __CONVERTERS = {param: _CONVERTERS[type_]
+                    for param, type_ in SCHEMA.items()}
+    """(*dict*) Setting => converter function, compiled from the schema."""
+
+    __CACHE_KEY = None
+    """(*tuple*) Modification time and size of the loaded config file."""
+
+    __CHECK_TIME = None
+    """(*float*) Monotonic time of the last check for changes."""
+
+    __LISTENERS = []
+    """(*list*) Functions called with the names of changed settings."""
+
+    __LOADED = set()
+    """(*set*) Names of the settings loaded from the config file."""
+
+    __DEFAULTS = {}
+    """(*dict*) Setting => value before it was loaded from the config file,
+    for the settings that had one."""
+
+    SETTINGS_RELOAD_INTERVAL = 1.0
+    """(*float*) Min seconds between checks of the config file."""
+
     @staticmethod
     def static_init():
         """
@@ -65,14 +381,80 @@ class Settings:
     @staticmethod
     def load_settings_from_yaml():
         """
-        Set system constants from YAML file.
+        Set system constants from YAML file, unless the file is unchanged
+        since it was last loaded. Settings removed from the file get back
+        the value they had before they were loaded, or are deleted. Listeners
+        are called with the changed and removed settings.
+
+        :rtype:  set
+        :return: Names of the changed settings.
+        :raises: SettingsError
 
         """
+        stat = os.stat(Settings.__CONFIG_FILE)
+        cache_key = (stat.st_mtime_ns, stat.st_size)
+        if cache_key == Settings.__CACHE_KEY:
+            return set()
+        import yaml
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
         with open(Settings.__CONFIG_FILE, 'r') as f:
-            constants = yaml.load(f, Loader=yaml.FullLoader)
-        for constant, value in constants.items():
-            setattr(
-                Settings, constant, Settings._format_value(constant, value))
+            constants = yaml.load(f, Loader=loader) or {}
+        # Convert all values before setting any, so that an invalid file
+        # leaves the settings unchanged
+        values = {constant: Settings._format_value(constant, value)
+                  for constant, value in constants.items()}
+        changed = set()
+        for constant, value in values.items():
+            if constant not in Settings.__LOADED and hasattr(Settings,
+                                                             constant):
+                Settings.__DEFAULTS.setdefault(constant,
+                                               getattr(Settings, constant))
+            if getattr(Settings, constant, None) != value:
+                setattr(Settings, constant, value)
+                changed.add(constant)
+        for constant in Settings.__LOADED - set(values):
+            if constant in Settings.__DEFAULTS:
+                setattr(Settings, constant, Settings.__DEFAULTS[constant])
+            else:
+                delattr(Settings, constant)
+            changed.add(constant)
+        Settings.__LOADED = set(values)
+        Settings.__CACHE_KEY = cache_key
+        if changed:
+            for listener in Settings.__LISTENERS:
+                listener(changed)
+        return changed
+
+    @staticmethod
+    def reload_if_changed():
+        """
+        Reload the config file if it has changed. The file is checked at most
+        once every SETTINGS_RELOAD_INTERVAL seconds, so this can be called
+        often.
+
+        :rtype:  set
+        :return: Names of the changed settings.
+        :raises: SettingsError
+
+        """
+        now = time.monotonic()
+        if (Settings.__CHECK_TIME is not None and
+                now - Settings.__CHECK_TIME <
+                Settings.SETTINGS_RELOAD_INTERVAL):
+            return set()
+        Settings.__CHECK_TIME = now
+        return Settings.load_settings_from_yaml()
+
+    @staticmethod
+    def add_listener(listener):
+        """
+        Add a function that is called with the names of the changed settings
+        when the config file is loaded.
+
+        :param listener: Listener function.
+
+        """
+        Settings.__LISTENERS.append(listener)
 
     @staticmethod
     def write_settings_to_file(settings_json):
@@ -80,56 +462,18 @@ class Settings:
         Write settings to file.
 
         :param dict settings_json: Settings that should be written to file.
+        :raises: SettingsError
 
         ..note:
 
-            Comments are only supported on top level parameters.
+            Comments, flow style and quotes are kept, see
+            :func:`write_yaml`.
 
         """
-        file_obj = open(Settings.__CONFIG_FILE, 'r', encoding="utf-8")
-        # Read YAML file comments from disk.
-        lines = file_obj.readlines()
-        file_obj.close()
-        # Get all comments
-        comment = []
-        param_comments = {}
-        for i in range(len(lines)):
-            if len(lines[i]) > 0 and lines[i][0] == '#':
-                comment.append(lines[i].strip())
-                if lines[i+1][0] != '#':
-                    param = re.match('(.+?):.*', lines[i+1]).group(1)
-                    param_comments[param] = comment
-                    comment = []
         # Set correct type of parameters
         for param, value in settings_json.items():
             settings_json[param] = Settings._format_value(param, value)
-        # Create YAML with comments
-        settings_yaml = yaml.dump(settings_json,
-                                  default_flow_style=False,
-                                  indent=4)
-        settings_list = settings_yaml.split('\n')
-        i = 0
-        while i < len(settings_list):
-            top_level_param = re.match('\A(\S+):.*\Z', settings_list[i])
-            # Top level parameter found
-            if top_level_param is not None:
-                param = top_level_param.group(1)
-                settings_list.insert(i, '')  # Add newline
-                i += 1
-                for test_param, comments in param_comments.items():
-                    if param == test_param:
-                        # Insert parameter comment
-                        for comment in comments:
-                            settings_list.insert(i, comment)
-                            i += 1
-                        del param_comments[param]
-                        break
-            i += 1
-        settings_yaml = '\n'.join(settings_list)[1:]
-        #  Write YAML to file
-        with open(Settings.__CONFIG_FILE+'~', 'w') as file_obj:
-            file_obj.writelines(settings_yaml)
-        os.rename(Settings.__CONFIG_FILE+'~', Settings.__CONFIG_FILE)
+        write_yaml(Settings.__CONFIG_FILE, settings_json)
 
     @staticmethod
     def _format_path(path, slash=True):
@@ -159,12 +503,21 @@ class Settings:
         :param str param: Value to format.
         :rtype: str or bool
         :return: A parameter with the correct type.
+        :raises: SettingsError
 
         """
+        converter = Settings.__CONVERTERS.get(param)
+        if converter is not None and value is not None:
+            try:
+                value = converter(value)
+            except (TypeError, ValueError):
+                raise SettingsError(param, SCHEMA[param], value)
         if param in Settings.__PATH_WITH_SLASH_PARAMETERS:
             return Settings._format_path(value, True)
         elif param in Settings.__PATH_WITHOUT_SLASH_PARAMETERS:
             return Settings._format_path(value, False)
+        elif converter is not None or value is None:
+            return value
         elif str(value).lower() == 'yes' or str(value).lower() == 'true':
             return True
         elif str(value).lower() == 'no' or str(value).lower() == 'false':
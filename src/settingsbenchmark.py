@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Settings benchmark
+******************
+
+This module benchmarks the settings writer on large generated config files,
+with a fleet of hubs that each have their own hardware and a commented macro
+per hub. The write time per line should not grow with the size of the file.
+
+"""
+
+# Built in modules
+import argparse
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+# Third party modules
+import yaml
+
+# Local modules
+from settings import write_yaml
+
+HUB = '''\
+-   name: hub{n}
+    ble_id: '90:84:2B:4E:{a:02X}:{b:02X}'
+    hardware:
+        drive_motor1:
+            type: CPlusXLMotor
+            port: 0
+            capabilities: [[sense_speed, 5]]
+        steering_motor:
+            type: CPlusLargeMotor
+            port: 2
+            capabilities: [sense_pos]
+'''
+"""(*str*) Generated hub in HUBS."""
+
+MACRO = '''\
+    # Start car {n}
+    start{n}:
+    -   {{time: 0, command: headlights, brightness: 100}}
+    -   {{time: 0, command: gearbox, gear: 1}}
+    -   {{time: 0.5, command: speed, speed: {speed}}}
+'''
+"""(*str*) Generated macro in MACROS."""
+
+
+def generate_config(size: int):
+    """
+    Generate a config file.
+
+    :param size: Number of hubs and macros.
+    :rtype:      str
+    :return:     YAML with comments.
+
+    """
+    hubs = ''.join(HUB.format(n=n, a=n // 256 % 256, b=n % 256)
+                   for n in range(size))
+    macros = ''.join(MACRO.format(n=n, speed=n % 100) for n in range(size))
+    return ('# Hubs controlled by the car control\nHUBS:\n' + hubs +
+            '\n# Named command sequences\nMACROS:\n' + macros +
+            '\n# Logging verbosity 0-50\nLOG_VERBOSITY: 1\n')
+
+
+class SettingsBenchmark:
+    """Measures the settings writer on config files of growing size."""
+
+    def __init__(self, sizes: list, repeat: int = 5):
+        """
+        Constructor function.
+
+        :param sizes:  Numbers of hubs and macros of the generated files.
+        :param repeat: Number of writes of every file, the median is
+                       reported.
+
+        """
+        self.sizes = sizes
+        self.repeat = repeat
+
+    def _measure(self, path: str, size: int):
+        """
+        Measure the writes of one generated file.
+
+        :param path: Full path and name of the file.
+        :param size: Number of hubs and macros.
+        :rtype:      dict
+        :return:     Lines, median write time and time per line.
+
+        """
+        text = generate_config(size)
+        with open(path, 'w') as file_obj:
+            file_obj.write(text)
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+        settings = yaml.load(text, Loader=loader)
+        times = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            write_yaml(path, settings)
+            times.append(time.perf_counter() - start)
+        with open(path) as file_obj:
+            written = file_obj.read()
+        if yaml.load(written, Loader=loader) != settings:
+            raise RuntimeError('Written settings differ')
+        comments = written.count('\n#') + written.count('    # ')
+        if comments != text.count('\n#') + text.count('    # '):
+            raise RuntimeError('Comments were not kept')
+        lines = written.count('\n')
+        median = statistics.median(times)
+        return {'size': size,
+                'lines': lines,
+                'comments': comments,
+                'write_ms': round(median * 1000, 3),
+                'us_per_line': round(median / lines * 1e6, 3)}
+
+    def run(self):
+        """
+        Run the benchmark.
+
+        :rtype:  dict
+        :return: Benchmark results. "scaling" is the time per line of the
+                 largest file divided by that of the smallest, about 1 when
+                 the writer is linear.
+
+        """
+        path = tempfile.mkdtemp()
+        try:
+            results = [self._measure(os.path.join(path, 'legcocar.conf'),
+                                     size)
+                       for size in self.sizes]
+        finally:
+            shutil.rmtree(path)
+        return {'config': {'sizes': self.sizes, 'repeat': self.repeat},
+                'results': results,
+                'scaling': round(results[-1]['us_per_line'] /
+                                 results[0]['us_per_line'], 2)}
+
+
+class Main:
+    """Contains the script"""
+
+    @staticmethod
+    def _parse_command_line_options():
+        """
+        Parse options from the command line.
+
+        :rtype: Namespace
+
+        """
+        description = 'Benchmark the legcocar settings writer.'
+        parser = argparse.ArgumentParser(description=description)
+        parser.add_argument('--sizes', type=int, nargs='+',
+                            default=[100, 1000, 10000],
+                            help='Numbers of hubs and macros of the '
+                                 'generated config files.')
+        parser.add_argument('--repeat', '-n', type=int, default=5,
+                            help='Number of writes of every file.')
+        parser.add_argument('--output', '-o', type=str, default=None,
+                            help='Save results as JSON to this file.')
+        args = parser.parse_args()
+        return args
+
+    def run(self):
+        """
+        Run the script.
+
+        """
+        args = self._parse_command_line_options()
+        benchmark = SettingsBenchmark(sizes=sorted(args.sizes),
+                                      repeat=args.repeat)
+        results = benchmark.run()
+        print(json.dumps(results, indent=4))
+        if args.output is not None:
+            with open(args.output, 'w') as file_obj:
+                json.dump(results, file_obj, indent=4)
+
+
+if __name__ == '__main__':
+    main = Main()
+    main.run()
@@ -0,0 +1,682 @@
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Simulated hub
+*************
+
+This module contains a simulated LEGO Control+ hub. It mimics the parts of the
+bricknil API that the car control uses, so that the real :class:`Car` handlers
+can run on a plain Linux box without a physical hub or Bluetooth.
+
+The car control uses this module instead of bricknil when the environment
+variable ``LEGCOCAR_SIMULATED_HUB`` is set. It then also uses :func:`sleep`
+and :func:`monotonic` from this module, so that the car runs on simulated
+time.
+
+"""
+
+# Built in modules
+import random
+import time
+from enum import IntEnum
+from functools import wraps
+
+# Third party modules
+import curio
+
+
+class SimClock:
+    """Simulation time."""
+
+    time_scale = 1.0
+    """(*float*) How many times faster than real time the simulation runs."""
+
+    @staticmethod
+    def monotonic():
+        """
+        Get simulated monotonic time.
+
+        :rtype:  float
+        :return: Simulated time in seconds.
+
+        """
+        return time.monotonic() * SimClock.time_scale
+
+
+def monotonic():
+    """
+    Get simulated monotonic time.
+
+    :rtype:  float
+    :return: Simulated time in seconds.
+
+    """
+    return SimClock.monotonic()
+
+
+async def sleep(seconds: float):
+    """
+    Sleep for a number of simulated seconds.
+
+    :param seconds: Simulated seconds to sleep.
+
+    """
+    await curio.sleep(seconds / SimClock.time_scale)
+
+
+def configure(time_scale: float = None,
+              write_latency: float = None,
+              write_jitter: float = None,
+              sensor_rate: float = None,
+              seed: int = None,
+              end_stops: dict = None):
+    """
+    Configure the simulation.
+
+    :param time_scale:    How many times faster than real time to run.
+    :param write_latency: Mean BLE write latency in seconds.
+    :param write_jitter:  Max BLE write latency deviation in seconds.
+    :param sensor_rate:   Sensor sample rate in Hz.
+    :param seed:          Random seed for reproducible jitter.
+    :param end_stops:     Peripheral name => (min, max) position of motors
+                          with mechanical end stops.
+
+    """
+    if time_scale is not None:
+        SimClock.time_scale = time_scale
+    if write_latency is not None:
+        SimHub.write_latency = write_latency
+    if write_jitter is not None:
+        SimHub.write_jitter = write_jitter
+    if sensor_rate is not None:
+        SimHub.sensor_rate = sensor_rate
+    if seed is not None:
+        SimHub.random = random.Random(seed)
+    if end_stops is not None:
+        SimHub.end_stops = end_stops
+
+
+def attach(peripheral_type, **kwargs):
+    """
+    Attach a simulated peripheral to a hub class, just like bricknil does.
+
+    The decorated hub class is replaced by a function that creates the hub
+    and attaches the peripheral. Peripherals with sensing capabilities need
+    a "<name>_change" handler in the hub class.
+
+    :param peripheral_type: Peripheral class.
+    :param kwargs:          Peripheral "name", "port" and "capabilities".
+    :rtype:                 function
+    :return:                Class decorator.
+
+    """
+    def decorator(cls):
+        @wraps(cls)
+        def wrapper_f(*args, **hub_kwargs):
+            peripheral = peripheral_type(**kwargs)
+            if any(capability.name.startswith('sense')
+                   for capability in peripheral.capabilities):
+                handler_name = '{}_change'.format(peripheral.name)
+                assert hasattr(cls, handler_name), \
+                    '{} needs a handler {}'.format(cls.__name__, handler_name)
+            hub = cls(*args, **hub_kwargs)
+            hub.attach_sensor(peripheral)
+            return hub
+        return wrapper_f
+    return decorator
+
+
+def start(system, duration: float = None):
+    """
+    Run a simulated system.
+
+    :param system:   Coroutine function that creates the hubs.
+    :param duration: Simulated seconds to run, forever if not set.
+
+    """
+    curio.run(run_system, system, duration)
+
+
+async def run_system(system, duration: float = None):
+    """
+    Create hubs and run them until they finish or duration has passed.
+
+    :param system:   Coroutine function that creates the hubs.
+    :param duration: Simulated seconds to run, forever if not set.
+
+    """
+    SimHub.hubs = []
+    await system()
+    tasks = []
+    for hub in SimHub.hubs:
+        tasks.extend(await hub.connect())
+        tasks.append(await curio.spawn(hub.run, daemon=True))
+    try:
+        # Run until a task ends, for example when a hub connection is lost
+        end_time = None if duration is None else monotonic() + duration
+        while not any(task.terminated for task in tasks):
+            if end_time is not None and monotonic() >= end_time:
+                break
+            await sleep(0.05)
+        for task in tasks:
+            if task.terminated:
+                await task.join()
+    finally:
+        for task in tasks:
+            await task.cancel()
+
+
+class DifferentPeripheralOnPortError(Exception):
+    """The hub reported another peripheral on a port than the attached."""
+
+
+class SimPeripheral:
+    """Simulated peripheral base."""
+
+    capability = IntEnum('capability', {})
+    """(*IntEnum*) Sensor capabilities of the peripheral."""
+
+    sensor_name = None
+    """(*str*) Device name the hub reports when the peripheral attaches."""
+
+    value_bytes = {}
+    """(*dict*) Capability name => size of the sensed value in bytes."""
+
+    def __init__(self, name: str, port: int = None, capabilities: list = ()):
+        """
+        Constructor function.
+
+        :param name:         Peripheral name.
+        :param port:         Hub port number.
+        :param capabilities: Sensor capabilities to subscribe to, either names
+                             or (name, delta) tuples.
+
+        """
+        self.name = name
+        self.port = port
+        self.hub = None
+        """(*SimHub*) Hub that the peripheral is attached to."""
+        self.value = None
+        """(*dict*) Capability => sensed value, encoded unsigned just like
+        in bricknil. None until updates are activated, and then a list of
+        None until the first notification."""
+        self.notifications = 0
+        self.capabilities = []
+        self._deltas = {}
+        self._sensed = {}
+        for capability in capabilities:
+            delta = 1
+            if isinstance(capability, tuple):
+                capability, delta = capability
+            self.capabilities.append(self.capability[capability])
+            self._deltas[self.capability[capability]] = delta
+
+    async def activate_updates(self):
+        """
+        Subscribe to the sensor capabilities, called when the hub reports
+        the peripheral attached.
+
+        """
+        if self.capabilities:
+            self.value = {capability: [None]
+                          for capability in self.capabilities}
+        self._sensed = {}
+
+    def encode(self, capability, value: int):
+        """
+        Encode a sensed value as the unsigned integer bricknil decodes.
+
+        :param capability: Capability of the value.
+        :param value:      Signed value.
+        :rtype:            int
+        :return:           Unsigned value.
+
+        """
+        return value & ((1 << 8 * self.value_bytes[capability.name]) - 1)
+
+    async def send_message(self, msg_name: str, msg_bytes: list):
+        """
+        Send a raw message to the hub.
+
+        :param msg_name:  Message name.
+        :param msg_bytes: Message, without the length byte.
+
+        """
+        await self.hub.send_message(msg_name, msg_bytes, peripheral=self)
+
+    def request_value(self):
+        """
+        Report the sensed values when they are next checked, even if they
+        have not moved their delta.
+
+        """
+        self._sensed = {}
+
+    def update(self, dt: float):
+        """
+        Advance simulated physics.
+
+        :param dt: Simulated seconds since last update.
+
+        """
+
+    def sample(self, capability):
+        """
+        Read the simulated value of a capability.
+
+        :param capability: Capability to read.
+        :rtype:  int
+        :return: Current value.
+
+        """
+        return 0
+
+    def changed_capabilities(self):
+        """
+        Find subscribed capabilities that moved at least their delta since
+        they were last reported. The first sample is always reported.
+
+        :rtype:  list
+        :return: (capability, encoded value) tuples with a new value.
+
+        """
+        changed = []
+        for capability, delta in self._deltas.items():
+            value = self.sample(capability)
+            last = self._sensed.get(capability)
+            if last is None or abs(value - last) >= delta:
+                self._sensed[capability] = value
+                changed.append((capability, self.encode(capability, value)))
+        return changed
+
+
+class SimMotor(SimPeripheral):
+    """Simulated Control+ motor."""
+
+    capability = IntEnum('capability', {'sense_speed': 1, 'sense_pos': 2})
+
+    value_bytes = {'sense_speed': 1, 'sense_pos': 4}
+
+    response_time = 0.2
+    """(*float*) Time constant of the speed response in seconds."""
+
+    max_speed = 900.0
+    """(*float*) Rotation at 100% speed in degrees per second."""
+
+    def __init__(self, name: str, port: int = None, capabilities: list = ()):
+        super().__init__(name, port, capabilities)
+        self.speed = 0
+        """(*int*) Last commanded speed, just like in bricknil."""
+        self.ramp_in_progress_task = None
+        self._actual_speed = 0.0
+        self._target_speed = 0.0
+        self._actual_pos = 0.0
+        self._target_pos = None
+        self._pos_speed = 0
+
+    async def _cancel_ramp(self):
+        """
+        Cancel a speed ramp started by another task.
+
+        """
+        if self.ramp_in_progress_task is not None:
+            if await curio.current_task() != self.ramp_in_progress_task:
+                await self.ramp_in_progress_task.cancel()
+                self.ramp_in_progress_task = None
+
+    async def set_speed(self, speed: int):
+        """
+        Set motor speed.
+
+        :param speed: Target speed from -100 to 100.
+
+        """
+        await self._cancel_ramp()
+        self.speed = speed
+        await self.hub.ble_write(self, self._run_at_speed, speed)
+
+    async def _run_at_speed(self, speed: int):
+        """
+        Apply a written speed.
+
+        :param speed: Target speed from -100 to 100.
+
+        """
+        self._target_pos = None
+        self._target_speed = max(-100, min(100, speed))
+
+    async def ramp_speed(self, target_speed: int, ramp_time_ms: int):
+        """
+        Ramp motor speed in 100 ms steps, like bricknil does.
+
+        :param target_speed: Target speed from -100 to 100.
+        :param ramp_time_ms: Ramp duration in milliseconds.
+
+        """
+        await self._cancel_ramp()
+        steps = max(1, int(ramp_time_ms / 100))
+        start_speed = self.speed
+
+        async def ramp():
+            for step in range(1, steps + 1):
+                await self.set_speed(
+                    int(start_speed + (target_speed - start_speed) * step /
+                        steps))
+                if step < steps:
+                    await sleep(0.1)
+            self.ramp_in_progress_task = None
+
+        self.ramp_in_progress_task = await curio.spawn(ramp, daemon=True)
+
+    async def set_pos(self, pos: int, speed: int = 50, max_power: int = 50):
+        """
+        Move motor to an absolute position.
+
+        :param pos:       Target position in degrees.
+        :param speed:     Speed from 0 to 100.
+        :param max_power: Max power from 0 to 100.
+
+        """
+        await self.hub.ble_write(self, self._run_to_pos, pos, speed,
+                                 max_power)
+
+    async def _run_to_pos(self, pos: int, speed: int, max_power: int):
+        """
+        Apply a written target position.
+
+        :param pos:       Target position in degrees.
+        :param speed:     Speed from 0 to 100.
+        :param max_power: Max power from 0 to 100.
+
+        """
+        self._target_pos = pos
+        self._pos_speed = min(abs(speed), max(max_power, 1))
+
+    def update(self, dt: float):
+        # Position mode drives the target speed towards the target position
+        if self._target_pos is not None:
+            error = self._target_pos - self._actual_pos
+            if abs(error) < 0.5:
+                self._target_speed = 0
+            else:
+                # Slow down when close to the target position
+                approach = (abs(error) / self.max_speed * 100 /
+                            self.response_time)
+                speed = min(self._pos_speed, approach)
+                self._target_speed = speed if error > 0 else -speed
+
+        # First order speed response
+        factor = min(1.0, dt / self.response_time)
+        self._actual_speed += (
+            (self._target_speed - self._actual_speed) * factor)
+        new_pos = (self._actual_pos +
+                   self._actual_speed / 100 * self.max_speed * dt)
+
+        # The hub position controller stops at the target position
+        if (self._target_pos is not None and
+                (self._target_pos - self._actual_pos) *
+                (self._target_pos - new_pos) < 0):
+            new_pos = self._target_pos
+            self._actual_speed = 0.0
+
+        # The motor stalls at mechanical end stops
+        end_stops = self.hub.end_stops.get(self.name)
+        if end_stops is not None:
+            min_pos, max_pos = end_stops
+            if not min_pos <= new_pos <= max_pos:
+                new_pos = max(min_pos, min(max_pos, new_pos))
+                self._actual_speed = 0.0
+        self._actual_pos = new_pos
+
+    def sample(self, capability):
+        if capability == self.capability.sense_speed:
+            return int(round(self._actual_speed))
+        return int(round(self._actual_pos))
+
+
+class CPlusXLMotor(SimMotor):
+    """Simulated Control+ XL motor."""
+
+    sensor_name = 'Technic Control+ XL Motor'
+    response_time = 0.3
+    max_speed = 1000.0
+
+
+class CPlusLargeMotor(SimMotor):
+    """Simulated Control+ large motor."""
+
+    sensor_name = 'Technic Control+ Large Motor'
+    response_time = 0.15
+    max_speed = 1100.0
+
+
+class Light(SimPeripheral):
+    """Simulated light."""
+
+    sensor_name = 'Light'
+
+    def __init__(self, name: str, port: int = None, capabilities: list = ()):
+        super().__init__(name, port, capabilities)
+        self.brightness = 0
+
+    async def set_brightness(self, brightness: int):
+        """
+        Set light brightness.
+
+        :param brightness: Brightness from 0 to 100.
+
+        """
+        await self.hub.ble_write(self, self._light, brightness)
+
+    async def _light(self, brightness: int):
+        """
+        Apply a written brightness.
+
+        :param brightness: Brightness from 0 to 100.
+
+        """
+        self.brightness = brightness
+
+
+class SimHub:
+    """Simulated Control+ hub."""
+
+    hubs = []
+    """(*list*) Hubs created by the running system."""
+
+    write_latency = 0.015
+    """(*float*) Mean BLE write latency in seconds."""
+
+    write_jitter = 0.005
+    """(*float*) Max BLE write latency deviation in seconds."""
+
+    sensor_rate = 20.0
+    """(*float*) Sensor sample rate in Hz."""
+
+    random = random.Random()
+    """(*Random*) Random generator for latency jitter."""
+
+    end_stops = {}
+    """(*dict*) Peripheral name => (min, max) motor end stop positions."""
+
+    def __init__(self,
+                 name: str,
+                 query_port_info: bool = False,
+                 ble_id: str = None):
+        self.name = name
+        self.query_port_info = query_port_info
+        self.ble_id = ble_id
+        self.ble_writes = 0
+        self.connected = True
+        """(*bool*) Writes are lost and sensors are silent when False."""
+        self.peripherals = {}
+        self.port_to_peripheral = {}
+        """(*dict*) Port => peripheral, set when the hub reports the
+        peripheral attached."""
+        self._writes = curio.Queue()
+        self._reports = curio.Queue()
+        SimHub.hubs.append(self)
+
+    def attach_sensor(self, sensor):
+        """
+        Add a peripheral to the hub, called by :func:`attach`.
+
+        :param sensor: Peripheral.
+
+        """
+        assert sensor.name not in self.peripherals, \
+            'Duplicate {} found!'.format(sensor.name)
+        sensor.hub = self
+        self.peripherals[sensor.name] = sensor
+        setattr(self, sensor.name, sensor)
+
+    def message_info(self, message: str):
+        """
+        Print an info message.
+
+        :param message: Message to print.
+
+        """
+        print('{name}: {message}'.format(name=self.name, message=message))
+
+    def message_debug(self, message: str):
+        """
+        Debug messages are not printed.
+
+        :param message: Message.
+
+        """
+
+    async def ble_write(self, peripheral, apply, *args):
+        """
+        Queue one BLE write to a peripheral. Just like in bricknil the write
+        does not wait for the hub and never fails, a write sent while the
+        connection is lost is silently dropped.
+
+        :param peripheral: Peripheral that is written to.
+        :param apply:      Coroutine function that applies the write to the
+                           simulated peripheral when the hub has received it.
+        :param args:       Function arguments.
+
+        """
+        await self._writes.put((peripheral, apply, args))
+
+    async def _write_loop(self):
+        # Writes are carried to the hub one at a time
+        while True:
+            peripheral, apply, args = await self._writes.get()
+            latency = self.write_latency + self.random.uniform(
+                -self.write_jitter, self.write_jitter)
+            await sleep(max(latency, 0.0))
+            if self.connected:
+                self.ble_writes += 1
+                await apply(*args)
+
+    async def send_message(self, msg_name: str, msg_bytes: list,
+                           peripheral=None):
+        """
+        Queue a raw message to the hub. Only port value requests are
+        simulated, the hub answers them right away with a sensor
+        notification.
+
+        :param msg_name:   Message name.
+        :param msg_bytes:  Message, without the length byte.
+        :param peripheral: Peripheral that sends the message.
+
+        """
+        await self.ble_write(peripheral, self._receive_message, msg_bytes)
+
+    async def _receive_message(self, msg_bytes: list):
+        # Port information request for the port value
+        if msg_bytes[1:2] == [0x21] and msg_bytes[3:4] == [0x00]:
+            peripheral = self.port_to_peripheral.get(msg_bytes[2])
+            if peripheral is not None:
+                peripheral.request_value()
+                await self._notify(peripheral)
+
+    def drop_connection(self):
+        """
+        Simulate a lost BLE connection.
+
+        """
+        self.connected = False
+
+    async def connect_peripheral_to_port(self, device_name: str, port: int):
+        """
+        Connect the peripheral on a port that the hub reported attached, just
+        like bricknil does.
+
+        :param device_name: Device name the hub reported.
+        :param port:        Hub port number.
+        :rtype:             SimPeripheral
+        :return:            Peripheral, None if no peripheral matches.
+        :raises:            DifferentPeripheralOnPortError
+
+        """
+        for peripheral in self.peripherals.values():
+            if peripheral.port == port:
+                if device_name != peripheral.sensor_name:
+                    raise DifferentPeripheralOnPortError
+                self.port_to_peripheral[port] = peripheral
+                return peripheral
+        for peripheral in self.peripherals.values():
+            if (peripheral.sensor_name == device_name and
+                    peripheral.port is None):
+                peripheral.port = port
+                self.port_to_peripheral[port] = peripheral
+                return peripheral
+        return None
+
+    async def connect(self):
+        """
+        Report the attached peripherals and start the simulated write,
+        sensor and notification tasks.
+
+        :rtype:  list
+        :return: Started tasks.
+
+        """
+        for peripheral in list(self.peripherals.values()):
+            peripheral = await self.connect_peripheral_to_port(
+                peripheral.sensor_name, peripheral.port)
+            if peripheral is not None:
+                await peripheral.activate_updates()
+        return [await curio.spawn(self._write_loop, daemon=True),
+                await curio.spawn(self._sensor_loop, daemon=True),
+                await curio.spawn(self._notification_loop, daemon=True)]
+
+    async def _notify(self, peripheral):
+        # Notify the sensed values that moved their delta
+        for capability, value in peripheral.changed_capabilities():
+            peripheral.notifications += 1
+            await self._reports.put((peripheral, capability, value))
+
+    async def _sensor_loop(self):
+        # Sensors are silent while the connection is lost
+        last = SimClock.monotonic()
+        while True:
+            await sleep(1 / self.sensor_rate)
+            now = SimClock.monotonic()
+            for peripheral in self.port_to_peripheral.values():
+                peripheral.update(now - last)
+                if self.connected:
+                    await self._notify(peripheral)
+            last = now
+
+    async def _notification_loop(self):
+        # Values are updated and handlers are awaited one at a time, just
+        # like bricknil does
+        while True:
+            peripheral, capability, value = await self._reports.get()
+            peripheral.value[capability] = value
+            await getattr(self, peripheral.name + '_change')()
+
+    async def run(self):
+        """
+        Hub operation, overridden by the hub implementation.
+
+        """
+
+
+CPlusHub = SimHub
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Startup benchmark
+*****************
+
+This module benchmarks cold start. Every measurement runs in a new Python
+process, like a restarted web server worker or car control worker:
+
+* the import time of every module the flask server and the car control
+  import directly,
+* the time from process start to the first handled HTTP request,
+* the time from process start until the car polls its queues, running
+  against a simulated hub, so the BLE connection time is not included.
+
+"""
+
+# Built in modules
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+FIRST_REQUEST = '''
+import flaskserver
+from membroker import InMemoryBroker
+
+broker = InMemoryBroker()
+
+
+def connection():
+    # Import pika like a real first publish does
+    import pika
+    return broker.connection()
+
+
+flaskserver.RequestHandler.broker_connection_factory = connection
+client = flaskserver.web_server.test_client()
+response = client.post('/api/speed', json={'speed': 0})
+print('ready', response.status_code, flush=True)
+'''
+"""(*str*) Program that handles one HTTP request."""
+
+HUB_READY = '''
+import os
+os.environ['LEGCOCAR_SIMULATED_HUB'] = '1'
+import carcontrol
+import simhub
+from membroker import InMemoryBroker
+
+carcontrol.channel = InMemoryBroker().connection().channel()
+simhub.configure(time_scale=1000)
+
+
+class ReadyCar(carcontrol.Car):
+
+    def _get_message(self):
+        print('ready', flush=True)
+        os._exit(0)
+
+
+async def system():
+    carcontrol.attach_hardware(ReadyCar)(name='startup',
+                                         ble_id='00:00:00:00:00:00')
+
+simhub.start(system)
+'''
+"""(*str*) Program that starts a car and exits when it is ready."""
+
+
+def parse_import_times(output: str, depth: int = 1):
+    """
+    Parse the output of "python -X importtime".
+
+    :param output: Standard error of the process.
+    :param depth:  Max import depth to include, 0 is the imported module
+                   itself and 1 its direct imports.
+    :rtype:        dict
+    :return:       Module => (self, cumulative) import time in ms.
+
+    """
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():
+            continue  # Header line
+        level = (len(name) - len(name.lstrip())) // 2 - 1
+        if level <= depth:
+            times[name.strip()] = (int(self_us) / 1000,
+                                   int(cumulative_us) / 1000)
+    return times
+
+
+class StartupBenchmark:
+    """Measures import and start times in new processes."""
+
+    def __init__(self, repeat: int = 5, bytecode: bool = True,
+                 simulated_hub: bool = False):
+        """
+        Constructor function.
+
+        :param repeat:        Number of runs of every measurement, the median
+                              is reported.
+        :param bytecode:      If False the local modules are compiled in every
+                              run, as if no bytecode had been installed.
+        :param simulated_hub: If the car control is imported with the
+                              simulated hub instead of bricknil.
+
+        """
+        self.repeat = repeat
+        self.bytecode = bytecode
+        self.simulated_hub = simulated_hub
+        self._path = os.path.dirname(os.path.abspath(__file__))
+
+    def _run(self, args: list, marker: str = None):
+        """
+        Run a Python process from the source directory.
+
+        :param args:   Python arguments.
+        :param marker: Line prefix the process prints when it is ready. The
+                       process is waited for if not set.
+        :rtype:        tuple
+        :return:       Seconds until ready and standard error.
+        :raises:       RuntimeError
+
+        """
+        env = dict(os.environ)
+        if self.simulated_hub:
+            env['LEGCOCAR_SIMULATED_HUB'] = '1'
+        path = self._path
+        if not self.bytecode:
+            path = tempfile.mkdtemp()
+            for name in os.listdir(self._path):
+                if name.endswith('.py'):
+                    shutil.copy(os.path.join(self._path, name), path)
+            env['PYTHONDONTWRITEBYTECODE'] = '1'
+        try:
+            start = time.perf_counter()
+            process = subprocess.Popen(
+                [sys.executable] + args, cwd=path, env=env,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                universal_newlines=True)
+            ready = marker is None
+            if marker is not None:
+                for line in process.stdout:
+                    if line.startswith(marker):
+                        ready = True
+                        break
+            elapsed = time.perf_counter() - start
+            stdout, stderr = process.communicate()
+            # A process that exits before it is ready is an error too, even
+            # if it exits with 0
+            if not ready or process.returncode != 0:
+                lines = stderr.strip().splitlines()
+                raise RuntimeError(lines[-1] if lines else
+                                   'Exited with {code} before {marker!r}'
+                                   .format(code=process.returncode,
+                                           marker=marker))
+            return elapsed, stderr
+        finally:
+            if path != self._path:
+                shutil.rmtree(path)
+
+    def _import_times(self, module: str):
+        """
+        Measure the import times of a module.
+
+        :param module: Module name.
+        :rtype:        dict
+        :return:       Module => median self and cumulative import time in ms.
+
+        """
+        runs = []
+        for _ in range(self.repeat):
+            elapsed, stderr = self._run(
+                ['-X', 'importtime', '-c', 'import ' + module])
+            runs.append(parse_import_times(stderr))
+        times = {}
+        for name in runs[0]:
+            values = [run[name] for run in runs if name in run]
+            times[name] = {
+                'self_ms': round(statistics.median(v[0] for v in values), 3),
+                'cumulative_ms': round(
+                    statistics.median(v[1] for v in values), 3)}
+        return dict(sorted(times.items(),
+                           key=lambda item: -item[1]['cumulative_ms']))
+
+    def _ready_time(self, program: str):
+        """
+        Measure the time until a program is ready.
+
+        :param program: Python program.
+        :rtype:         float
+        :return:        Median time in ms.
+
+        """
+        return round(statistics.median(
+            self._run(['-c', program], marker='ready')[0]
+            for _ in range(self.repeat)) * 1000, 3)
+
+    def run(self):
+        """
+        Run the benchmark.
+
+        :rtype:  dict
+        :return: Benchmark results.
+
+        """
+        interpreter = self._ready_time("print('ready')")
+        return {
+            'config': {'repeat': self.repeat,
+                       'bytecode': self.bytecode,
+                       'simulated_hub': self.simulated_hub,
+                       'python': sys.version.split()[0]},
+            'interpreter_ms': interpreter,
+            'first_request_ms': self._ready_time(FIRST_REQUEST),
+            'hub_ready_ms': self._ready_time(HUB_READY),
+            'import_ms': {'flaskserver': self._import_times('flaskserver'),
+                          'carcontrol': self._import_times('carcontrol')}}
+
+
+class Main:
+    """Contains the script"""
+
+    @staticmethod
+    def _parse_command_line_options():
+        """
+        Parse options from the command line.
+
+        :rtype: Namespace
+
+        """
+        description = 'Benchmark legcocar cold start.'
+        parser = argparse.ArgumentParser(description=description)
+        parser.add_argument('--repeat', '-n', type=int, default=5,
+                            help='Number of runs of every measurement.')
+        parser.add_argument('--no-bytecode', action='store_true',
+                            help='Compile the local modules in every run.')
+        parser.add_argument('--simulated-hub', action='store_true',
+                            help='Import the car control with the simulated '
+                                 'hub instead of bricknil.')
+        parser.add_argument('--output', '-o', type=str, default=None,
+                            help='Save results as JSON to this file.')
+        args = parser.parse_args()
+        return args
+
+    def run(self):
+        """
+        Run the script.
+
+        """
+        args = self._parse_command_line_options()
+        benchmark = StartupBenchmark(repeat=args.repeat,
+                                     bytecode=not args.no_bytecode,
+                                     simulated_hub=args.simulated_hub)
+        results = benchmark.run()
+        print(json.dumps(results, indent=4))
+        if args.output is not None:
+            with open(args.output, 'w') as file_obj:
+                json.dump(results, file_obj, indent=4)
+
+
+if __name__ == '__main__':
+    main = Main()
+    main.run()
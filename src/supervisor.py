@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Supervisor
+**********
+
+This module contains the car control supervisor. It runs the car control of
+every hub in its own worker process, so that the hubs don't share one core
+and one Python interpreter, restarts workers that exit with a backoff and
+collects the health reports the workers send over a pipe.
+
+"""
+
+# Built in modules
+import multiprocessing
+import multiprocessing.connection
+import os
+import time
+
+# Local modules
+from commonlib import write_json_file
+
+
+class Supervisor:
+    """Runs and restarts one worker process per hub."""
+
+    def __init__(self,
+                 hubs: list,
+                 target,
+                 args: tuple = (),
+                 pin_cores: bool = False,
+                 status_file: str = None,
+                 min_backoff: float = 1.0,
+                 max_backoff: float = 60.0,
+                 stable_time: float = 60.0,
+                 health_timeout: float = 30.0,
+                 log=print):
+        """
+        Constructor function.
+
+        :param hubs:           Hub names.
+        :param target:         Worker function, called with the hub name, the
+                               health pipe, the core to pin to (None if not
+                               pinned) and args.
+        :param args:           Extra worker function arguments.
+        :param pin_cores:      If each worker should be pinned to a core.
+        :param status_file:    Full path and name of the worker status file.
+                               The status is not written if not set.
+        :param min_backoff:    Seconds before the first restart of a worker.
+        :param max_backoff:    Max seconds before a restart. The backoff is
+                               doubled for every restart.
+        :param stable_time:    The backoff is reset when a worker has run this
+                               many seconds.
+        :param health_timeout: A worker that has not reported its health for
+                               this many seconds is stopped and restarted.
+        :param log:            Function called with log messages.
+
+        """
+        self.target = target
+        self.args = args
+        self.status_file = status_file
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.stable_time = stable_time
+        self.health_timeout = health_timeout
+        self._log = log
+        self._context = multiprocessing.get_context('spawn')
+        cores = os.cpu_count() or 1
+        self.workers = {}
+        """(*dict*) Hub name => worker state."""
+        for number, hub in enumerate(hubs):
+            self.workers[hub] = {
+                'core': number % cores if pin_cores else None,
+                'process': None,
+                'pipe': None,
+                'start_time': None,
+                'restart_time': 0.0,
+                'backoff': min_backoff,
+                'restarts': 0,
+                'exitcode': None,
+                'health': None,
+                'health_time': None}
+
+    def _start(self, hub: str):
+        """
+        Start the worker of a hub.
+
+        :param hub: Hub name.
+
+        """
+        worker = self.workers[hub]
+        receiver, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=self.target, name='legcocar-' + hub,
+            args=(hub, sender, worker['core']) + tuple(self.args),
+            daemon=True)
+        process.start()
+        sender.close()
+        now = time.monotonic()
+        worker.update(process=process, pipe=receiver, start_time=now,
+                      health_time=now)
+        self._log('Started worker {hub}, pid {pid}'.format(hub=hub,
+                                                           pid=process.pid))
+
+    def _exited(self, hub: str):
+        """
+        Handle the exit of a worker and schedule its restart.
+
+        :param hub: Hub name.
+
+        """
+        worker = self.workers[hub]
+        worker['process'].join()
+        worker['exitcode'] = worker['process'].exitcode
+        if worker['pipe'] is not None:
+            worker['pipe'].close()
+        now = time.monotonic()
+        if now - worker['start_time'] >= self.stable_time:
+            worker['backoff'] = self.min_backoff
+        worker['restart_time'] = now + worker['backoff']
+        self._log('Worker {hub} exited with {code}, restart in {s:.1f} '
+                  's'.format(hub=hub, code=worker['exitcode'],
+                             s=worker['backoff']))
+        worker['backoff'] = min(worker['backoff'] * 2, self.max_backoff)
+        worker['restarts'] += 1
+        worker.update(process=None, pipe=None)
+
+    def _receive(self, hub: str):
+        """
+        Receive a health report from a worker.
+
+        :param hub: Hub name.
+
+        """
+        worker = self.workers[hub]
+        try:
+            worker['health'] = worker['pipe'].recv()
+            worker['health_time'] = time.monotonic()
+        except (EOFError, OSError):
+            # The worker has closed its end, the exit is handled when the
+            # process sentinel is ready
+            worker['pipe'].close()
+            worker['pipe'] = None
+
+    def status(self):
+        """
+        Get the status of all workers.
+
+        :rtype:  dict
+        :return: Hub name => worker status.
+
+        """
+        now = time.monotonic()
+        status = {}
+        for hub, worker in self.workers.items():
+            process = worker['process']
+            status[hub] = {
+                'pid': process.pid if process is not None else None,
+                'running': process is not None,
+                'core': worker['core'],
+                'restarts': worker['restarts'],
+                'exitcode': worker['exitcode'],
+                'health_age': (round(now - worker['health_time'], 3)
+                               if worker['health_time'] is not None
+                               else None),
+                'health': worker['health']}
+        return status
+
+    def run_once(self, timeout: float = 1.0):
+        """
+        Start due workers and wait for health reports and exits.
+
+        :param timeout: Max seconds to wait.
+
+        """
+        now = time.monotonic()
+        for hub, worker in self.workers.items():
+            if worker['process'] is None and now >= worker['restart_time']:
+                self._start(hub)
+            elif (worker['process'] is not None and
+                  now - worker['health_time'] > self.health_timeout):
+                self._log('Worker {hub} is not reporting, stopping it'.format(
+                    hub=hub))
+                worker['process'].terminate()
+                worker['health_time'] = now
+
+        # Wait for health reports and exits
+        waitables = {}
+        for hub, worker in self.workers.items():
+            if worker['process'] is not None:
+                waitables[worker['process'].sentinel] = (hub, self._exited)
+                if worker['pipe'] is not None:
+                    waitables[worker['pipe']] = (hub, self._receive)
+        if not waitables:
+            time.sleep(timeout)
+            return
+        ready = multiprocessing.connection.wait(list(waitables),
+                                                timeout=timeout)
+        # Read health reports before handling exits
+        ready.sort(key=lambda obj: waitables[obj][1] == self._exited)
+        for obj in ready:
+            hub, handler = waitables[obj]
+            if handler == self._receive and self.workers[hub]['pipe'] is obj:
+                handler(hub)
+            elif handler == self._exited:
+                handler(hub)
+
+    def stop(self):
+        """
+        Stop all workers.
+
+        """
+        for worker in self.workers.values():
+            if worker['process'] is not None:
+                worker['process'].terminate()
+        for worker in self.workers.values():
+            if worker['process'] is not None:
+                worker['process'].join()
+                worker['process'] = None
+
+    def run(self):
+        """
+        Run the workers until interrupted.
+
+        """
+        try:
+            while True:
+                self.run_once()
+                if self.status_file is not None:
+                    write_json_file(self.status_file, self.status())
+        finally:
+            self.stop()
@@ -2,4 +2,8 @@ import sys
 
 sys.path.insert(0, '/srv/legcocar')
 
+import flaskserver
+
+flaskserver.load_settings()
+
 from flaskserver import web_server as application
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Car control tests
+*****************
+
+Tests of the car control that run on the simulated hub.
+
+"""
+
+# Built in modules
+import enum
+import json
+import os
+import sys
+import tempfile
+import unittest
+from functools import wraps
+from unittest import mock
+
+os.environ['LEGCOCAR_SIMULATED_HUB'] = '1'
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# Third party modules
+import curio
+
+# Local modules
+import carcontrol
+import simhub
+
+
+class FakePeripheral:
+    """Peripheral with capabilities like the bricknil peripherals."""
+
+    capability = enum.Enum('capability', ['sense_speed', 'sense_pos'])
+    """(*Enum*) Capabilities of the peripheral."""
+
+    def __init__(self, name: str, port: int = None, capabilities: list = ()):
+        """
+        Constructor function.
+
+        :param name:         Peripheral name.
+        :param port:         Hub port.
+        :param capabilities: Capability names, or name and delta tuples.
+
+        """
+        self.name = name
+        self.port = port
+        self.capabilities = [
+            self.capability[capability[0] if isinstance(capability, tuple)
+                            else capability]
+            for capability in capabilities]
+
+
+class bricknil_attach:
+    """Class decorator shaped like bricknil.attach."""
+
+    def __init__(self, peripheral_type, **kwargs):
+        """
+        Constructor function.
+
+        :param peripheral_type: Peripheral class.
+
+        """
+        self.peripheral_type = peripheral_type
+        self.kwargs = kwargs
+
+    def __call__(self, cls):
+        """
+        Decorate a hub class, the hub class is checked for sensor handlers.
+
+        :param cls: Hub class, or function that creates hubs.
+        :rtype:     function
+        :return:    Function that creates hubs with the peripheral attached.
+
+        """
+        @wraps(cls)
+        def wrapper_f(*args, **kwargs):
+            peripheral = self.peripheral_type(**self.kwargs)
+            if any([cap.name.startswith('sense')
+                    for cap in peripheral.capabilities]):
+                handler_name = f'{peripheral.name}_change'
+                assert hasattr(cls, handler_name), \
+                    f'{cls.__name__} needs a handler {handler_name}'
+            o = cls(*args, **kwargs)
+            setattr(o, peripheral.name, peripheral)
+            return o
+        return wrapper_f
+
+
+class TestAttachHardware(unittest.TestCase):
+    """Tests of :func:`carcontrol.attach_hardware`."""
+
+    def setUp(self):
+        """Use the bricknil shaped attach and fake peripherals."""
+        types = {name: FakePeripheral for name in carcontrol.PERIPHERAL_TYPES}
+        patches = [mock.patch.object(carcontrol, 'attach', bricknil_attach),
+                   mock.patch.object(carcontrol, 'PERIPHERAL_TYPES', types)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_default_hardware(self):
+        """All default peripherals are attached to the car."""
+        car = carcontrol.attach_hardware(carcontrol.Car)(name='hub2')
+        self.assertIsInstance(car, carcontrol.Car)
+        for name in carcontrol.DEFAULT_HARDWARE:
+            self.assertIsInstance(getattr(car, name), FakePeripheral)
+
+    def test_missing_handler(self):
+        """A sensing peripheral without a handler is not attached."""
+        hardware = {'unknown_motor': {'type': 'CPlusLargeMotor', 'port': 0,
+                                      'capabilities': ['sense_pos']}}
+        with self.assertRaises(AssertionError):
+            carcontrol.attach_hardware(carcontrol.Car, hardware)(name='hub2')
+
+    def test_car_class_unchanged(self):
+        """Peripherals are not attached to the car class itself."""
+        namespace = dict(vars(carcontrol.Car))
+        carcontrol.attach_hardware(carcontrol.Car)(name='hub2')
+        self.assertEqual(dict(vars(carcontrol.Car)), namespace)
+
+
+class TestSimulatedHub(unittest.TestCase):
+    """Tests of the car on the simulated hub."""
+
+    def test_attach(self):
+        """The simulated attach works like the bricknil attach."""
+        car = carcontrol.attach_hardware(carcontrol.Car)(name='hub2')
+        self.assertEqual(set(car.peripherals),
+                         set(carcontrol.DEFAULT_HARDWARE))
+        for peripheral in car.peripherals.values():
+            self.assertIsNone(peripheral.value)
+
+    def test_unsigned_values(self):
+        """Sensed values are encoded unsigned, just like in bricknil."""
+        car = carcontrol.attach_hardware(carcontrol.Car)(name='hub2')
+        motor = car.steering_motor
+        sense_pos = motor.capability.sense_pos
+        self.assertEqual(motor.encode(sense_pos, -1), 0xFFFFFFFF)
+        self.assertIsNone(carcontrol.sensed_value(motor, sense_pos, 32))
+        motor.value = {sense_pos: motor.encode(sense_pos, -90)}
+        self.assertEqual(carcontrol.sensed_value(motor, sense_pos, 32), -90)
+
+    def test_position_only(self):
+        """Drive motors that only sense their position leave speed as is."""
+        hardware = dict(carcontrol.DEFAULT_HARDWARE)
+        hardware['drive_motor1'] = dict(hardware['drive_motor1'],
+                                        capabilities=['sense_pos'])
+        carcontrol.check_hardware(hardware)
+        car = carcontrol.attach_hardware(carcontrol.Car, hardware)(
+            name='hub2')
+        motor = car.drive_motor1
+        sense_pos = motor.capability.sense_pos
+        motor.value = {sense_pos: motor.encode(sense_pos, 90)}
+        with mock.patch.object(carcontrol, 'flight_recorder') as recorder:
+            curio.run(car.drive_motor1_change)
+        recorder.write.assert_not_called()
+        self.assertEqual(car._speed, 0)
+
+
+class TestPortMap(unittest.TestCase):
+    """Tests of the port map cache."""
+
+    def setUp(self):
+        """Use a port map file in a temporary directory."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.port_map_file = os.path.join(directory.name, 'ports.json')
+
+    def _connect(self, reports: dict = None):
+        """
+        Create a car and report its peripherals attached.
+
+        :param reports: Port => reported device name, the configured
+                        peripherals are reported if not set.
+        :rtype:         Car
+        :return:        Car.
+
+        """
+        car = carcontrol.attach_hardware(carcontrol.Car)(
+            name='hub2', query_port_info=True, ble_id='90:84:2B:4E:35:B4',
+            port_map_file=self.port_map_file)
+        car.use_cached_port_map()
+        if reports is None:
+            reports = {peripheral.port: peripheral.sensor_name
+                       for peripheral in car.peripherals.values()}
+
+        async def report():
+            for port, device_name in reports.items():
+                await car.connect_peripheral_to_port(device_name, port)
+
+        curio.run(report)
+        return car
+
+    def test_cached(self):
+        """Port info is not queried when the hub reported the same ports."""
+        self.assertTrue(self._connect().query_port_info)
+        self.assertFalse(self._connect().query_port_info)
+
+    def test_changed(self):
+        """Port info is queried when the hub reported other peripherals."""
+        self._connect()
+        with self.assertRaises(simhub.DifferentPeripheralOnPortError):
+            self._connect({0: 'Technic Control+ XL Motor',
+                           1: 'Technic Control+ XL Motor',
+                           2: 'Technic Control+ XL Motor',
+                           3: 'Technic Control+ Large Motor'})
+        self.assertTrue(self._connect().query_port_info)
+
+
+class TestRestoredLights(unittest.TestCase):
+    """Tests of the lights restored from the state file."""
+
+    def _start(self, state: dict):
+        """
+        Create a car from a state file and turn on its restored lights.
+
+        :param state: State file contents.
+        :rtype:       Car
+        :return:      Car.
+
+        """
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        state_file = os.path.join(directory.name, 'state.json')
+        with open(state_file, 'w') as file_obj:
+            json.dump(state, file_obj)
+        car = carcontrol.attach_hardware(carcontrol.Car)(
+            name='hub2', state_file=state_file)
+        car._restore_lights()
+        return car
+
+    def test_saved_command(self):
+        """Lights that were on are turned on with their saved command."""
+        car = self._start({'_headlight_status': True,
+                           '_tail_light_status': False,
+                           'lights': {'headlights': [
+                               {'brightness': 40, 'effect': 'pulse'},
+                               'steady']}})
+        self.assertTrue(car._headlight_status)
+        self.assertTrue(car._light_effects.is_running('headlights'))
+        self.assertEqual(car._light_effects._effects['headlights'].brightness,
+                         40)
+        self.assertFalse(car._light_effects.is_running('tail_lights'))
+
+    def test_status_only(self):
+        """Lights saved without their command are turned on with defaults."""
+        car = self._start({'_left_indicator_status': True})
+        self.assertTrue(car._left_indicator_status)
+        self.assertTrue(car._light_effects.is_running('left_indicators'))
+
+
+class TestLightStatus(unittest.TestCase):
+    """Tests of the light status kept by the car."""
+
+    def setUp(self):
+        """Create a car with the headlights on."""
+        self.car = carcontrol.attach_hardware(carcontrol.Car)(name='hub2')
+        curio.run(self.car.set_headlight_brightness, {'brightness': 80})
+        self._advance()
+
+    def _advance(self):
+        """
+        Advance the light effects one tick as if the writes were sent.
+
+        :rtype:  dict
+        :return: Light name => brightness written.
+
+        """
+        writes = self.car._light_effects._advance()
+        self.car._light_effects.brightness.update(writes)
+        return writes
+
+    def test_invalid(self):
+        """Invalid commands keep the status of a steady light."""
+        curio.run(self.car.set_headlight_brightness, {'effect': 'strobe'})
+        self.assertTrue(self.car._headlight_status)
+
+    def test_fade_off(self):
+        """Lights fade down to 0 and then their status is cleared."""
+        curio.run(self.car.set_headlight_brightness,
+                  {'effect': 'fade', 'brightness': 0, 'fade_time': 0.2})
+        self.assertTrue(self.car._headlight_status)
+        writes = [self._advance() for _ in range(4)]
+        self.assertEqual([write['headlights'] for write in writes],
+                         [60, 40, 20, 0])
+        self.assertFalse(self.car._headlight_status)
+
+    def test_timed_blink(self):
+        """The indicator status is cleared when a timed blink ends."""
+        curio.run(self.car.set_indicator_lights,
+                  {'left': True, 'duration': 1.0})
+        self.assertTrue(self.car._left_indicator_status)
+        for _ in range(100):
+            self._advance()
+        self.assertFalse(self.car._left_indicator_status)
+        self.assertFalse(self.car._light_effects.is_running('left_indicators'))
+
+
+class TestSteeringCalibration(unittest.TestCase):
+    """Tests of the steering end stop calibration."""
+
+    def setUp(self):
+        """Create a car with a calibration file and fake end stops."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.calibration_file = os.path.join(directory.name, 'cal.json')
+        self.car = carcontrol.attach_hardware(carcontrol.Car)(
+            name='hub2', ble_id='AA:BB',
+            calibration_file=self.calibration_file)
+        self.probed = []
+
+        async def find_end_stop(speed: int):
+            self.probed.append(speed)
+            return -100 if speed < 0 else 80
+
+        self.car._find_steering_end_stop = find_end_stop
+
+    def test_sweep(self):
+        """Both end stops are found if no limits are cached."""
+        curio.run(self.car._calibrate_steering)
+        self.assertEqual(self.probed, [-15, 15])
+        self.assertEqual((self.car._steering_max_left,
+                          self.car._steering_max_right), (-100, 80))
+        with open(self.calibration_file) as file_obj:
+            self.assertEqual(json.load(file_obj),
+                             {'AA:BB': {'left': -100, 'right': 80}})
+
+    def test_power_cycled(self):
+        """The cached range is moved to the probed left end stop."""
+        with open(self.calibration_file, 'w') as file_obj:
+            json.dump({'AA:BB': {'left': -20, 'right': 160}}, file_obj)
+        curio.run(self.car._calibrate_steering)
+        self.assertEqual(self.probed, [-15])
+        self.assertEqual((self.car._steering_max_left,
+                          self.car._steering_max_right), (-100, 80))
+
+
+class TestShift(unittest.TestCase):
+    """Tests of the gear shift."""
+
+    def test_speed_during_shift(self):
+        """A speed commanded during a shift is not overwritten."""
+        car = carcontrol.attach_hardware(carcontrol.Car)(name='hub2')
+        car._drive_speed = 50
+        ramps = []
+
+        async def ramp_drive_speed(speed: int, ramp_time_ms: int,
+                                   wait: bool = True):
+            ramps.append(speed)
+
+        async def write(method, *args, **kwargs):
+            # The gear change motor reaches the gear and a speed command is
+            # handled while it moves
+            car._gear_change_motor_pos = kwargs['pos']
+            car._drive_speed = 30
+
+        car._ramp_drive_speed = ramp_drive_speed
+        car._write = write
+        curio.run(car._shift, 2)
+        self.assertEqual(ramps, [0, 30])
+        self.assertEqual(car._drive_speed, 30)
+        self.assertFalse(car._shifting)
+
+
+class TestProfile(unittest.TestCase):
+    """Tests of the motion profiles."""
+
+    def test_saved(self):
+        """The state changed by each profile step is saved."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        state_file = os.path.join(directory.name, 'state.json')
+        car = carcontrol.attach_hardware(carcontrol.Car)(
+            name='hub2', state_file=state_file)
+        saved = []
+        write_json_file = carcontrol.write_json_file
+
+        def save(path: str, state: dict):
+            saved.append(state['_steering_pos'])
+            write_json_file(path, state)
+
+        with mock.patch.object(carcontrol, 'write_json_file', save):
+            curio.run(car._run_profile, [{'time': 0, 'steering': 20},
+                                         {'time': 0, 'steering': -20}])
+        self.assertEqual(saved, [20, -20])
+        with open(state_file) as file_obj:
+            self.assertEqual(json.load(file_obj)['_steering_pos'], -20)
+
+
+class TestSkippedCommands(unittest.TestCase):
+    """Tests of the commands that are skipped or coalesced."""
+
+    def setUp(self):
+        """Create a car driving at speed 50."""
+        self.car = carcontrol.attach_hardware(carcontrol.Car)(name='hub2')
+        self.car._drive_speed = 50
+        self.car._speed = 48
+
+    def test_noop_speed(self):
+        """A speed equal to the commanded and sensed speed is skipped."""
+        self.assertTrue(self.car._is_noop({'command': 'speed', 'speed': 50}))
+        self.assertFalse(self.car._is_noop({'command': 'speed', 'speed': 60}))
+        self.car._speed = 40
+        self.assertFalse(self.car._is_noop({'command': 'speed', 'speed': 50}))
+        self.car._speed = 50
+        self.car._shifting = True
+        self.assertFalse(self.car._is_noop({'command': 'speed', 'speed': 50}))
+
+    def test_noop_steering(self):
+        """A steering command is skipped only if no setting would change."""
+        self.car._steering_pos = 20
+        self.car._steering_motor_pos = 21
+        body = {'command': 'steering', 'position': 20}
+        self.assertTrue(self.car._is_noop(body))
+        self.assertFalse(self.car._is_noop(dict(body, max_power=10)))
+        self.car._steering_motor_pos = 30
+        self.assertFalse(self.car._is_noop(body))
+
+    def test_not_setpoints(self):
+        """Commands without a setpoint are never skipped."""
+        self.assertFalse(self.car._is_noop({'command': 'headlights'}))
+
+    def test_coalesce(self):
+        """Only the last setpoint with the same keys is kept, not shifts."""
+        bodies = [{'command': 'speed', 'speed': 10},
+                  {'command': 'gearbox', 'change_up': True},
+                  {'command': 'speed', 'speed': 20},
+                  {'command': 'gearbox', 'change_up': True},
+                  {'command': 'speed', 'speed': 30}]
+        self.assertEqual(self.car._coalesce(bodies),
+                         [bodies[1], bodies[3], bodies[4]])
+        self.assertEqual(self.car.metrics['coalesced_commands'], 2)
+
+    def test_different_keys(self):
+        """Commands with different body keys are not merged."""
+        bodies = [{'command': 'steering', 'position': 10, 'max_power': 30},
+                  {'command': 'steering', 'position': 20}]
+        self.assertEqual(self.car._coalesce(bodies), bodies)
+        self.assertEqual(self.car.metrics['coalesced_commands'], 0)
+
+
+class TestSensedValue(unittest.TestCase):
+    """Tests of :func:`carcontrol.sensed_value`."""
+
+    def setUp(self):
+        """Create a peripheral with speed sensing."""
+        self.capability = FakePeripheral.capability.sense_speed
+        self.peripheral = FakePeripheral('drive_motor1', 0,
+                                         [('sense_speed', 5)])
+        self.peripheral.value = None
+
+    def test_not_sensed(self):
+        """Nothing is sensed before and after updates are activated."""
+        self.assertIsNone(
+            carcontrol.sensed_value(self.peripheral, self.capability, 8))
+        self.peripheral.value = {self.capability: [None]}
+        self.assertIsNone(
+            carcontrol.sensed_value(self.peripheral, self.capability, 8))
+
+    def test_signed(self):
+        """Unsigned values are converted to signed values."""
+        for raw, bits, value in ((5, 8, 5), (127, 8, 127), (128, 8, -128),
+                                 (251, 8, -5), (0xFFFFFFFF, 32, -1),
+                                 (1000, 32, 1000)):
+            self.peripheral.value = {self.capability: raw}
+            self.assertEqual(carcontrol.sensed_value(
+                self.peripheral, self.capability, bits), value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Controller tests
+****************
+
+Tests of the motor position controllers, driven with synthetic positions.
+
+"""
+
+# Built in modules
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# Local modules
+from controllers import GearHold, SteeringController
+
+
+class TestGearHold(unittest.TestCase):
+    """Tests of :class:`controllers.GearHold`."""
+
+    def setUp(self):
+        """Create a gear hold with gear 2 at 90 degrees."""
+        self.gear_hold = GearHold(band=4, settle_band=1, debounce=0.25,
+                                  min_interval=0.5)
+        self.gear_hold.set_gears(offset=90, adjust=0, gear_number=4)
+
+    def test_band(self):
+        """Positions within the band are held without corrections."""
+        self.assertEqual(self.gear_hold.positions, [0, 90, 180, 270])
+        for now, position in enumerate((86, 90, 94, 90, 86)):
+            self.assertIsNone(self.gear_hold.update(2, position, now))
+        self.assertIsNone(self.gear_hold.update(2, 95, 10.0))
+        self.assertEqual(self.gear_hold.update(2, 95, 10.25), 90)
+        self.assertEqual(self.gear_hold.corrections, 1)
+
+    def test_debounce(self):
+        """Positions must stay outside the band for the debounce time."""
+        self.assertIsNone(self.gear_hold.update(2, 96, 0.0))
+        self.assertIsNone(self.gear_hold.update(2, 96, 0.125))
+        # Back within the band restarts the debounce
+        self.assertIsNone(self.gear_hold.update(2, 92, 0.1875))
+        self.assertIsNone(self.gear_hold.update(2, 96, 0.25))
+        self.assertIsNone(self.gear_hold.update(2, 96, 0.375))
+        self.assertEqual(self.gear_hold.update(2, 96, 0.5), 90)
+
+    def test_rate_limit(self):
+        """Unsettled corrections are repeated at most every min_interval."""
+        self.gear_hold.update(2, 100, 0.0)
+        self.assertEqual(self.gear_hold.update(2, 100, 0.25), 90)
+        # Within the band but not settled, the correction is still running
+        self.assertIsNone(self.gear_hold.update(2, 93, 0.375))
+        self.assertIsNone(self.gear_hold.update(2, 93, 0.625))
+        self.assertEqual(self.gear_hold.update(2, 93, 0.75), 90)
+        self.assertEqual(self.gear_hold.corrections, 2)
+
+    def test_settle(self):
+        """The position is held again when a correction has settled."""
+        self.gear_hold.update(2, 100, 0.0)
+        self.gear_hold.update(2, 100, 0.25)
+        self.assertIsNone(self.gear_hold.update(2, 91, 0.375))
+        self.assertIsNone(self.gear_hold.update(2, 94, 1.0))
+        self.assertIsNone(self.gear_hold.update(2, 95, 1.125))
+        self.assertEqual(self.gear_hold.update(2, 95, 1.375), 90)
+
+    def test_reset(self):
+        """A reset restarts the debounce, for example after a shift."""
+        self.gear_hold.update(2, 100, 0.0)
+        self.gear_hold.reset()
+        self.assertIsNone(self.gear_hold.update(3, 170, 0.25))
+        self.assertEqual(self.gear_hold.update(3, 170, 0.5), 180)
+
+
+class TestSteeringController(unittest.TestCase):
+    """Tests of :class:`controllers.SteeringController`."""
+
+    def setUp(self):
+        """Create a proportional controller."""
+        self.controller = SteeringController(kp=1.5, ki=0, kd=0, deadband=2,
+                                             slew_rate=400, output_step=5,
+                                             stall_time=0.25)
+
+    def _update(self, position: float, target: float = 100,
+                dt: float = 0.0625):
+        """
+        Update the controller.
+
+        :param position: Sensed position.
+        :param target:   Target position.
+        :param dt:       Seconds since last update.
+        :rtype:          int
+        :return:         Motor speed.
+
+        """
+        return self.controller.update(target=target, position=position,
+                                      max_output=50, dt=dt)
+
+    def test_deadband(self):
+        """There is no output within the deadband."""
+        self.assertEqual(self._update(98), 0)
+        self.assertEqual(self._update(102), 0)
+        self.assertEqual(self._update(97), 5)
+        self.assertEqual(self._update(103), -5)
+
+    def test_slew_rate(self):
+        """The output changes at most slew_rate per second."""
+        outputs = [self._update(position, dt=0.01)
+                   for position in range(0, 20, 2)]
+        self.assertEqual(outputs, [5, 10, 10, 15, 20, 25, 30, 30, 35, 40])
+        outputs = [self._update(position, dt=0.01)
+                   for position in range(20, 40, 2)]
+        self.assertEqual(outputs[-1], 50)
+
+    def test_stall(self):
+        """A motor that stops moving is stalled until the target changes."""
+        self.assertNotEqual(self._update(10), 0)
+        self.assertNotEqual(self._update(10.5), 0)
+        self.assertNotEqual(self._update(10), 0)
+        self.assertNotEqual(self._update(10.5), 0)
+        self.assertEqual(self._update(10), 0)
+        self.assertEqual(self.controller.stalls, 1)
+        self.assertEqual(self._update(30), 0)
+        self.assertNotEqual(self._update(30, target=-100), 0)
+        self.assertEqual(self.controller.stalls, 1)
+
+    def test_moving(self):
+        """A moving motor is not stalled."""
+        for position in range(0, 80, 2):
+            self.assertNotEqual(self._update(position), 0)
+        self.assertEqual(self.controller.stalls, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Flask server tests
+******************
+
+Tests of the input filter and the request validation of the web server.
+
+"""
+
+# Built in modules
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# Local modules
+import flaskserver
+
+
+class FakeTimer:
+    """Timer that is fired by the test, like threading.Timer."""
+
+    timers = []
+    """(*list*) Started timers."""
+
+    def __init__(self, interval: float, function, args: tuple = ()):
+        """
+        Constructor function.
+
+        :param interval: Seconds until the timer fires.
+        :param function: Function called when the timer fires.
+        :param args:     Function arguments.
+
+        """
+        self.interval = interval
+        self.function = function
+        self.args = args
+        self.daemon = False
+
+    def start(self):
+        """Start the timer."""
+        FakeTimer.timers.append(self)
+
+    def fire(self):
+        """Fire the timer."""
+        FakeTimer.timers.remove(self)
+        self.function(*self.args)
+
+
+class TestInputFilter(unittest.TestCase):
+    """Tests of :class:`flaskserver.InputFilter`."""
+
+    def setUp(self):
+        """Create a filter with a fake clock and timers."""
+        self.now = 100.0
+        FakeTimer.timers = []
+        self.published = []
+        self.input_filter = flaskserver.InputFilter(
+            clock=lambda: self.now, timer=FakeTimer)
+
+    def _filter(self, speed: int):
+        """
+        Filter a speed update.
+
+        :param speed: Speed.
+        :rtype:       tuple
+        :return:      Arguments to publish and the reason they were dropped.
+
+        """
+        return self.input_filter.filter('client', 'speed', {'speed': speed},
+                                        publish=self.published.append)
+
+    def test_trailing_edge(self):
+        """The last update dropped by the rate limit is published later."""
+        self.assertEqual(self._filter(50), ({'speed': 50}, None))
+        self.now += 0.01
+        self.assertEqual(self._filter(60), (None, 'rate'))
+        self.assertEqual(self._filter(70), (None, 'rate'))
+        self.assertEqual(len(FakeTimer.timers), 1)
+        self.assertAlmostEqual(FakeTimer.timers[0].interval, 0.04)
+        self.now += 0.04
+        FakeTimer.timers[0].fire()
+        self.assertEqual(self.published, [{'speed': 70}])
+        self.assertEqual(self._filter(71), (None, 'unchanged'))
+
+    def test_superseded(self):
+        """A dropped update is not published after a later update."""
+        self._filter(50)
+        self.now += 0.01
+        self._filter(60)
+        self.now += 0.05
+        self.assertEqual(self._filter(80), ({'speed': 80}, None))
+        FakeTimer.timers[0].fire()
+        self.assertEqual(self.published, [])
+
+    def test_max_rate(self):
+        """A max rate that is not more than 0 is invalid."""
+        with self.assertRaises(ValueError):
+            self.input_filter.configure({'speed': {'max_rate': 0}})
+        self.assertEqual(self.input_filter.filters['speed']['max_rate'],
+                         flaskserver.INPUT_FILTERS['speed']['max_rate'])
+
+
+class TestLightRequest(unittest.TestCase):
+    """Tests of the light request validation."""
+
+    def test_invalid(self):
+        """Unknown effects and times that are not more than 0 are invalid."""
+        client = flaskserver.web_server.test_client()
+        for path, body in (('/api/headlights', {'effect': 'strobe'}),
+                           ('/api/headlights', {'period': 0.0}),
+                           ('/api/indicators', {'left': True,
+                                                'interval': -0.5})):
+            response = client.post(path, json=body)
+            self.assertEqual(response.status_code, 400)
+
+
+class TestCarRequest(unittest.TestCase):
+    """Tests of the car selection."""
+
+    def test_unknown(self):
+        """Requests to cars that are not configured are not found."""
+        config = SimpleNamespace(HUBS=[{'name': 'hub2'}],
+                                 reload_if_changed=set)
+        client = flaskserver.web_server.test_client()
+        with mock.patch.object(flaskserver, 'config', config):
+            response = client.post('/api/cars/hub3/speed',
+                                   json={'speed': 10})
+            self.assertEqual(response.status_code, 404)
+            response = client.post('/api/speed', json={'speed': 10},
+                                   headers={'X-Car': 'hub3'})
+            self.assertEqual(response.status_code, 404)
+
+    def test_unknown_command(self):
+        """Unknown commands to a car are not found."""
+        config = SimpleNamespace(HUBS=[{'name': 'hub2'}],
+                                 reload_if_changed=set)
+        client = flaskserver.web_server.test_client()
+        with mock.patch.object(flaskserver, 'config', config):
+            response = client.post('/api/cars/hub2/foo', json={})
+        self.assertEqual(response.status_code, 404)
+        self.assertIn('speed', response.get_json()['message'])
+
+
+if __name__ == '__main__':
+    unittest.main()
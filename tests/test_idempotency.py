@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Idempotency tests
+*****************
+
+Tests of the cache of executed idempotency keys.
+
+"""
+
+# Built in modules
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# Local modules
+from idempotency import IdempotencyCache
+
+
+class TestIdempotencyCache(unittest.TestCase):
+    """Tests of :class:`idempotency.IdempotencyCache`."""
+
+    def setUp(self):
+        """Create a small cache."""
+        self.cache = IdempotencyCache(size=3, ttl=10.0)
+
+    def test_duplicate(self):
+        """Keys that have been seen are duplicates."""
+        self.assertFalse(self.cache.seen('a', 0.0))
+        self.assertTrue(self.cache.seen('a', 1.0))
+        self.assertTrue(self.cache.seen('a', 2.0))
+        self.assertFalse(self.cache.seen('b', 3.0))
+        self.assertEqual(self.cache.duplicates, 2)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_eviction_order(self):
+        """The least recently seen key is forgotten first."""
+        for now, key in enumerate('abc'):
+            self.cache.seen(key, now)
+        self.assertTrue(self.cache.seen('a', 3.0))
+        self.assertFalse(self.cache.seen('d', 4.0))
+        self.assertEqual(len(self.cache), 3)
+        self.assertFalse(self.cache.seen('b', 5.0))
+        self.assertTrue(self.cache.seen('a', 6.0))
+        self.assertTrue(self.cache.seen('d', 7.0))
+
+    def test_expiry(self):
+        """Keys are forgotten when they have not been seen for ttl."""
+        self.cache.seen('a', 0.0)
+        self.cache.seen('b', 5.0)
+        self.assertTrue(self.cache.seen('a', 10.0))
+        self.assertTrue(self.cache.seen('b', 15.0))
+        self.assertFalse(self.cache.seen('a', 20.5))
+        self.assertTrue(self.cache.seen('b', 21.0))
+
+    def test_size_lowered(self):
+        """Keys are dropped until the cache fits a lowered size."""
+        for now, key in enumerate('abc'):
+            self.cache.seen(key, now)
+        self.cache.size = 1
+        self.assertFalse(self.cache.seen('d', 3.0))
+        self.assertEqual(len(self.cache), 1)
+        self.assertTrue(self.cache.seen('d', 4.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Journal tests
+*************
+
+Tests of the flight recorder journal.
+
+"""
+
+# Built in modules
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# Local modules
+from journal import COMMAND, SENSOR, Journal, decode_journal
+
+
+class TestJournal(unittest.TestCase):
+    """Tests of :class:`journal.Journal`."""
+
+    def setUp(self):
+        """Create a journal file path."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'journal')
+
+    def test_round_trip(self):
+        """Records are decoded as they were written."""
+        journal = Journal(path=self.path, records=8)
+        journal.write(COMMAND, 'speed', 1)
+        journal.write(SENSOR, 'steering_motor.pos', -90)
+        journal.write(SENSOR, 'steering_motor.pos', 2 ** 40)
+        journal.close()
+        records = decode_journal(self.path)
+        self.assertEqual(
+            [(record['seq'], record['event'], record['source'],
+              record['value']) for record in records],
+            [(0, 'command', 'speed', 1),
+             (1, 'sensor', 'steering_motor.pos', -90),
+             (2, 'sensor', 'steering_motor.pos', 0x7fffffff)])
+        self.assertLessEqual(records[0]['time'], records[2]['time'])
+
+    def test_wrap(self):
+        """The ring keeps the last records when it wraps, oldest first."""
+        journal = Journal(path=self.path, records=4)
+        for value in range(10):
+            journal.write(SENSOR, 'drive_motor1.speed', value)
+        journal.close()
+        records = decode_journal(self.path)
+        self.assertEqual([record['seq'] for record in records],
+                         [6, 7, 8, 9])
+        self.assertEqual([record['value'] for record in records],
+                         [6, 7, 8, 9])
+
+    def test_continued(self):
+        """A journal with the same capacity is continued after a restart."""
+        journal = Journal(path=self.path, records=4)
+        for value in range(3):
+            journal.write(SENSOR, 'drive_motor1.speed', value)
+        journal.close()
+        journal = Journal(path=self.path, records=4)
+        journal.write(COMMAND, 'gearbox', 3)
+        journal.write(SENSOR, 'drive_motor1.speed', 4)
+        journal.close()
+        records = decode_journal(self.path)
+        self.assertEqual(
+            [(record['seq'], record['source'], record['value'])
+             for record in records],
+            [(1, 'drive_motor1.speed', 1), (2, 'drive_motor1.speed', 2),
+             (3, 'gearbox', 3), (4, 'drive_motor1.speed', 4)])
+
+
+if __name__ == '__main__':
+    unittest.main()
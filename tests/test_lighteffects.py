@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Light effects tests
+*******************
+
+Tests of the timer wheel that runs the light effects.
+
+"""
+
+# Built in modules
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# Third party modules
+import curio
+
+# Local modules
+from lighteffects import Blink, Fade, LightEffects, Steady
+
+
+class FakeLight:
+    """Light that records the brightness written to it."""
+
+    def __init__(self):
+        self.written = []
+        """(*list*) Brightness values written."""
+
+    async def set_brightness(self, brightness: int):
+        """
+        Set the brightness.
+
+        :param brightness: Brightness 0-100.
+
+        """
+        self.written.append(brightness)
+
+
+class TestLightEffects(unittest.TestCase):
+    """Tests of :class:`lighteffects.LightEffects`."""
+
+    def setUp(self):
+        """Create an engine with a small wheel."""
+        self.finished = []
+        self.light_effects = LightEffects(
+            hub=None, tick_time=0.1, wheel_size=8,
+            on_finish=lambda light, brightness: self.finished.append(
+                (light, brightness)))
+
+    def _run(self, ticks: int):
+        """
+        Advance the engine as if the writes were sent.
+
+        :param ticks: Number of ticks.
+        :rtype:       list
+        :return:      Light name => brightness written, for each tick.
+
+        """
+        result = []
+        for _ in range(ticks):
+            writes = self.light_effects._advance()
+            self.light_effects.brightness.update(writes)
+            result.append(writes)
+        return result
+
+    def test_blink(self):
+        """Blinks are on and off for their length and interval."""
+        self.light_effects.set_effect('headlights', Blink(
+            brightness=100, length=0.2, interval=0.5, duration=1.0))
+        writes = self._run(12)
+        self.assertEqual(
+            [tick.get('headlights') for tick in writes],
+            [100, None, 0, None, None, 100, None, 0, None, None, None, None])
+        self.assertEqual(self.finished, [('headlights', 0)])
+        self.assertFalse(self.light_effects.is_running('headlights'))
+
+    def test_wrap(self):
+        """Effects due more than one wheel turn ahead wait for their tick."""
+        self.light_effects.set_effect('headlights',
+                                      Steady(brightness=50, duration=2.0))
+        writes = self._run(22)
+        self.assertEqual(writes[0], {'headlights': 50})
+        self.assertEqual(writes[20], {'headlights': 0})
+        self.assertEqual([tick for tick in writes if tick],
+                         [writes[0], writes[20]])
+        self.assertEqual(self.finished, [('headlights', 0)])
+
+    def test_replaced(self):
+        """Replaced effects are not stepped and do not finish."""
+        self.light_effects.set_effect('headlights',
+                                      Steady(brightness=50, duration=0.3))
+        self._run(1)
+        self.light_effects.set_effect('headlights',
+                                      Fade(brightness=100, fade_time=1.0))
+        writes = self._run(12)
+        self.assertEqual(writes[-3:], [{'headlights': 100}, {}, {}])
+        self.assertEqual(self.finished, [('headlights', 100)])
+
+    def test_unchanged(self):
+        """Brightness that is already written is not written again."""
+        self.light_effects.set_effect('headlights', Steady(brightness=50))
+        self.assertEqual(self._run(1), [{'headlights': 50}])
+        self.light_effects.set_effect('headlights', Steady(brightness=50))
+        self.assertEqual(self._run(1), [{}])
+        self.assertEqual(self.finished, [('headlights', 50)] * 2)
+
+    def test_run(self):
+        """Lights that are not attached are skipped when writing."""
+        headlights = FakeLight()
+        light_effects = LightEffects(
+            hub=SimpleNamespace(headlights=headlights), tick_time=0.1)
+        light_effects.set_effect('headlights', Steady(brightness=50))
+        light_effects.set_effect('tail_lights', Steady(brightness=30))
+
+        async def sleep(seconds: float):
+            if light_effects.writes:
+                raise curio.TaskCancelled()
+
+        with self.assertRaises(curio.TaskCancelled):
+            curio.run(light_effects.run, sleep)
+        self.assertEqual(headlights.written, [50])
+        self.assertEqual(light_effects.brightness,
+                         {'headlights': 50, 'tail_lights': 30})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Link monitor tests
+******************
+
+Tests of the link monitor and the command pacer.
+
+"""
+
+# Built in modules
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# Local modules
+from linkmonitor import LinkMonitor, Pacer
+
+
+class TestLinkMonitor(unittest.TestCase):
+    """Tests of :class:`linkmonitor.LinkMonitor`."""
+
+    def test_round_trip(self):
+        """The latency is measured from a request to its answer."""
+        monitor = LinkMonitor(alpha=1.0)
+        monitor.write_started(10.0)
+        monitor.write_started(10.0, 'steering_motor')
+        monitor.write_started(10.01, 'steering_motor')
+        monitor.notification(10.03, 'drive_motor1')
+        monitor.notification(10.04, 'steering_motor')
+        self.assertEqual(monitor.writes, 3)
+        self.assertAlmostEqual(monitor.latency, 0.04)
+
+    def test_unanswered(self):
+        """Requests that are not answered in time are not measured."""
+        monitor = LinkMonitor(alpha=1.0, default_latency=0.02,
+                              max_latency=1.0)
+        monitor.write_started(10.0, 'steering_motor')
+        monitor.notification(12.0, 'steering_motor')
+        self.assertEqual(monitor.latency, 0.02)
+
+
+class TestPacer(unittest.TestCase):
+    """Tests of :class:`linkmonitor.Pacer`."""
+
+    def test_min_write_time(self):
+        """Writes get at least the min write time of the link."""
+        monitor = LinkMonitor(default_latency=0.001)
+        pacer = Pacer(monitor, min_write_time=0.01, headroom=0.2)
+        self.assertAlmostEqual(pacer.command_done(2), 0.024)
+
+    def test_max_delay(self):
+        """A degraded link does not stall the dispatcher."""
+        monitor = LinkMonitor(default_latency=1.0)
+        pacer = Pacer(monitor, max_delay=0.5)
+        self.assertEqual(pacer.command_done(3), 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
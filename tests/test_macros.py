@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Macro tests
+***********
+
+Tests of the macro compiler and the light command checks.
+
+"""
+
+# Built in modules
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# Local modules
+from lighteffects import Pulse, effect_from_body
+from macros import MacroError, compile_macros
+
+
+class TestLightArgs(unittest.TestCase):
+    """Tests of the light command checks."""
+
+    def test_macro(self):
+        """Macros with unknown effects or non-positive times are invalid."""
+        for step in ({'effect': 'strobe'}, {'effect': 'pulse', 'period': 0},
+                     {'fade_time': -1.0}, {'length': float('nan')}):
+            with self.assertRaises(MacroError):
+                compile_macros({'lights': [
+                    {'time': 0, 'command': 'headlights', **step}]})
+        macros = compile_macros({'lights': [
+            {'time': 0, 'command': 'indicators', 'effect': 'pulse',
+             'period': 0.5, 'left': True}]})
+        self.assertEqual(len(macros['lights']), 1)
+
+    def test_effect(self):
+        """Effects are not created from invalid light commands."""
+        with self.assertRaises(ValueError):
+            effect_from_body({'effect': 'pulse', 'period': 0})
+        with self.assertRaises(ValueError):
+            effect_from_body({'effect': 'strobe'})
+        self.assertIsInstance(effect_from_body({'effect': 'pulse'}), Pulse)
+
+
+if __name__ == '__main__':
+    unittest.main()
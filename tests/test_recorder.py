@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Recorder tests
+**************
+
+Tests of the command recordings.
+
+"""
+
+# Built in modules
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# Local modules
+from recorder import RECORD_HEADER, CommandRecorder, read_recording
+
+
+class TestRecording(unittest.TestCase):
+    """Tests of :class:`recorder.CommandRecorder` and
+    :func:`recorder.read_recording`."""
+
+    def setUp(self):
+        """Use a recording in a temporary directory."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'commands.rec')
+
+    def test_monotonic(self):
+        """Arrival times follow the monotonic clock, not the wall clock."""
+        with mock.patch('time.time', return_value=1000.0), \
+                mock.patch('time.monotonic', return_value=50.0):
+            recorder = CommandRecorder(self.path)
+        recorder.record(b'{"command": "speed"}', timestamp=50.5)
+        recorder.record('{"command": "steering"}', timestamp=51.0)
+        recorder.close()
+        self.assertEqual(list(read_recording(self.path)),
+                         [(1000.5, b'{"command": "speed"}'),
+                          (1001.0, b'{"command": "steering"}')])
+
+    def test_old_format(self):
+        """Recordings without session headers are read as before."""
+        now = time.time()
+        with open(self.path, 'wb') as file_obj:
+            file_obj.write(RECORD_HEADER.pack(now, 2) + b'{}')
+        self.assertEqual(list(read_recording(self.path)), [(now, b'{}')])
+
+
+if __name__ == '__main__':
+    unittest.main()
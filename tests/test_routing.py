@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Routing tests
+*************
+
+Tests of the weighted class queues.
+
+"""
+
+# Built in modules
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# Local modules
+from routing import WeightedQueues, class_queues
+
+
+class FakeChannel:
+    """Broker channel with messages in memory, counts the polls."""
+
+    def __init__(self, messages: dict):
+        """
+        Constructor function.
+
+        :param messages: Queue name => messages.
+
+        """
+        self.messages = messages
+        self.gets = 0
+
+    def basic_get(self, queue: str):
+        """
+        Get a message from a queue.
+
+        :param queue: Queue name.
+        :rtype:       tuple
+        :return:      Method frame, header frame and body, all None if the
+                      queue is empty.
+
+        """
+        self.gets += 1
+        if self.messages.get(queue):
+            return queue, None, self.messages[queue].pop(0)
+        return None, None, None
+
+
+class TestWeightedQueues(unittest.TestCase):
+    """Tests of :class:`routing.WeightedQueues`."""
+
+    def setUp(self):
+        """Create the class queues of two car queues."""
+        self.queues = WeightedQueues(class_queues(('to_lego.hub2',
+                                                   'to_lego')))
+
+    def test_empty(self):
+        """Every queue is polled once when all are empty."""
+        channel = FakeChannel({})
+        self.assertEqual(self.queues.get(channel), (None, None, None))
+        self.assertEqual(channel.gets, len(self.queues.queues))
+
+    def test_weights(self):
+        """Up to prefetch messages are taken before the next class."""
+        channel = FakeChannel({'to_lego.drive': list(range(6)),
+                               'to_lego.gear': ['a', 'b']})
+        names = []
+        for _ in range(8):
+            names.append(self.queues.get(channel)[0])
+        self.assertEqual(names, ['to_lego.drive'] * 4 + ['to_lego.gear'] +
+                         ['to_lego.drive'] * 2 + ['to_lego.gear'])
+        self.assertEqual(self.queues.get(channel), (None, None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Settings tests
+**************
+
+Tests of the settings loader and writer.
+
+"""
+
+# Built in modules
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# Third party modules
+import yaml
+
+# Local modules
+from settings import Settings, write_yaml
+
+CONFIG = '''\
+# Hubs controlled by the car control
+HUBS:
+# The first hub
+-   name: hub2
+    ble_id: '90:84:2B:4E:35:B4'
+    hardware:
+        steering_motor:
+            type: CPlusLargeMotor
+            port: 2
+            capabilities: [sense_pos]
+
+# Named command sequences
+MACROS:
+    launch:
+    # Lights first
+    -   {time: 0, command: headlights, brightness: 100}
+    -   {time: 0.5, command: speed, speed: 100}
+
+# Logging verbosity 0-50
+LOG_VERBOSITY: 1  # Quiet
+'''
+"""(*str*) Config file with comments, flow style and quotes."""
+
+
+class TestWriteYaml(unittest.TestCase):
+    """Tests of :func:`settings.write_yaml`."""
+
+    def setUp(self):
+        """Write the config to a temporary directory."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'legcocar.conf')
+        with open(self.path, 'w') as file_obj:
+            file_obj.write(CONFIG)
+        self.settings = yaml.safe_load(CONFIG)
+
+    def _write(self):
+        """
+        Write the settings.
+
+        :rtype:  str
+        :return: Written file.
+
+        """
+        write_yaml(self.path, self.settings)
+        with open(self.path) as file_obj:
+            written = file_obj.read()
+        self.assertEqual(yaml.safe_load(written), self.settings)
+        return written
+
+    def test_unchanged(self):
+        """Unchanged settings are written as they were."""
+        self.assertEqual(self._write(), CONFIG)
+
+    def test_changed(self):
+        """Changed values keep the style of the old values."""
+        hub = self.settings['HUBS'][0]
+        hub['ble_id'] = '90:84:2B:4E:35:B5'
+        hub['hardware']['steering_motor']['capabilities'].append('sense_speed')
+        self.settings['MACROS']['launch'][1]['speed'] = 50
+        self.settings['LOG_VERBOSITY'] = 5
+        expected = (CONFIG
+                    .replace("'90:84:2B:4E:35:B4'", "'90:84:2B:4E:35:B5'")
+                    .replace('[sense_pos]', '[sense_pos, sense_speed]')
+                    .replace('speed: 100}', 'speed: 50}')
+                    .replace('LOG_VERBOSITY: 1', 'LOG_VERBOSITY: 5'))
+        self.assertEqual(self._write(), expected)
+
+
+class TestLoadSettings(unittest.TestCase):
+    """Tests of :meth:`settings.Settings.load_settings_from_yaml`."""
+
+    def setUp(self):
+        """Load a config file in a temporary directory."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'legcocar.conf')
+        self._write('SETTINGS_RELOAD_INTERVAL: 5.0\nIDEMPOTENCY_TTL: 9.0\n')
+        config_path = Settings._Settings__CONFIG_PATH
+        Settings._Settings__CONFIG_PATH = directory.name
+        Settings.static_init()
+        self.addCleanup(setattr, Settings, '_Settings__CONFIG_PATH',
+                        config_path)
+        # Unload the settings again
+        self.addCleanup(Settings.load_settings_from_yaml)
+        self.addCleanup(self._write, '')
+        Settings.load_settings_from_yaml()
+
+    def _write(self, text: str):
+        """
+        Write the config file. The files of a test have different sizes, so
+        that they are loaded again.
+
+        :param text: Config file text.
+
+        """
+        with open(self.path, 'w') as file_obj:
+            file_obj.write(text)
+
+    def test_removed(self):
+        """Removed settings get their default value or are deleted."""
+        self.assertEqual(Settings.SETTINGS_RELOAD_INTERVAL, 5.0)
+        self.assertEqual(Settings.IDEMPOTENCY_TTL, 9.0)
+        self._write('LOG_VERBOSITY: 1\n')
+        self.assertEqual(Settings.load_settings_from_yaml(),
+                         {'SETTINGS_RELOAD_INTERVAL', 'IDEMPOTENCY_TTL',
+                          'LOG_VERBOSITY'})
+        self.assertEqual(Settings.SETTINGS_RELOAD_INTERVAL, 1.0)
+        self.assertFalse(hasattr(Settings, 'IDEMPOTENCY_TTL'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+.. moduleauthor:: John Brännström <john.brannstrom@gmail.com>
+
+Supervisor tests
+****************
+
+Tests of the worker restarts of the supervisor, with real worker processes.
+
+"""
+
+# Built in modules
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# Local modules
+from supervisor import Supervisor
+
+
+def crashing_worker(hub: str, health_pipe, core: int):
+    """
+    Worker that reports its health and then crashes.
+
+    :param hub:         Hub name.
+    :param health_pipe: Pipe to the supervisor.
+    :param core:        Core to pin to.
+
+    """
+    health_pipe.send({'hub': hub, 'state': 'running'})
+    health_pipe.close()
+    sys.exit(3)
+
+
+class TestSupervisor(unittest.TestCase):
+    """Tests of :class:`supervisor.Supervisor`."""
+
+    def test_crash(self):
+        """Crashed workers are restarted with a doubled backoff."""
+        messages = []
+        supervisor = Supervisor(hubs=['hub2'], target=crashing_worker,
+                                min_backoff=0.05, max_backoff=0.1,
+                                stable_time=60.0, log=messages.append)
+        self.addCleanup(supervisor.stop)
+        worker = supervisor.workers['hub2']
+        deadline = time.monotonic() + 60
+        while worker['restarts'] < 3 and time.monotonic() < deadline:
+            supervisor.run_once(timeout=0.1)
+        self.assertEqual(worker['restarts'], 3)
+        self.assertEqual(worker['exitcode'], 3)
+        self.assertEqual(worker['backoff'], 0.1)
+        self.assertEqual(supervisor.status()['hub2']['health'],
+                         {'hub': 'hub2', 'state': 'running'})
+        self.assertEqual(
+            [message.split(',')[0] for message in messages
+             if message.startswith('Worker')],
+            ['Worker hub2 exited with 3'] * 3)
+        self.assertIn('restart in 0.1 s', messages[-1])
+
+        # The worker is started again when its backoff has passed
+        time.sleep(0.1)
+        supervisor.run_once(timeout=0)
+        self.assertTrue(supervisor.status()['hub2']['running'])
+
+
+if __name__ == '__main__':
+    unittest.main()